@@ -51,6 +51,23 @@ class DougApplication(BaseApplication):
             #print("logging to file", file)
             shtoom.log.startLogging(file)
         BaseApplication.boot(self)
+        # Configure the RTP port allocator and the prompt cache from our
+        # preferences now, rather than when the first call turns up.
+        from shtoom.rtp.ports import getPortAllocator
+        self.portAllocator = getPortAllocator(self)
+        from shtoom.doug.promptcache import getPromptCache
+        self.promptCache = getPromptCache(self)
+        # Let recordings finish writing before we exit
+        from twisted.internet import reactor
+        from shtoom.doug.recorder import getRecordingWriter
+        reactor.addSystemEventTrigger('after', 'shutdown',
+                                      getRecordingWriter().stop)
+        if self.getPref('conference_workers'):
+            from twisted.internet import reactor
+            from shtoom.doug import conferencing
+            conferencing.startSharding(self.getPref('conference_workers'))
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                                          conferencing.stopSharding)
 
     def start(self):
         "Start the application."
@@ -136,6 +153,8 @@ class DougApplication(BaseApplication):
             d.addErrback(lambda x: self.rejectedCall(cookie, x))
             ad = defer.Deferred()
             inbound = Leg(cookie, call.dialog)
+            if self.getPref('vad'):
+                inbound.vadMode()
             inbound.incomingCall(ad)
             self._voiceapps[cookie].va_callstart(inbound)
             d.addCallback(lambda x, ad=ad: ad)
@@ -154,8 +173,22 @@ class DougApplication(BaseApplication):
         rtp = RTPProtocol(self, cookie)
         self._rtp[cookie] = rtp
         d = rtp.createRTPSocket(fromIP,withSTUN)
+        d.addErrback(self._createRTPFailed, cookie)
         return d
 
+    def _createRTPFailed(self, failure, cookie):
+        # Most likely we've run out of RTP ports (NoRTPPortsAvailable).
+        log.msg("couldn't create RTP for %s: %s"%(cookie,
+                failure.getErrorMessage()), system='doug')
+        if cookie in self._rtp:
+            del self._rtp[cookie]
+        return failure
+
+    def getPortStats(self):
+        "RTP port occupancy, as a dict of counters"
+        from shtoom.rtp.ports import getPortAllocator
+        return getPortAllocator(self).getStats()
+
     def selectDefaultFormat(self, callcookie, sdp):
         md = sdp.getMediaDescription('audio')
         rtpmap = md.rtpmap
@@ -187,6 +220,9 @@ class DougApplication(BaseApplication):
             rtp = self._rtp[callcookie]
             rtp.stopSendingAndReceiving()
             del self._rtp[callcookie]
+            log.msg("rtp ports: %(inuse)d in use, %(free)d free, "
+                    "%(quarantined)d quarantined"%self.getPortStats(),
+                    system='doug')
         if self._calls.get(callcookie):
             del self._calls[callcookie]
         if self._voiceapps.get(callcookie):
@@ -197,9 +233,11 @@ class DougApplication(BaseApplication):
         from shtoom.rtp.formats import PT_NTE
         v = self._voiceapps[callcookie]
         if packet.header.ct is PT_NTE:
+            # Bridged legs in passthrough pass the NTE on as well
+            v.va_incomingNTE(packet, callcookie)
             data = packet.data
-            key = ord(data[0])
-            start = (ord(data[1]) & 128) and True or False
+            key = data[0]
+            start = (data[1] & 128) and True or False
             if start:
                 #print("start inbound dtmf", key)
                 v.va_startDTMFevent(nteMap[key], callcookie)
@@ -218,6 +256,19 @@ class DougApplication(BaseApplication):
         if rtp:
             rtp.handle_media_sample(sample)
 
+    def relayRTP(self, cookie, packet):
+        rtp = self._rtp.get(cookie)
+        if rtp:
+            rtp.relay_packet(packet)
+
+    def relayLegs(self, cookie1, cookie2):
+        "Relay RTP between two calls. Returns the RTPRelay, or None"
+        from shtoom.rtp.relay import relayRTP
+        rtp1, rtp2 = self._rtp.get(cookie1), self._rtp.get(cookie2)
+        if rtp1 is None or rtp2 is None:
+            return None
+        return relayRTP(rtp1, rtp2)
+
     def placeCall(self, cookie, nleg, sipURL, fromURI=None):
         ncookie = self.getCookie()
         nleg.setCookie(ncookie)
@@ -269,10 +320,19 @@ class DougApplication(BaseApplication):
         import os.path
 
         from shtoom.Options import OptionGroup, StringOption, ChoiceOption
+        from shtoom.Options import NumberOption
         app = OptionGroup('doug', 'doug')
         app.add(StringOption('logfile','log to this file'))
         app.add(StringOption('dougargs',
                                 'pass these arguments to the voiceapp'))
+        app.add(NumberOption('conference_workers',
+                        'mix conference rooms in this many processes'))
+        app.add(NumberOption('prompt_cache_size',
+                        'megabytes of encoded prompts to keep'))
+        app.add(StringOption('prompt_cache_dir',
+                        'keep encoded prompts in this directory'))
+        app.add(StringOption('prompt_dirs',
+                        'cache prompts from these directories (comma separated)'))
         opts.add(app)
         if self.configFileName is not None:
             opts.setOptsFile(self.configFileName)
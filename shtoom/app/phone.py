@@ -304,6 +304,8 @@ class Phone(BaseApplication):
         app.add(ChoiceOption('audio',_('use AUDIO for interface'),
                     choices=['oss', 'fast', 'port', 'alsa', 'echo', 'file']))
         app.add(StringOption('audio_device',_('use this audio device')))
+        app.add(ChoiceOption('playout',_('jitter buffer policy'),
+                            default='fixed', choices=['fixed', 'adaptive']))
         # XXX TOFIX: This next option Must Die.
         app.add(StringOption('shtoomdir',_('root dir of shtoom installation')))
         app.add(StringOption('incoming_ring_file',
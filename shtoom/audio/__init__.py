@@ -61,4 +61,11 @@ def getAudioDevice(_testAudioInt=None):
             raise NoAudioDevice("no working audio interface found")
         dev = audioint.Device()
         _device = MediaLayer(dev)
+        try:
+            from __main__ import app
+        except:
+            app = None
+        if app:
+            _device.playoutPolicy = app.getPref('playout')
+            _device.vad = app.getPref('vad')
     return _device
@@ -1,5 +1,9 @@
-import wave, sunau, aifc, sndhdr
-from audioop import tomono, lin2lin, ulaw2lin, ratecv
+import wave
+try:
+    from audioop import tomono, lin2lin, ratecv
+except ImportError:
+    # Python 3.13 and later. Only needed for resampling and the like.
+    tomono = lin2lin = ratecv = None
 
 import struct
 if struct.pack("h", 1) == "\000\001":
@@ -7,12 +11,23 @@ if struct.pack("h", 1) == "\000\001":
 else:
     big_endian = 0
 
+def _stdlibModule(name):
+    """ Import one of the audio file modules (sunau, sndhdr) that
+        Python 3.13 dropped, only when it's actually needed.
+    """
+    try:
+        return __import__(name)
+    except ImportError:
+        raise ImportError("the %s module is needed for this, and this "
+                          "Python doesn't have it (it was removed in "
+                          "3.13)"%(name,))
+
 class BaseReader:
     _cvt = lambda s, x: x
     _freqCvt = { 8000: 160, 16000: 320, 32000: 640, 64000: 1280 }
 
     def __init__(self, fp):
-        self.fp = self.module.open(fp, 'rb')
+        self.fp = _stdlibModule(self.moduleName).open(fp, 'rb')
         p = self.fp.getparams()
         print(p)
         if (p[4] not in self.allowedComp):
@@ -49,11 +64,11 @@ class BaseReader:
         self.fp.close()
 
 class WavReader(BaseReader):
-    module = wave
+    moduleName = 'wave'
     allowedComp = ('NONE','ULAW')
 
 class AuReader(BaseReader):
-    module = sunau
+    moduleName = 'sunau'
     allowedComp = ('ULAW','NONE')
 
     def endianCvt(self, data):
@@ -74,7 +89,7 @@ class BaseWriter:
     sampwidth = 2
 
     def __init__(self, fp):
-        self.fp = self.module.open(fp, 'wb')
+        self.fp = _stdlibModule(self.moduleName).open(fp, 'wb')
         self.fp.setparams((1, 2, 8000, 0, 'NONE', 'not compressed'))
 
     def write(self, data):
@@ -84,10 +99,10 @@ class BaseWriter:
         self.fp.close()
 
 class WavWriter(BaseWriter):
-    module = wave
+    moduleName = 'wave'
 
 class AuWriter(BaseWriter):
-    module = sunau
+    moduleName = 'sunau'
     def endianCvt(self, data):
         import array
         _array_fmts = None, None, 'h', None, 'l'
@@ -120,6 +135,177 @@ def getWriter(filename):
         raise ValueError("only know .au/.wav files, not %s"%(filename))
     return audio
 
+
+# Mapping whole files, for Doug's prompts. Rather than reading a frame at
+# a time, the file is mmap'd and converted (if need be) to 16 bit, 8KHz
+# mono PCM once; players then take slices of the result.
+
+import os, sys, mmap, threading
+from collections import OrderedDict
+
+# Converted files to keep, in bytes
+MAX_CONVERTED = 16 * 1024 * 1024
+
+# Files are converted in threads (by the prompt cache) as well as on the
+# reactor, so the bookkeeping is done under _convertedLock. The
+# converting itself isn't.
+_converted = OrderedDict()
+_convertedBytes = 0
+_convertedLock = threading.Lock()
+
+# WAV format tags, and AU encodings, that we understand
+_WAV_PCM, _WAV_ALAW, _WAV_ULAW = 1, 6, 7
+_AU_ULAW, _AU_LIN8, _AU_LIN16, _AU_ALAW = 1, 2, 3, 27
+
+def _parseWav(buf):
+    """ Returns (encoding, width, rate, channels, offset, length) for a
+        RIFF WAVE file. encoding is 'lin', 'ulaw' or 'alaw'.
+    """
+    if buf[:4] != b'RIFF' or buf[8:12] != b'WAVE':
+        raise ValueError("not a WAV file")
+    fmt = None
+    off = 12
+    while off + 8 <= len(buf):
+        cid, clen = struct.unpack_from('<4sI', buf, off)
+        off += 8
+        if cid == b'fmt ':
+            tag, channels, rate, _, _, bits = struct.unpack_from('<HHIIHH',
+                                                                 buf, off)
+            fmt = tag, channels, rate, bits // 8
+        elif cid == b'data':
+            if fmt is None:
+                break
+            tag, channels, rate, width = fmt
+            encoding = { _WAV_PCM: 'lin', _WAV_ULAW: 'ulaw',
+                         _WAV_ALAW: 'alaw' }.get(tag)
+            if encoding is None:
+                raise ValueError("can't handle WAV format %d"%(tag,))
+            return (encoding, width, rate, channels, off,
+                    min(clen, len(buf) - off))
+        off += clen + (clen & 1)
+    raise ValueError("no fmt/data chunks in WAV file")
+
+def _parseAu(buf):
+    "As _parseWav, for a Sun .au file"
+    magic, off, length, enc, rate, channels = struct.unpack_from('>4sIIIII',
+                                                                 buf)
+    if magic != b'.snd':
+        raise ValueError("not an AU file")
+    if enc == _AU_ULAW:
+        encoding, width = 'ulaw', 1
+    elif enc == _AU_ALAW:
+        encoding, width = 'alaw', 1
+    elif enc == _AU_LIN8:
+        encoding, width = 'lin', 1
+    elif enc == _AU_LIN16:
+        encoding, width = 'linbe', 2
+    else:
+        raise ValueError("can't handle AU encoding %d"%(enc,))
+    if length == 0xffffffff:
+        length = len(buf) - off
+    return encoding, width, rate, channels, off, min(length, len(buf) - off)
+
+def _toPCM(data, encoding, width, rate, channels):
+    "Convert audio to 16 bit, 8KHz, mono, native-endian PCM"
+    from shtoom.audio import g711
+    if encoding in ('ulaw', 'alaw'):
+        data, width = getattr(g711, encoding).decode(data), 2
+        if channels == 1 and rate == 8000:
+            # The usual telephony case - no need for audioop
+            return data
+    try:
+        from audioop import byteswap, lin2lin, bias, tomono, ratecv
+    except ImportError:
+        raise ValueError("can't convert %s audio (%d bit, %dHz, %d "
+                         "channels) to 8KHz PCM without audioop"%(
+                            encoding, width * 8, rate, channels))
+    if encoding == 'linbe':
+        if sys.byteorder == 'little' and width > 1:
+            data = byteswap(data, width)
+    elif encoding == 'lin' and sys.byteorder == 'big' and width > 1:
+        data = byteswap(data, width)
+    if encoding == 'lin' and width == 1:
+        # 8 bit WAV is unsigned
+        data = bias(data, 1, -128)
+    if channels == 2:
+        data = tomono(data, width, 0.5, 0.5)
+    elif channels != 1:
+        raise ValueError("can only handle mono/stereo, not %d"%(channels,))
+    if width != 2:
+        data = lin2lin(data, width, 2)
+    if rate != 8000:
+        data, state = ratecv(data, 2, 1, rate, 8000, None)
+    return data
+
+def mapAudioFile(filename, convert=True):
+    """ Return the audio in filename (a .wav, .au, or raw 16 bit 8KHz
+        PCM file) as a buffer of 16 bit 8KHz mono PCM.
+
+        Files that are already in that format are mmap'd, and the
+        buffer is a view of the mapping. Anything else is converted the
+        first time it's asked for, and the result is kept (up to
+        MAX_CONVERTED bytes' worth) for next time. If convert is False,
+        None is returned instead of converting.
+    """
+    global _convertedBytes
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
+    with _convertedLock:
+        pcm = _converted.get(key)
+        if pcm is not None:
+            _converted.move_to_end(key)
+            return pcm
+    if not st.st_size:
+        return memoryview(b'')
+    fp = open(path, 'rb')
+    try:
+        buf = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+    finally:
+        fp.close()
+    name = path.lower()
+    if name.endswith('.wav'):
+        params = _parseWav(buf)
+    elif name.endswith('.au'):
+        params = _parseAu(buf)
+    else:
+        # Raw, the way Doug's always had them
+        return buf
+    encoding, width, rate, channels, off, length = params
+    # Only whole samples
+    length -= length % (width * channels)
+    data = buf[off:off+length]
+    if ((encoding == 'lin' and sys.byteorder == 'little') or
+            (encoding == 'linbe' and sys.byteorder == 'big')) and \
+            (width, rate, channels) == (2, 8000, 1):
+        return data
+    if not convert:
+        return None
+    pcm = _toPCM(data, encoding, width, rate, channels)
+    with _convertedLock:
+        if key in _converted:
+            # Someone else converted it while we were
+            _convertedBytes -= len(_converted[key])
+        _converted[key] = pcm
+        _convertedBytes += len(pcm)
+        while _convertedBytes > MAX_CONVERTED and len(_converted) > 1:
+            k, old = _converted.popitem(last=False)
+            _convertedBytes -= len(old)
+    return pcm
+
+def mapAudioFileLater(filename):
+    """ As mapAudioFile, but returns a Deferred. A file that needs
+        converting is converted in a thread, so the reactor (and every
+        call's media) doesn't wait for it. Missing or unreadable files
+        still raise straight away.
+    """
+    from twisted.internet import defer, threads
+    pcm = mapAudioFile(filename, convert=False)
+    if pcm is not None:
+        return defer.succeed(pcm)
+    return threads.deferToThread(mapAudioFile, filename)
+
+
 # For testing porpoises
 def getdev():
     import ossaudiodev
@@ -133,7 +319,7 @@ def getdev():
 def test():
     import sys
     if len(sys.argv) == 2:
-        print(sndhdr.what(sys.argv[1]))
+        print(_stdlibModule('sndhdr').what(sys.argv[1]))
         inaudio = getReader(sys.argv[1])
         outaudio = getdev()
     elif len(sys.argv) == 3:
@@ -0,0 +1,168 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+The media clock.
+
+Everything that produces or consumes a frame of audio every 20ms (legs,
+conference rooms, some of the audio devices) used to run its own
+LoopingCall. With lots of calls that's lots of timers, all drifting
+against each other. Instead they all register with the one MediaClock,
+which calls them in a single pass each tick.
+
+Clients are called in priority order - devices, then rooms, then legs -
+so that a room has mixed this tick's audio before the legs read it.
+"""
+
+from twisted.python import log
+
+# Client priorities. Lower goes first.
+PRIORITY_DEVICE = 0
+PRIORITY_ROOM = 10
+PRIORITY_LEG = 20
+
+# If the reactor is late by more than this many ticks, don't try to make
+# them all up - skip ahead.
+MAX_CATCHUP_TICKS = 5
+
+class MediaClockCall:
+    """ Returned by MediaClock.call(). Has a stop() method, like the
+        LoopingCall it replaces.
+    """
+
+    def __init__(self, clock, func, priority):
+        self.clock = clock
+        self.func = func
+        self.priority = priority
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.clock._remove(self)
+
+    def __repr__(self):
+        return "<MediaClockCall %r priority %d>"%(self.func, self.priority)
+
+
+class MediaClock:
+    """ Calls every registered function once every interval seconds.
+
+        If the reactor is late calling us, the missed ticks are run
+        straight away (up to MAX_CATCHUP_TICKS of them), so clients
+        still see the right number of ticks per second.
+    """
+
+    def __init__(self, interval=0.020, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.interval = interval
+        # priority -> {call: True}, in order of registration
+        self._calls = {}
+        self._order = None
+        self._timer = None
+        self._next = None
+        self._firing = False
+        # statistics
+        self.ticks = 0
+        self.lateTicks = 0
+        self.skippedTicks = 0
+        self.lateness = 0.0
+        self.maxLateness = 0.0
+
+    def call(self, func, priority=PRIORITY_LEG):
+        "Call func() every tick, until the returned object is stop()ed"
+        c = MediaClockCall(self, func, priority)
+        self._calls.setdefault(priority, {})[c] = True
+        self._order = None
+        if self._timer is None and not self._firing:
+            self._start()
+        return c
+
+    def _remove(self, c):
+        calls = self._calls.get(c.priority)
+        if calls is not None and c in calls:
+            del calls[c]
+            if not calls:
+                del self._calls[c.priority]
+            self._order = None
+        if not self._calls:
+            self._stop()
+
+    def clientCount(self):
+        return sum([len(x) for x in self._calls.values()])
+
+    def isRunning(self):
+        return self._timer is not None
+
+    def _start(self):
+        now = self.reactor.seconds()
+        self._next = now + self.interval
+        self._timer = self.reactor.callLater(self.interval, self._fire)
+
+    def _stop(self):
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+
+    def _fire(self):
+        self._timer = None
+        now = self.reactor.seconds()
+        late = now - self._next
+        self.lateness = late
+        if late > self.maxLateness:
+            self.maxLateness = late
+        due = int(late / self.interval) + 1
+        if due > 1:
+            self.lateTicks += due - 1
+        if due > MAX_CATCHUP_TICKS:
+            self.skippedTicks += due - MAX_CATCHUP_TICKS
+            log.msg("media clock %0.3fs late, skipping %d ticks"%(late,
+                        due - MAX_CATCHUP_TICKS), system='audio')
+            self._next += (due - MAX_CATCHUP_TICKS) * self.interval
+            due = MAX_CATCHUP_TICKS
+        self._firing = True
+        try:
+            for i in range(due):
+                self.tick()
+                self._next += self.interval
+        finally:
+            self._firing = False
+        if self._calls and self._timer is None:
+            self._timer = self.reactor.callLater(
+                            max(0, self._next - self.reactor.seconds()),
+                            self._fire)
+
+    def tick(self):
+        "Call everything once"
+        self.ticks += 1
+        order = self._order
+        if order is None:
+            order = self._order = [ c for p in sorted(self._calls)
+                                      for c in self._calls[p] ]
+        for c in order:
+            # A client may be stopped by one that runs before it.
+            if not c.running:
+                continue
+            try:
+                c.func()
+            except:
+                log.err()
+
+    def getStats(self):
+        return { 'clients': self.clientCount(),
+                 'ticks': self.ticks,
+                 'late': self.lateTicks,
+                 'skipped': self.skippedTicks,
+                 'maxlateness': self.maxLateness,
+               }
+
+_clock = None
+
+def getMediaClock():
+    "Returns the process-wide media clock"
+    global _clock
+    if _clock is None:
+        _clock = MediaClock()
+    return _clock
@@ -4,6 +4,7 @@ from shtoom.rtp.formats import PT_PCMA, PT_ILBC
 from shtoom.rtp.formats import PT_CN, PT_xCN, AudioPTMarker
 from shtoom.avail import codecs
 from shtoom.audio import aufile, playout
+from shtoom.audio.framebuffer import FrameBuffer
 from shtoom.lwc import Interface, implements
 
 from twisted.python import log
@@ -11,10 +12,7 @@ from twisted.python import log
 #import sets
 import struct
 
-try:
-    import audioop
-except ImportError:
-    audioop = None
+from shtoom.audio import g711
 
 class NullEncoder:
     def handle_audio(self, data):
@@ -83,17 +81,25 @@ class IAudioCodec:
 class _Codec:
     """Base class for codecs"""
     implements(IAudioCodec)
+    # A stateless codec can encode and decode frames from any number of
+    # streams - see encodeBatch()
+    stateless = False
+
     def __init__(self, samplesize):
         self.samplesize = samplesize
-        self.b = b''
+        self.b = FrameBuffer()
 
     def buffer_and_encode(self, payload):
-        self.b += payload
-        res = []
-        while len(self.b) >= self.samplesize:
-            sample, self.b = self.b[:self.samplesize], self.b[self.samplesize:]
-            res.append(self._encode(sample))
-        return res
+        self.b.write(payload)
+        return [ self._encode(f) for f in self.b.frames(self.samplesize) ]
+
+    def encodeFrames(self, frames):
+        "Encode a list of frames of samplesize bytes each"
+        return [ self._encode(bytes(f)) for f in frames ]
+
+    def decodePayloads(self, payloads):
+        "Decode a list of payloads"
+        return [ self.decode(bytes(p)) for p in payloads ]
 
 class GSMCodec(_Codec):
     def __init__(self):
@@ -140,16 +146,46 @@ class SpeexCodec(_Codec):
         ostr = struct.pack('160h', *frames)
         return ostr
 
-class MulawCodec(_Codec):
-    """A codec for mulaw encoded audio (G.711U, PCMU)"""
+class _G711Codec(_Codec):
+    """ Base class for the G.711 codecs. With numpy, a batch of frames is
+        converted in one table lookup.
+    """
+    stateless = True
+    law = None
 
     def __init__(self):
         _Codec.__init__(self, 320)
-        self.buf = b''
+
+    def _batch(self, convert, chunks, size, dtype):
+        if g711.numpy is None or len(chunks) < 2:
+            return None
+        for c in chunks:
+            if len(c) != size:
+                return None
+        out = convert(g711.numpy.frombuffer(b''.join(chunks),
+                                            dtype)).tobytes()
+        n = len(out) // len(chunks)
+        return [ out[i:i+n] for i in range(0, len(out), n) ]
+
+    def encodeFrames(self, frames):
+        res = self._batch(self.law.encodeSamples, frames, 320, 'int16')
+        if res is None:
+            res = _Codec.encodeFrames(self, frames)
+        return res
+
+    def decodePayloads(self, payloads):
+        res = self._batch(self.law.decodeCodes, payloads, 160, 'uint8')
+        if res is None:
+            res = _Codec.decodePayloads(self, payloads)
+        return res
+
+class MulawCodec(_G711Codec):
+    """A codec for mulaw encoded audio (G.711U, PCMU)"""
+    law = g711.ulaw
 
     def _encode(self, payload):
         assert isinstance(payload, bytes), "payload is not an instance of bytes"
-        return audioop.lin2ulaw(payload, 2)
+        return g711.lin2ulaw(payload)
 
     def decode(self, payload):
         assert isinstance(payload, bytes), "payload is not an instance of bytes"
@@ -159,36 +195,28 @@ class MulawCodec(_Codec):
             log.msg("mulaw: short read on decode, %d != 160"%len(payload),
                                                             system="codec")
             # Pad with silence.
-            extra = (160 - len(payload)) * payload[-1]
+            extra = (160 - len(payload)) * payload[-1:]
             payload += extra
-        if 0:
-            payload = audioop.ulaw2lin(payload, 2)
-            self.buf += payload
-            if len(self.buf) > 159:
-                out, self.buf = self.buf[:160], self.buf[160:]
-                return out
-        else:
-            return audioop.ulaw2lin(payload, 2)
+        return g711.ulaw2lin(payload)
 
-class AlawCodec(_Codec):
+class AlawCodec(_G711Codec):
     "A codec for alaw encoded audio (G.711A, PCMA)"
-
-    def __init__(self):
-        _Codec.__init__(self, 320)
+    law = g711.alaw
 
     def _encode(self, payload):
         assert isinstance(payload, bytes), "payload is not an instance of bytes"
-        return audioop.lin2alaw(payload, 2)
+        return g711.lin2alaw(payload)
 
     def decode(self, payload):
         assert isinstance(payload, bytes), "payload is not an instance of bytes"
         if len(payload) != 160:
             log.msg("alaw: short read on decode, %d != 160"%len(payload),
                                                             system="codec")
-        return audioop.alaw2lin(payload, 2)
+        return g711.alaw2lin(payload)
 
 class NullCodec(_Codec):
     """A codec that consumes/emits nothing (e.g. for comfort noise)"""
+    stateless = True
 
     def __init__(self):
         _Codec.__init__(self, 1)
@@ -203,43 +231,102 @@ class NullCodec(_Codec):
 
 class PassthruCodec(_Codec):
     """A codec that leaves it's input alone"""
+    stateless = True
     def __init__(self):
         _Codec.__init__(self, None)
     decode = lambda self, payload: payload
     buffer_and_encode = lambda self, payload: [payload]
 
-def make_codec_set():
-    format_to_codec = {}
-    format_to_codec[PT_CN] = NullCodec()
-    format_to_codec[PT_xCN] = NullCodec()
-    format_to_codec[PT_RAW] = PassthruCodec()
+def _findCodecs():
+    "format -> codec class, for every codec we can use"
+    format_to_class = {}
+    format_to_class[PT_CN] = NullCodec
+    format_to_class[PT_xCN] = NullCodec
+    format_to_class[PT_RAW] = PassthruCodec
     assert codecs.mulaw
     if codecs.mulaw is not None:
-        format_to_codec[PT_PCMU] = MulawCodec()
+        format_to_class[PT_PCMU] = MulawCodec
     if codecs.alaw is not None:
-        format_to_codec[PT_PCMA] = AlawCodec()
+        format_to_class[PT_PCMA] = AlawCodec
     if codecs.gsm is not None:
-        format_to_codec[PT_GSM] = GSMCodec()
+        format_to_class[PT_GSM] = GSMCodec
     if codecs.speex is not None:
-        format_to_codec[PT_SPEEX] = SpeexCodec()
+        format_to_class[PT_SPEEX] = SpeexCodec
     #if codecs.dvi4 is not None:
-    #    format_to_codec[PT_DVI4] = DVI4Codec()
+    #    format_to_class[PT_DVI4] = DVI4Codec
     #if codecs.ilbc is not None:
-    #    format_to_codec[PT_ILBC] = ILBCCodec()
-    return format_to_codec
+    #    format_to_class[PT_ILBC] = ILBCCodec
+    return format_to_class
+
+codecClasses = _findCodecs()
+
+# Stateless codecs, shared by every CodecSet
+_sharedCodecs = {}
+
+class CodecSet:
+    """ The codecs one Codecker uses, by format. They're only created
+        when they're first asked for. Stateless codecs (G.711, CN, raw)
+        are shared by everyone; stateful ones (GSM, Speex) belong to
+        this CodecSet alone.
+    """
+
+    def __init__(self):
+        self._codecs = {}
+
+    def get(self, format, default=None):
+        codec = self._codecs.get(format)
+        if codec is None:
+            klass = codecClasses.get(format)
+            if klass is None:
+                return default
+            if klass.stateless:
+                codec = _sharedCodecs.get(format)
+                if codec is None:
+                    codec = _sharedCodecs[format] = klass()
+            else:
+                codec = klass()
+            self._codecs[format] = codec
+        return codec
+
+    def __getitem__(self, format):
+        codec = self.get(format)
+        if codec is None:
+            raise KeyError(format)
+        return codec
+
+    def __contains__(self, format):
+        return format in codecClasses
+
+    def keys(self):
+        return codecClasses.keys()
+
+    def values(self):
+        return [ self[f] for f in codecClasses ]
+
+    def items(self):
+        return [ (f, self[f]) for f in codecClasses ]
+
+def make_codec_set():
+    return CodecSet()
 
 # changed for Python 3
 # sets.ImmutableSet ==> frozenset
-known_formats = (frozenset(make_codec_set().keys()) -
+known_formats = (frozenset(codecClasses.keys()) -
                                   frozenset([PT_CN, PT_xCN,]))
 
 class Codecker:
     def __init__(self, format):
-        self.format_to_codec = make_codec_set()
         if not format in known_formats:
             raise ValueError("Can't handle codec %r"%format)
+        self.format_to_codec = make_codec_set()
         self.format = format
         self.handler = None
+        # Audio left over from the last handle_audio(), by format, for
+        # shared codecs
+        self._pending = {}
+        self.vad = None
+        self._vadBuffer = None
+        self._cnLevel = None
 
     def set_handler(self, handler):
         """
@@ -250,22 +337,73 @@ class Codecker:
     def getDefaultFormat(self):
         return self.format
 
+    def setVAD(self, vad):
+        """ Run outgoing audio through vad (a shtoom.audio.vad.VAD), and
+            send comfort noise instead of silence. None turns it off.
+        """
+        self.vad = vad
+        self._vadBuffer = None
+        if vad is not None:
+            self._vadBuffer = FrameBuffer()
+        self._cnLevel = None
+
     def handle_audio(self, payload):
-        """Accept audio as bytes, emits MediaSamples."""
-        assert isinstance(payload, bytes), "payload is not an instance of bytes"
+        """Accept audio as bytes (or a view of some), emits MediaSamples."""
+        assert isinstance(payload, (bytes, memoryview)), \
+                            "payload is not an instance of bytes"
         if not payload:
             return None
         codec = self.format_to_codec.get(self.format)
         if not codec:
             raise ValueError("can't encode format %r"%self.format)
-        encaudios = codec.buffer_and_encode(payload)
-        for encaudio in encaudios:
-            samp = MediaSample(self.format, encaudio)
+        if self.vad is not None and codec.samplesize == 320:
+            samples = self._vad_and_encode(codec, payload)
+        else:
+            if codec.stateless and codec.samplesize:
+                encaudios = self._buffer_and_encode(codec, payload)
+            else:
+                encaudios = codec.buffer_and_encode(payload)
+            samples = [ MediaSample(self.format, e) for e in encaudios ]
+        for samp in samples:
             if self.handler is not None:
                 self.handler(samp)
             else:
                 return samp
 
+    def _buffer_and_encode(self, codec, payload):
+        """ codec.buffer_and_encode(), for a shared codec - what's left
+            over is kept here, not in the codec.
+        """
+        b = self._pending.get(self.format)
+        if b is None:
+            b = self._pending[self.format] = FrameBuffer()
+        b.write(payload)
+        return codec.encodeFrames(b.frames(codec.samplesize))
+
+    def _vad_and_encode(self, codec, payload):
+        """ Encode the frames of payload that are speech. For each frame
+            of silence, there's a CN sample if the other end needs to be
+            told the noise level, or None.
+        """
+        from shtoom.audio.vad import cnPayload, CN_LEVEL_CHANGE
+        b = self._vadBuffer
+        b.write(payload)
+        samples = []
+        for frame in b.frames(320):
+            if self.vad.process(frame):
+                self._cnLevel = None
+                samples.append(MediaSample(self.format,
+                                           codec.encodeFrames([frame])[0]))
+                continue
+            level = self.vad.noiseLevel()
+            if (self._cnLevel is None or
+                    abs(level - self._cnLevel) >= CN_LEVEL_CHANGE):
+                self._cnLevel = level
+                samples.append(MediaSample(PT_CN, cnPayload(level)))
+            else:
+                samples.append(None)
+        return samples
+
     def decode(self, packet):
         """Accepts an RTPPacket, emits audio as bytes"""
         if not packet.data:
@@ -276,6 +414,50 @@ class Codecker:
         encaudio = codec.decode(packet.data)
         return encaudio
 
+def encodeBatch(codeckers, frames):
+    """ Encode a frame of audio for each of a list of Codeckers, as their
+        handle_audio() would, and return a list of the MediaSamples (or
+        None). Frames for streams with the same stateless codec (G.711)
+        are encoded together, in one go.
+    """
+    out = [None] * len(frames)
+    groups = {}
+    for i, c in enumerate(codeckers):
+        codec = c.format_to_codec.get(c.format)
+        frame = frames[i]
+        if (codec is not None and codec.stateless and c.handler is None
+                and c.vad is None and not c._pending.get(c.format)
+                and len(frame) == codec.samplesize):
+            groups.setdefault(c.format, (codec, []))[1].append(i)
+        else:
+            out[i] = c.handle_audio(frame)
+    for fmt, (codec, idx) in groups.items():
+        payloads = codec.encodeFrames([ frames[i] for i in idx ])
+        for i, payload in zip(idx, payloads):
+            out[i] = MediaSample(fmt, payload)
+    return out
+
+def decodeBatch(codeckers, packets):
+    """ Decode an RTPPacket for each of a list of Codeckers, as their
+        decode() would, returning a list of the audio. Packets with the
+        same stateless codec are decoded together.
+    """
+    out = [None] * len(packets)
+    groups = {}
+    for i, c in enumerate(codeckers):
+        packet = packets[i]
+        ct = packet.header.ct
+        codec = c.format_to_codec.get(ct)
+        if codec is not None and codec.stateless and packet.data:
+            groups.setdefault(ct, (codec, []))[1].append(i)
+        else:
+            out[i] = c.decode(packet)
+    for ct, (codec, idx) in groups.items():
+        audio = codec.decodePayloads([ packets[i].data for i in idx ])
+        for i, data in zip(idx, audio):
+            out[i] = data
+    return out
+
 class MediaLayer(NullConv):
     """ The MediaLayer sits between the network and the raw
         audio device. It converts the audio to/from the codec on
@@ -285,6 +467,10 @@ class MediaLayer(NullConv):
 
     _playfile_LC = None
     _playfile_fp = None
+    # jitter buffer policy - see shtoom.audio.playout.policies
+    playoutPolicy = None
+    # don't send silence - see shtoom.audio.vad
+    vad = False
 
     def __init__(self, device, *args, **kwargs):
         self.playout = None
@@ -301,10 +487,12 @@ class MediaLayer(NullConv):
             log.msg("write before reopen, discarding")
             return 0
         audio = self.codecker.decode(packet)
+        header = packet.header
         if audio:
-            return self.playout.write(audio, packet.header.seq)
+            return self.playout.write(audio, header.seq, header.ts,
+                                      header.marker)
         else:
-            self.playout.write('', packet.header.seq)
+            self.playout.write(b'', header.seq, header.ts, header.marker)
             return 0
 
     def selectDefaultFormat(self, fmts=[PT_PCMU,]):
@@ -332,6 +520,9 @@ class MediaLayer(NullConv):
                                    "before (re-)opening the device."
 
         self.codecker = Codecker(self.defaultFormat)
+        if self.vad:
+            from shtoom.audio.vad import VAD
+            self.codecker.setVAD(VAD())
         self._d.reopen()
         if mediahandler:
             self.codecker.set_handler(mediahandler)
@@ -342,7 +533,7 @@ class MediaLayer(NullConv):
         if self.playout:
             log.msg("playout already started")
         else:
-            self.playout = playout.Playout(self)
+            self.playout = playout.getPlayout(self, self.playoutPolicy)
 
     def playWaveFile(self, fname):
         from twisted.internet.task import LoopingCall
@@ -391,3 +582,11 @@ class DougConverter(MediaLayer):
         if not kwargs.get('device'):
             kwargs['device'] = None
         NullConv.__init__(self, *args, **kwargs)
+
+    def selectDefaultFormat(self, fmts=[PT_PCMU,]):
+        MediaLayer.selectDefaultFormat(self, fmts)
+        # Encode outbound audio in the format we negotiated
+        self.codecker.format = self.defaultFormat
+
+    def getFormat(self):
+        return self.codecker.getDefaultFormat()
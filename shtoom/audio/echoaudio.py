@@ -30,9 +30,9 @@ class EchoAudioDevice(baseaudio.AudioDevice):
             pass
 
     def openDev(self):
-        from twisted.internet.task import LoopingCall
-        self.LC = LoopingCall(self._push_up_some_data)
-        self.LC.start(0.020)
+        from shtoom.audio.clock import getMediaClock, PRIORITY_DEVICE
+        self.LC = getMediaClock().call(self._push_up_some_data,
+                                       PRIORITY_DEVICE)
         self._data = ''
 
 Device = EchoAudioDevice
@@ -2,7 +2,7 @@
 
 from twisted.python import log
 from shtoom.audio import baseaudio
-from twisted.internet.task import LoopingCall
+from shtoom.audio.clock import getMediaClock, PRIORITY_DEVICE
 
 # XXX TOFIX: use the audio pref to specify infile,outfile and kill two options
 class AudioFromFiles(baseaudio.AudioDevice):
@@ -69,9 +69,8 @@ class AudioFromFiles(baseaudio.AudioDevice):
             return
         if self._infp is None and self._outfp is None:
             self._getFiles()
-        self.LC = LoopingCall(self._push_up_some_data)
-        #print(self, "creating LoopingCall", self.LC, stack())
-        self.LC.start(0.020)
+        self.LC = getMediaClock().call(self._push_up_some_data,
+                                       PRIORITY_DEVICE)
 
 
 Device = AudioFromFiles
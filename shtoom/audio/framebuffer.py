@@ -0,0 +1,80 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+A buffer for audio that comes in in arbitrary sized chunks and goes out
+in frames.
+
+Doing this with a string - buf += data, then buf[:n], buf[n:] for each
+frame - copies everything that's left for every frame taken out, which
+gets very slow when a device hands over a large read. A FrameBuffer
+appends to a bytearray and reads from an offset into it, only throwing
+away the used part of the bytearray once it's big enough to be worth it.
+"""
+
+# Throw away data we've read once there's at least this much of it, and
+# it's more than half of the buffer
+COMPACT_SIZE = 4096
+
+class FrameBuffer:
+
+    def __init__(self, data=b''):
+        self._buf = bytearray(data)
+        self._off = 0
+
+    def __len__(self):
+        return len(self._buf) - self._off
+
+    def write(self, data):
+        "Add data (bytes, or anything else with the buffer interface)"
+        self._buf += data
+
+    def read(self, n=None):
+        """ Take up to n bytes (or everything, if n is None) from the
+            front of the buffer.
+        """
+        off = self._off
+        if n is None or off + n > len(self._buf):
+            end = len(self._buf)
+        else:
+            end = off + n
+        view = memoryview(self._buf)
+        try:
+            data = view[off:end].tobytes()
+        finally:
+            view.release()
+        self._off = end
+        self._compact()
+        return data
+
+    def frames(self, size):
+        "Take as many whole frames of size bytes as there are, as a list"
+        buf, off = self._buf, self._off
+        count = (len(buf) - off) // size
+        if not count:
+            return []
+        # Slice a view rather than the bytearray, so each frame is only
+        # copied once. The view has to go before the bytearray's resized.
+        view = memoryview(buf)
+        try:
+            out = [ view[i:i+size].tobytes()
+                        for i in range(off, off + count * size, size) ]
+        finally:
+            view.release()
+        self._off = off + count * size
+        self._compact()
+        return out
+
+    def clear(self):
+        self._buf = bytearray()
+        self._off = 0
+
+    def _compact(self):
+        off = self._off
+        if off == len(self._buf):
+            self.clear()
+        elif off >= COMPACT_SIZE and off * 2 >= len(self._buf):
+            del self._buf[:off]
+            self._off = 0
+
+    def __repr__(self):
+        return '<FrameBuffer %d bytes>'%(len(self),)
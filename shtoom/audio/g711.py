@@ -0,0 +1,160 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+G.711 (u-law and A-law) without audioop.
+
+audioop is gone from Python 3.13. This does the same conversions with
+lookup tables: 256 entries to decode, and 64K entries (one per 16 bit
+sample value) to encode. The tables are built from the Sun reference
+code that audioop (and most everyone else) uses, so the results are
+bit-exact with it. With numpy, a conversion is a single indexing
+operation - over one frame, or a whole batch of them at once.
+
+PCM is 16 bit signed, host endian, as everywhere else in shtoom.
+"""
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_SIGN_BIT = 0x80
+_QUANT_MASK = 0xf
+_SEG_SHIFT = 4
+_SEG_MASK = 0x70
+_BIAS = 0x84
+_CLIP = 8159
+
+_seg_uend = (0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF)
+_seg_aend = (0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF)
+
+def _search(val, table):
+    for i, end in enumerate(table):
+        if val <= end:
+            return i
+    return len(table)
+
+def _linear2ulaw(sample):
+    "One 16 bit sample to u-law"
+    pcm = sample >> 2
+    if pcm < 0:
+        pcm = -pcm
+        mask = 0x7F
+    else:
+        mask = 0xFF
+    if pcm > _CLIP:
+        pcm = _CLIP
+    pcm += _BIAS >> 2
+    seg = _search(pcm, _seg_uend)
+    if seg >= 8:
+        return 0x7F ^ mask
+    return ((seg << 4) | ((pcm >> (seg + 1)) & 0xF)) ^ mask
+
+def _ulaw2linear(u):
+    u = ~u & 0xff
+    t = ((u & _QUANT_MASK) << 3) + _BIAS
+    t <<= (u & _SEG_MASK) >> _SEG_SHIFT
+    if u & _SIGN_BIT:
+        return _BIAS - t
+    return t - _BIAS
+
+def _linear2alaw(sample):
+    "One 16 bit sample to A-law"
+    pcm = sample >> 3
+    if pcm >= 0:
+        mask = 0xD5
+    else:
+        mask = 0x55
+        pcm = -pcm - 1
+    seg = _search(pcm, _seg_aend)
+    if seg >= 8:
+        return 0x7F ^ mask
+    aval = seg << _SEG_SHIFT
+    if seg < 2:
+        aval |= (pcm >> 1) & _QUANT_MASK
+    else:
+        aval |= (pcm >> seg) & _QUANT_MASK
+    return aval ^ mask
+
+def _alaw2linear(a):
+    a ^= 0x55
+    t = (a & _QUANT_MASK) << 4
+    seg = (a & _SEG_MASK) >> _SEG_SHIFT
+    if seg == 0:
+        t += 8
+    elif seg == 1:
+        t += 0x108
+    else:
+        t += 0x108
+        t <<= seg - 1
+    if a & _SIGN_BIT:
+        return t
+    return -t
+
+
+class _Law:
+    """ Tables for one companding law. The encode table is indexed by a
+        sample's 16 bit pattern (i.e. as unsigned), and only built the
+        first time it's needed.
+    """
+
+    def __init__(self, name, encode, decode):
+        self.name = name
+        self._encodeOne = encode
+        self.decodeTable = array('h', [decode(x) for x in range(256)])
+        self._encodeTable = None
+        if numpy is not None:
+            self.decodeArray = numpy.array(self.decodeTable, numpy.int16)
+
+    def _getEncodeTable(self):
+        if self._encodeTable is None:
+            enc = self._encodeOne
+            # 0..32767, then -32768..-1
+            self._encodeTable = bytes([enc(x) for x in range(32768)] +
+                                      [enc(x) for x in range(-32768, 0)])
+            if numpy is not None:
+                self.encodeArray = numpy.frombuffer(self._encodeTable,
+                                                    numpy.uint8)
+        return self._encodeTable
+    encodeTable = property(_getEncodeTable)
+
+    def encode(self, data):
+        "16 bit PCM (bytes) to G.711 (bytes)"
+        table = self.encodeTable
+        data = data[:len(data) & ~1]
+        if numpy is not None:
+            return self.encodeArray[numpy.frombuffer(data,
+                                                     numpy.uint16)].tobytes()
+        samples = array('H')
+        samples.frombytes(data)
+        return bytes([table[x] for x in samples])
+
+    def decode(self, data):
+        "G.711 (bytes) to 16 bit PCM (bytes)"
+        if numpy is not None:
+            return self.decodeArray[numpy.frombuffer(data,
+                                                     numpy.uint8)].tobytes()
+        table = self.decodeTable
+        return array('h', [table[x] for x in bytes(data)]).tobytes()
+
+    def encodeSamples(self, samples):
+        """ numpy int16 array (any shape, e.g. frames x samples) to a
+            uint8 array of codes
+        """
+        self._getEncodeTable()
+        return self.encodeArray[samples.view(numpy.uint16)]
+
+    def decodeCodes(self, codes):
+        "numpy uint8 array of codes to an int16 array of samples"
+        return self.decodeArray[codes]
+
+
+ulaw = _Law('ulaw', _linear2ulaw, _ulaw2linear)
+alaw = _Law('alaw', _linear2alaw, _alaw2linear)
+
+lin2ulaw = ulaw.encode
+ulaw2lin = ulaw.decode
+lin2alaw = alaw.encode
+alaw2lin = alaw.decode
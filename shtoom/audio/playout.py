@@ -1,13 +1,16 @@
 # from the Python Standard Library
-from bisect import bisect
 import sys
+from array import array
+try:
+    import audioop
+except ImportError:
+    audioop = None
 
 # from the Twisted library
 from twisted.internet import reactor
 from twisted.python import log
 
 # TODO's
-#  * think about persistent clock skew (the RTP book by Perkins has an extensive discussion and sophisticated algorithm for this)
 #  * measure (callLater lag, jitter, clock skew,)
 #  * add more livetests
 #  * minimize playout buffer. The only reason for the large size
@@ -39,6 +42,33 @@ JITTER_BUFFER_SECONDS=0.8
 # in order to catch up
 CATCHUP_TRIGGER_SECONDS=1.4
 
+# number of packet slots in the jitter buffer. Must be a power of two, and
+# comfortably more than CATCHUP_TRIGGER_SECONDS worth of packets.
+RING_SLOTS=512
+
+# bytes per second of audio handed to us (8KHz, 16 bit)
+BPS=16000
+
+# Adaptive playout: the target delay is this many times the estimated
+# interarrival jitter, plus a packet, kept between these limits.
+JITTER_MULTIPLIER=4
+MIN_DELAY_SECONDS=0.04
+MAX_DELAY_SECONDS=JITTER_BUFFER_SECONDS
+# until we know better
+INITIAL_DELAY_SECONDS=0.1
+# RTP timestamp clock rate for the audio we handle
+TS_RATE=8000
+
+# Clock skew: once the sender's clock has drifted this far from ours,
+# drop or repeat a silent frame to bring it back
+SKEW_THRESHOLD_SECONDS=0.02
+# weight of each packet in the running average of transit time
+SKEW_GAIN=1/128.0
+# packets to see before we take the average as our baseline
+SKEW_WARMUP=100
+# frames quieter than this (RMS of 16 bit samples) count as silence
+SILENCE_RMS=200
+
 EPSILON=0.0001
 
 import time
@@ -46,23 +76,83 @@ import time
 DEBUG=False
 #DEBUG=True
 
-def is_run(packets, i, runsecs):
+class SkewEstimator:
     """
-        Returns True iff packets contains a run of sequential packets starting at
-        index i and extending at least runsecs seconds in aggregate length.
+    Estimates how far the sender's clock has drifted from ours, after the
+    fashion of Perkins ("RTP: Audio and Video for the Internet", ch 6).
+
+    The transit time of each packet (arrival time less RTP timestamp) is
+    smoothed with a slow running average, which filters out jitter. Once
+    SKEW_WARMUP packets have been seen the average is taken as the
+    baseline; after that, drift() is how far the average has moved from
+    it. A positive drift means packets are arriving later than their
+    timestamps say they should (the sender is slow, and we'll run dry),
+    negative means they're arriving early (the sender is fast, and the
+    buffer will grow).
     """
-    runbytes = runsecs * 16000
-    firstseq = packets[i][0]
-    runbytessofar = 0
-    i2 = 0
-    while runbytessofar < runbytes:
-        if len(packets) <= i + i2:
-            return False
-        if packets[i + i2][0] != firstseq + i2:
-            return False
-        runbytessofar += len(packets[i + i2][1])
-        i2 += 1
-    return True
+    def __init__(self):
+        self.est = None
+        self.base = None
+        self.count = 0
+        self._ts = None
+        self._extts = 0
+        # corrections made so far
+        self.dropped = 0
+        self.inserted = 0
+
+    def update(self, ts, now):
+        if self._ts is None:
+            self._extts = ts
+        else:
+            self._extts += ((ts - self._ts + 0x80000000) & 0xffffffff) - 0x80000000
+        self._ts = ts
+        transit = now - self._extts / float(TS_RATE)
+        if self.est is None or abs(transit - self.est) > 1.0:
+            # first packet, or the sender's been restarted
+            self.est = self.base = transit
+            self.count = 0
+        else:
+            self.est += (transit - self.est) * SKEW_GAIN
+        self.count += 1
+        if self.count <= SKEW_WARMUP:
+            self.base = self.est
+
+    def drift(self):
+        if self.est is None or self.count <= SKEW_WARMUP:
+            return 0.0
+        return self.est - self.base
+
+    def pending(self):
+        """ Returns 1 if we should insert a frame, -1 if we should drop
+            one, or 0 if all is well.
+        """
+        drift = self.drift()
+        if drift > SKEW_THRESHOLD_SECONDS:
+            return 1
+        elif drift < -SKEW_THRESHOLD_SECONDS:
+            return -1
+        return 0
+
+    def corrected(self, seconds):
+        """ We've played seconds more (inserted) or less (dropped, if
+            negative) audio than the sender sent.
+        """
+        if seconds > 0:
+            self.inserted += 1
+        else:
+            self.dropped += 1
+        self.base += seconds
+
+
+def is_silent(audio):
+    "Is audio (16 bit linear) quiet enough to drop or repeat unnoticed?"
+    if audioop is not None:
+        return audioop.rms(audio, 2) < SILENCE_RMS
+    samples = array('h', audio[:len(audio) & ~1])
+    if not samples:
+        return True
+    return sum([s*s for s in samples]) < SILENCE_RMS**2 * len(samples)
+
 
 class Playout:
     """
@@ -87,45 +177,143 @@ class Playout:
     more packets before it underruns, even when reactor.callLater() sometimes
     gets called 110 milliseconds later than we wanted.  This happens on Mac.
     See TODO item about playout buffer in comments above.
+
+    Clock skew between the sender and us is tracked by a SkewEstimator.
+    When it says we've drifted, the next silent frame to be played out is
+    dropped or played twice. Frames with speech in them are never touched.
+
+    The jitter buffer is a ring of RING_SLOTS slots, indexed by sequence
+    number modulo RING_SLOTS. Sequence numbers are extended past 16 bits,
+    so wraparound is invisible. Each run of consecutive packets keeps its
+    total length in bytes, and the sequence number of its other end, in
+    the slots at both of its ends. Adding a packet joins at most two runs
+    and removing the first packet shortens one, so writes, playouts and
+    the decision to switch to play mode are all O(1). The start of the
+    most recent run to reach the jitter buffer length is kept, and when
+    we leave refill mode that's where playout starts - anything older is
+    discarded.
     """
-    def __init__(self, medialayer):
+    def __init__(self, medialayer, clock=time.time):
         self.medialayer = medialayer
-        self.b = [] # (seqno, bytes,)
+        self.clock = clock
+        # seconds of sequential audio to hoard before leaving refill
+        # mode, and to have waiting before we drop a packet to catch up
+        self.jitterbuffer = JITTER_BUFFER_SECONDS
+        self.catchup = CATCHUP_TRIGGER_SECONDS
+        self._mask = RING_SLOTS - 1
+        # extended sequence number, audio, other end of run, bytes in run
+        self._seq = [None] * RING_SLOTS
+        self._data = [None] * RING_SLOTS
+        self._other = [0] * RING_SLOTS
+        self._runbytes = [0] * RING_SLOTS
+        # highest (extended) sequence number we've seen
+        self._top = None
+        # start of the most recent run to reach JITTER_BUFFER_SECONDS
+        self._readyrun = None
         # the sequence number of the (most recent) packet which has gone to
-        # the output device
+        # the output device. Everything at or before this is stale.
         self.s = 0
         # the time at which the audio output device will have nothing to play
         self.drytime = None
         self.refillmode = True # we start in refill mode
         self.nextcheckscheduled = None
-        self.st = time.time()
+        self.st = self.clock()
         self.stopping = False
+        self.skew = SkewEstimator()
 
     def close(self):
         self.stopping = True
 
-    def _schedule_next_check(self, delta, t=time.time):
+    def _has(self, seq):
+        return seq > self.s and self._seq[seq & self._mask] == seq
+
+    def _extend(self, seq):
+        "Turn a 16 bit RTP sequence number into an extended one"
+        if self._top is None:
+            self._top = seq
+            # leave room behind the first packet for reordering
+            self.s = seq - RING_SLOTS//2
+            return seq
+        top = self._top
+        seq = top + ((seq - top + 32768) & 0xffff) - 32768
+        if seq > top:
+            self._top = seq
+        return seq
+
+    def _add(self, seq, audio):
+        "Put a packet in the buffer, joining it to its neighbours' runs"
+        low = high = seq
+        total = len(audio)
+        other, runbytes = self._other, self._runbytes
+        mask = self._mask
+        if self._has(seq - 1):
+            low = other[(seq - 1) & mask]
+            total += runbytes[(seq - 1) & mask]
+        if self._has(seq + 1):
+            high = other[(seq + 1) & mask]
+            total += runbytes[(seq + 1) & mask]
+        i = seq & mask
+        self._seq[i] = seq
+        self._data[i] = audio
+        other[low & mask] = high
+        other[high & mask] = low
+        runbytes[low & mask] = runbytes[high & mask] = total
+        if total >= self.jitterbuffer * BPS:
+            self._readyrun = low
+
+    def _pop(self):
+        "Take the packet after self.s out of the buffer"
+        seq = self.s + 1
+        mask = self._mask
+        i = seq & mask
+        audio = self._data[i]
+        high = self._other[i]
+        total = self._runbytes[i] - len(audio)
+        self._seq[i] = self._data[i] = None
+        self.s = seq
+        if high > seq:
+            self._other[(seq + 1) & mask] = high
+            self._other[high & mask] = seq + 1
+            self._runbytes[(seq + 1) & mask] = total
+            self._runbytes[high & mask] = total
+        return seq, audio
+
+    def _headrun(self):
+        "Bytes of sequential audio ready to go, starting at self.s + 1"
+        if self._has(self.s + 1):
+            return self._runbytes[(self.s + 1) & self._mask]
+        return 0
+
+    def _flush(self, seq):
+        "Throw away everything before seq"
+        self.s = seq - 1
+        self._readyrun = None
+
+    def _schedule_next_check(self, delta):
         if self.nextcheckscheduled:
             return
         self.nextcheckscheduled = reactor.callLater(delta, self._do_scheduled_check)
         if DEBUG:
+            t = self.clock
             log.msg("scheduling next check. now: %0.3f, then: %0.3f, drytime: %0.3f" %
                     (t() - self.st, self.nextcheckscheduled.getTime() - self.st,
                     self.drytime - self.st,))
 
-    def _do_scheduled_check(self, t=time.time):
+    def _do_scheduled_check(self):
         if self.stopping:
             return
         if DEBUG:
+            t = self.clock
             log.msg("doing scheduled check at %0.3f == %0.3f late" %
                     (t() - self.st, t()-self.nextcheckscheduled.getTime()))
         self.nextcheckscheduled = None
         self._consider_playing_out_sample()
 
-    def _consider_playing_out_sample(self, t=time.time, newsampseqno=None):
-        if not self.b or self.b[0][0] != (self.s + 1):
+    def _consider_playing_out_sample(self, newsampseqno=None):
+        t = self.clock
+        if not self._has(self.s + 1):
             # We don't have a packet ready to play out.
-            if t() >= self.drytime:
+            if self.drytime is None or t() >= self.drytime:
                 self._switch_to_refill_mode()
             return
 
@@ -133,34 +321,46 @@ class Playout:
                                                     (newsampseqno != (self.s + 1))):
             log.msg(("output device ran dry unnecessarily! now: %0.3f, "+
                     "self.drytime: %s, nextseq: %s, newsampseqno: %s") %
-                    (t() - self.st, self.drytime - self.st, self.b[0][0], newsampseqno,))
+                    (t() - self.st, self.drytime - self.st, self.s + 1, newsampseqno,))
 
         # While the output device would run dry within PLAYOUT_BUFFER_SECONDS from
         # now, then play out another sample.
-        while ((t() + PLAYOUT_BUFFER_SECONDS >= self.drytime)
-                            and self.b and self.b[0][0] == (self.s + 1)):
-            (seq, bytes,) = self.b.pop(0)
-            self.medialayer._d.write(bytes)
-            self.s = seq
-            packetlen = len(bytes) / float(16000)
+        while (((self.drytime is None) or
+                            (t() + PLAYOUT_BUFFER_SECONDS >= self.drytime))
+                            and self._has(self.s + 1)):
+            (seq, audio,) = self._pop()
+            packetlen = len(audio) / float(BPS)
+            adjust = self.skew.pending()
+            if adjust and is_silent(audio):
+                if adjust < 0:
+                    self.skew.corrected(-packetlen)
+                    if DEBUG:
+                        log.msg("skew: dropped silent packet %s" % seq)
+                    continue
+                self.skew.corrected(packetlen)
+                if DEBUG:
+                    log.msg("skew: repeated silent packet %s" % seq)
+                self.medialayer._d.write(audio)
+                packetlen *= 2
+            self.medialayer._d.write(audio)
             if self.drytime is None:
                 self.drytime = t() + packetlen
             else:
                 self.drytime = max(self.drytime + packetlen, t() + packetlen)
             if DEBUG:
-                log.msg("xxxxx %0.3f played %s, playbuflen ~= %0.3f, jitterbuf: %d:%s"
+                log.msg("xxxxx %0.3f played %s, playbuflen ~= %0.3f, ready: %d"
                         % (t() - self.st, seq, self.drytime and
-                        (self.drytime - t()) or 0, len(self.b),
-                        [x[0] for x in self.b],))
+                        (self.drytime - t()) or 0, self._headrun(),))
 
         # If we filled the playout buffer then come back and consider refilling it
         # after it has an open slot big enough to hold the next packet.  (If we
         # didn't just fill it then when the next packet comes in from the network
         # self.write() will invoke self._consider_playing_out_sample().)
-        if self.b and self.b[0][0] == (self.s + 1):
+        if self._has(self.s + 1):
             # Come back and consider playing out again after we've played out an
             # amount of audio equal to the next packet.
-            self._schedule_next_check(len(self.b[0][1]) / float(16000) + EPSILON)
+            nextlen = len(self._data[(self.s + 1) & self._mask])
+            self._schedule_next_check(nextlen / float(BPS) + EPSILON)
 
 
     def _switch_to_refill_mode(self):
@@ -170,46 +370,174 @@ class Playout:
     def _consider_switching_to_play_mode(self):
         # If we have enough sequential packets ready, then we'll make them be the
         # current packets and switch to play mode.
-        for i in range(len(self.b) - 1):
-            if is_run(self.b, i, JITTER_BUFFER_SECONDS):
-                self.b = self.b[i:]
-                self.s = self.b[0][0] - 1 # prime it for the next packet
-                self.refillmode = False
-                self._consider_playing_out_sample()
-                return
-
-    def write(self, bytes, seq, t=time.time):
-        assert isinstance(bytes, basestring)
-
-        if not bytes:
+        low = self._readyrun
+        if low is None:
+            return
+        self._readyrun = None
+        if (not self._has(low) or self._has(low - 1) or
+                self._runbytes[low & self._mask] < self.jitterbuffer * BPS):
+            # That run's been played, or had a packet added in front of it
+            # (which would have made a new ready run).
+            return
+        # Everything before the run is discarded
+        self.s = low - 1 # prime it for the next packet
+        self.refillmode = False
+        self._consider_playing_out_sample()
+
+    def _arrived(self, seq, ts, marker):
+        "Packet seq is about to go in the buffer"
+        if ts is not None:
+            self.skew.update(ts, self.clock())
+
+    def write(self, audio, seq, ts=None, marker=0):
+        assert isinstance(audio, bytes)
+
+        if not audio:
             return 0
 
-        i = bisect(self.b, (seq, bytes,))
-        if i > 0 and self.b[i-1][0] == seq:
+        seq = self._extend(seq)
+        if seq <= self.s:
+            log.msg("xxx late packet %s" % seq)
+            return
+        if seq - self.s > RING_SLOTS:
+            # Too far ahead of what we've got - the sender skipped, or we
+            # lost a *lot*. Start again from this packet.
+            log.msg("xxx jitter buffer overflow at %s" % seq)
+            self._flush(seq)
+            self.refillmode = True
+        elif self._has(seq):
             log.msg("xxx duplicate packet %s" % seq)
             return
 
-        self.b.insert(i, (seq, bytes,))
+        self._arrived(seq, ts, marker)
+        self._add(seq, audio)
 
         if DEBUG:
-            log.msg("xxxxx %0.3f added  %s, playbuflen ~= %0.3f, jitterbuf: %d:%s"
+            t = self.clock
+            log.msg("xxxxx %0.3f added  %s, playbuflen ~= %0.3f, ready: %d"
                 % (t() - self.st, seq, self.drytime and (self.drytime - t()) or 0,
-                len(self.b), [x[0] for x in self.b],))
+                self._headrun(),))
         if self.refillmode:
             self._consider_switching_to_play_mode()
         else:
             self._consider_playing_out_sample(newsampseqno=seq)
-            if (self.b and (self.b[0][0] == self.s + 1) and
-                        is_run(self.b, 0, CATCHUP_TRIGGER_SECONDS)):
-                (seq, bytes,) = self.b.pop(0) # catch up
+            if self._headrun() >= self.catchup * BPS:
+                (seq, audio,) = self._pop() # catch up
                 log.msg("xxxxxxx catchup! dropping %s" % seq)
-                self.s = self.b[0][0] - 1 # prime it for the next packet
+
+class AdaptivePlayout(Playout):
+    """
+    A Playout whose jitter buffer is sized from the network, rather than
+    fixed at JITTER_BUFFER_SECONDS.
+
+    Interarrival jitter is estimated as in RFC 3550 (section 6.4.1), from
+    the RTP timestamps and arrival times of the packets. The target delay
+    is JITTER_MULTIPLIER times that, plus a packet's worth, clamped to
+    MIN_DELAY_SECONDS..MAX_DELAY_SECONDS.
+
+    The delay is only changed when it won't be heard: at the start of a
+    talkspurt (an RTP packet with the marker bit set, after we've played
+    everything from the last one), or after an underrun. The first packet
+    of a talkspurt is held for the target delay and then played, however
+    little of the talkspurt has arrived by then.
+    """
+    def __init__(self, medialayer, clock=time.time):
+        Playout.__init__(self, medialayer, clock)
+        # estimated interarrival jitter, in seconds
+        self.jitter = 0.0
+        self.target = INITIAL_DELAY_SECONDS
+        self._lastts = None
+        self._lastarrival = None
+        self._packetlen = 0.02
+        self._spurtcall = None
+        self._setThresholds()
+
+    def close(self):
+        Playout.close(self)
+        if self._spurtcall is not None:
+            self._spurtcall.cancel()
+            self._spurtcall = None
+
+    def _estimate(self, ts):
+        """ Update the jitter estimate. D is the difference between the
+            arrival spacing and the timestamp spacing of two packets.
+        """
+        now = self.clock()
+        if self._lastts is not None:
+            tsdelta = ((ts - self._lastts + 0x80000000) & 0xffffffff) - 0x80000000
+            d = abs((now - self._lastarrival) - tsdelta / float(TS_RATE))
+            # A jump of more than a second isn't jitter, it's a new stream
+            # or a sender that's stopped and started again.
+            if d < 1.0:
+                self.jitter += (d - self.jitter) / 16.0
+        self._lastts = ts
+        self._lastarrival = now
+
+    def _setThresholds(self):
+        self.jitterbuffer = self.target
+        self.catchup = self.target + max(self.target, 0.1)
+
+    def _adapt(self):
+        target = self._packetlen + JITTER_MULTIPLIER * self.jitter
+        target = min(MAX_DELAY_SECONDS, max(MIN_DELAY_SECONDS, target))
+        if DEBUG and abs(target - self.target) > 0.001:
+            log.msg("playout delay %0.3f -> %0.3f (jitter %0.4f)" % (
+                                            self.target, target, self.jitter))
+        self.target = target
+        self._setThresholds()
+        # With a smaller target, the newest run might already be enough
+        top = self._top
+        if top is not None and self._has(top):
+            if self._runbytes[top & self._mask] >= self.jitterbuffer * BPS:
+                self._readyrun = self._other[top & self._mask]
+
+    def _arrived(self, seq, ts, marker):
+        Playout._arrived(self, seq, ts, marker)
+        if ts is not None:
+            self._estimate(ts)
+        if marker and not self._has(self.s + 1):
+            # Start of a talkspurt, and the last one has all gone to the
+            # output device. Now's the time to change the delay.
+            self._adapt()
+            self.refillmode = True
+            if self._spurtcall is not None:
+                self._spurtcall.cancel()
+            self._spurtcall = reactor.callLater(self.target,
+                                                self._startTalkspurt, seq)
+
+    def _startTalkspurt(self, seq):
+        self._spurtcall = None
+        if self.stopping or not self.refillmode:
+            return
+        if self._has(seq) and not self._has(seq - 1):
+            self.s = seq - 1
+            self.refillmode = False
+            self._consider_playing_out_sample()
+
+    def _switch_to_refill_mode(self):
+        # Ran dry - the delay's probably too short
+        self._adapt()
+        Playout._switch_to_refill_mode(self)
+
+    def write(self, audio, seq, ts=None, marker=0):
+        if audio:
+            self._packetlen = len(audio) / float(BPS)
+        return Playout.write(self, audio, seq, ts, marker)
 
 class NullPlayout:
     def __init__(self, medialayer):
         self.medialayer = medialayer
 
-    def write(self, bytes, seq, t=time.time):
-        self.medialayer._d.write(bytes)
+    def write(self, audio, seq, ts=None, marker=0):
+        self.medialayer._d.write(audio)
 
 #Playout=NullPlayout
+
+policies = { 'fixed': Playout,
+             'adaptive': AdaptivePlayout,
+             'null': NullPlayout,
+           }
+
+def getPlayout(medialayer, policy=None):
+    "Returns a new playout object for medialayer, using the named policy"
+    return policies[policy or 'fixed'](medialayer)
@@ -4,6 +4,7 @@ from . import baseaudio
 import traceback
 from twisted.python import log
 from twisted.internet.protocol import Protocol, Factory
+from shtoom.audio.framebuffer import FrameBuffer
 
 SHTOOM_PORT = 22000
 
@@ -13,26 +14,23 @@ class TCPAudioProtocol(Protocol):
     def connectionMade(self):
         log.msg("TCPAudioProtocol.connectionMade")
         self.factory.device.connection = self
-        self.readbuffer = ''
+        self.readbuffer = FrameBuffer()
 
     def dataReceived(self, data):
         if self.readbuffer is not None:
-            self.readbuffer += data
+            self.readbuffer.write(data)
 
     def write(self, data):
         self.transport.write(data)
 
     def open(self):
-        self.readbuffer = ''
+        self.readbuffer = FrameBuffer()
 
     def _close(self):
         self.readbuffer = None
 
     def read(self, bytes=None):
-        if bytes is None:
-            bytes = len(self.readbuffer)
-        rval, self.readbuffer = self.readbuffer[:bytes], self.readbuffer[bytes:]
-        return rval
+        return self.readbuffer.read(bytes)
 
 
 class TCPAudioFactory(Factory):
@@ -0,0 +1,142 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+Voice activity detection.
+
+Most of the time, at least one end of a call is listening rather than
+talking. A VAD looks at each 20ms frame before it's encoded, and decides
+whether it's speech. While it's not, the Codecker doesn't encode or send
+the frames - instead it sends an occasional RFC 3389 comfort noise (CN)
+packet, telling the other end how loud the background noise is, so it
+can play something similar rather than dead air.
+
+The decision is made on the frame's energy, compared with the noise
+floor, and its zero crossing rate, which lets quieter unvoiced sounds
+('s', 'f') count as speech too. The floor drops straight down to any
+quieter frame, follows background noise up over a second or so, but
+only creeps up while there's speech - otherwise hold music, or a long
+tone, would become the "noise" and be cut off. Once speech stops, the VAD waits a few frames before
+calling it silence, so word endings and short gaps aren't clipped.
+"""
+
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Frames of non-speech after speech before it's called silence - 200ms
+HANGOVER = 10
+# dB a frame the noise floor can rise by, towards a louder frame that
+# isn't speech, and one that is (0.5dB a second)
+NOISE_RISE_DB = 0.5
+SPEECH_RISE_DB = 0.01
+# A frame this many dB over the noise floor is speech
+SPEECH_DB = 9.0
+# As is one this many dB over, that crosses zero this often (per sample)
+UNVOICED_DB = 4.0
+UNVOICED_ZCR = 0.3
+# Frames quieter than this (dBov) are never speech
+MIN_DB = -55.0
+# Quieter than we'll ever see from 16 bit audio
+SILENCE_DB = -127.0
+# During silence, send a new CN packet if the noise level moves this
+# many dB from the one we last sent
+CN_LEVEL_CHANGE = 3
+
+# 0 dBov - a full scale square wave, for 16 bit samples
+_FULL_SCALE = 32768.0 * 32768.0
+
+def frameLevel(frame):
+    """ Return the level (in dBov) and zero crossing rate (crossings per
+        sample) of a frame of 16 bit PCM.
+    """
+    if numpy is not None:
+        samples = numpy.frombuffer(frame, numpy.int16)
+        n = len(samples)
+        if not n:
+            return SILENCE_DB, 0.0
+        f = samples.astype(numpy.float64)
+        power = float(numpy.dot(f, f)) / n
+        neg = samples < 0
+        crossings = int(numpy.count_nonzero(neg[1:] != neg[:-1]))
+    else:
+        samples = array('h', bytes(frame[:len(frame) & ~1]))
+        n = len(samples)
+        if not n:
+            return SILENCE_DB, 0.0
+        power = float(sum([s*s for s in samples])) / n
+        crossings = 0
+        neg = samples[0] < 0
+        for s in samples:
+            if (s < 0) != neg:
+                crossings += 1
+                neg = not neg
+    if power <= 0:
+        return SILENCE_DB, crossings / float(n)
+    return (max(SILENCE_DB, 10 * math.log10(power / _FULL_SCALE)),
+            crossings / float(n))
+
+
+class VAD:
+    """ Decides, one frame of 16 bit PCM at a time, whether there's
+        speech.
+
+        level is the last frame's level, and floor the noise floor, both
+        in dBov.
+    """
+
+    def __init__(self, hangover=HANGOVER):
+        self.hangover = hangover
+        self.level = SILENCE_DB
+        self.floor = SILENCE_DB
+        self.speech = False
+        self._quiet = 0
+        # statistics
+        self.frames = 0
+        self.speechFrames = 0
+
+    def process(self, frame):
+        "Returns True if frame is (or is in the hangover after) speech"
+        level, zcr = frameLevel(frame)
+        self.level = level
+        if not self.frames:
+            self.floor = level
+        floor = self.floor
+        if level < MIN_DB:
+            active = False
+        elif level > floor + SPEECH_DB:
+            active = True
+        else:
+            active = zcr > UNVOICED_ZCR and level > floor + UNVOICED_DB
+        if level <= floor:
+            self.floor = level
+        elif active:
+            self.floor = floor + min(level - floor, SPEECH_RISE_DB)
+        else:
+            self.floor = floor + min(level - floor, NOISE_RISE_DB)
+        if active:
+            self._quiet = 0
+            self.speech = True
+        elif self.speech:
+            self._quiet += 1
+            if self._quiet > self.hangover:
+                self.speech = False
+        self.frames += 1
+        if self.speech:
+            self.speechFrames += 1
+        return self.speech
+
+    def noiseLevel(self):
+        "The noise floor, as an RFC 3389 noise level (-dBov, 0 to 127)"
+        return min(127, max(0, int(round(-self.floor))))
+
+    def reset(self):
+        self.__init__(self.hangover)
+
+
+def cnPayload(noiseLevel):
+    "An RFC 3389 comfort noise payload, with no spectral information"
+    return bytes([noiseLevel])
@@ -18,19 +18,10 @@ except ImportError:
     speex = None
     _removeImport('speex')
 
-try:
-    from audioop import ulaw2lin, lin2ulaw
-    mulaw = ulaw2lin
-    del ulaw2lin, lin2ulaw
-except ImportError:
-    mulaw = None
-
-try:
-    # _obviously_ broken :-)
-    from audioop import alaw2lin, lin2alaw
-    alaw = alaw2lin
-except ImportError:
-    alaw = None
+# G.711 is done with lookup tables (shtoom.audio.g711) rather than
+# audioop, so it's always there.
+mulaw = True
+alaw = True
 
 dvi4 = None # always, until it's implemented
 ilbc = None # always, until it's implemented
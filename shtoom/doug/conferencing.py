@@ -1,13 +1,21 @@
 "Conferencing code"
 
-# XXX A relatively simple enhancement to this would be to store the 
-# volumes for each source in the conference, and use an exponential
-# decay type algorithm to determine the "loudest". 
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+    try:
+        import audioop
+    except ImportError:
+        audioop = None
 
 from shtoom.doug.source import Source
-from twisted.internet.task import LoopingCall
+from shtoom.doug.mixer import Mixer
+from shtoom.audio.clock import getMediaClock, PRIORITY_ROOM
 from twisted.python import log
-from sets import Set
 
 class ConferenceError(Exception): pass
 class ConferenceClosedError(ConferenceError): pass
@@ -62,6 +70,14 @@ class ConfSource(Source):
             self._quiet = False
         return ret
 
+    def readEncoded(self, fmt):
+        # If we're just listening, the room may have already encoded
+        # what we're going to hear.
+        try:
+            return self._room.readEncoded(self, fmt)
+        except ConferenceClosedError:
+            return None
+
     def close(self):
         self._room.removeMember(self)
 
@@ -83,29 +99,145 @@ class ConfSource(Source):
                             self._room.getName(), id(self))
 
 
+def rms(audio):
+    "The RMS level of a frame of 16 bit linear audio"
+    n = len(audio) // 2
+    if not n:
+        return 0
+    if numpy is not None:
+        samples = numpy.frombuffer(audio, numpy.int16, n).astype(numpy.float64)
+        return int(math.sqrt(numpy.dot(samples, samples) / n))
+    if audioop is not None:
+        return audioop.rms(audio, 2)
+    samples = array('h', audio[:n * 2])
+    return int(math.sqrt(sum([s*s for s in samples]) / float(n)))
+
+
+class SpeakerTracker:
+    """ Keeps track of who's talking in a room.
+
+        Each member has a smoothed energy level: it rises quickly when
+        they get louder (ATTACK) and falls away slowly when they stop
+        (DECAY), so a speaker doesn't drop out between words. While
+        there are free speaker slots, anyone above GATE_LEVEL gets one,
+        loudest first. Once they're full, a member has to be above
+        ON_LEVEL to displace the quietest speaker, and then only if that
+        speaker has fallen below OFF_LEVEL or the newcomer is
+        SWITCH_RATIO times louder, so the speaker set doesn't flap.
+
+        Members whose energy has fallen below GATE_LEVEL are gated out:
+        their audio is only measured every PROBE_TICKS ticks, so a big
+        room of listeners costs next to nothing.
+
+        newTick() must be called at the start of every tick, before
+        update().
+    """
+
+    ATTACK = 0.66
+    DECAY = 0.9
+    ON_LEVEL = 400
+    OFF_LEVEL = 200
+    GATE_LEVEL = 50
+    SWITCH_RATIO = 2.0
+    PROBE_TICKS = 5
+
+    def __init__(self):
+        # member -> energy
+        self.energy = {}
+        # gated out members -> tick to probe them on
+        self.gated = {}
+        self.speakers = []
+        self.tick = 0
+        # number of RMS calculations, for the curious
+        self.measured = 0
+
+    def remove(self, member):
+        self.energy.pop(member, None)
+        self.gated.pop(member, None)
+        if member in self.speakers:
+            self.speakers.remove(member)
+
+    def newTick(self):
+        self.tick += 1
+
+    def update(self, member, audio):
+        "Called each tick for each member, with their audio (or None)"
+        energy = self.energy.get(member, 0.0)
+        probe = self.gated.get(member)
+        if not audio or (probe is not None and probe != self.tick):
+            level = 0
+        else:
+            level = rms(audio)
+            self.measured += 1
+        if level > energy:
+            energy += (level - energy) * self.ATTACK
+        else:
+            energy += (level - energy) * (1 - self.DECAY)
+        self.energy[member] = energy
+        if energy < self.GATE_LEVEL:
+            if probe is None or probe == self.tick:
+                self.gated[member] = (self.tick + self.PROBE_TICKS)
+        elif probe is not None:
+            del self.gated[member]
+
+    def select(self, audioIn, maxSpeakers):
+        """ Called once a tick, after update(). Returns the speakers who
+            have sent audio this tick, loudest first.
+        """
+        energy, gated = self.energy, self.gated
+        speakers = [ m for m in self.speakers
+                            if m not in gated
+                               and energy.get(m, 0) >= self.GATE_LEVEL ]
+        candidates = [ m for m in audioIn
+                            if m not in speakers and m not in gated
+                               and energy[m] >= self.GATE_LEVEL ]
+        candidates.sort(key=energy.get, reverse=True)
+        for m in candidates:
+            if len(speakers) < maxSpeakers:
+                speakers.append(m)
+                continue
+            quietest = min(speakers, key=energy.get)
+            if energy[m] >= self.ON_LEVEL and (
+                    energy[quietest] < self.OFF_LEVEL or
+                    energy[m] > energy[quietest] * self.SWITCH_RATIO):
+                speakers[speakers.index(quietest)] = m
+            else:
+                # the rest are quieter still
+                break
+        speakers.sort(key=energy.get, reverse=True)
+        self.speakers = speakers
+        return [ m for m in speakers if m in audioIn ]
+
+
 class Room:
     """A room is a conference. Everyone in the room hears everyone else
        (well, kinda)
     """
 
     # Theory of operation. Rather than rely on the individual sources
-    # timer loops (which would be, well, horrid), we trigger off our
-    # own timer.
+    # timer loops (which would be, well, horrid), we trigger off the
+    # media clock, which calls us before it calls any of the legs.
     # This means we don't have to worry about the end systems not
     # contributing during a window.
     _open = False
 
     def __init__(self, name, MaxSpeakers=4):
         self._name = name
-        self._members = Set()
+        self._members = set()
         self._audioOut = {}
-        self._audioOutDefault = ''
+        self._audioOutDefault = b''
+        # format -> MediaSamples of _audioOutDefault, this tick
+        self._encodedDefault = {}
+        # format -> Codecker, for encoding _audioOutDefault
+        self._encoders = {}
         self._maxSpeakers = MaxSpeakers
+        self._mixer = Mixer()
+        self._tracker = SpeakerTracker()
         self.start()
 
     def start(self):
-        self._audioCalcLoop = LoopingCall(self.mixAudio)
-        self._audioCalcLoop.start(0.020)
+        self._audioCalcLoop = getMediaClock().call(self.mixAudio,
+                                                   PRIORITY_ROOM)
         self._open = True
 
     def getName(self):
@@ -125,7 +257,7 @@ class Room:
         else:
             self._audioCalcLoop.stop()
         # XXX close down any running sources!
-        self._members = Set()
+        self._members = set()
         del self._audioOut
         self._open = False
         removeRoom(self._name)
@@ -140,6 +272,7 @@ class Room:
     def removeMember(self, confsource):
         if len(self._members) and confsource in self._members:
             self._members.remove(confsource)
+            self._tracker.remove(confsource)
             if CONFDEBUG:
                 print("removed", confsource, "from", self)
         else:
@@ -164,20 +297,44 @@ class Room:
         else:
             raise ConferenceClosedError()
 
+    def readEncoded(self, confsource, fmt):
+        """ Returns the default audio, encoded in fmt, for a member who
+            isn't a speaker. Every listener using the same format shares
+            the one encoding. Returns None for speakers, who each have
+            their own mix.
+        """
+        if not self._open:
+            raise ConferenceClosedError()
+        if confsource in self._audioOut:
+            return None
+        samples = self._encodedDefault.get(fmt)
+        if samples is None:
+            samples = self._encodedDefault[fmt] = self._encode(fmt)
+        return samples
+
+    def _encode(self, fmt):
+        from shtoom.audio.converters import Codecker
+        enc = self._encoders.get(fmt)
+        if enc is None:
+            enc = self._encoders[fmt] = Codecker(fmt)
+        samples = []
+        enc.set_handler(samples.append)
+        enc.handle_audio(self._audioOutDefault)
+        return samples
+
     def mixAudio(self):
-        # XXX see the comment above about storing a decaying number for the
-        # volume. For instance, each time round the loop, take the calculated
-        # volume, and the stored volume, and do something like:
-        # newStoredVolume = (oldStoredVolume * 0.33) + (thisPacketVolume * 0.66)
-        import audioop
         self._audioOut = {}
+        self._encodedDefault = {}
         if not self._open:
             log.msg('mixing closed room %r'%(self,), system='doug')
             return
         audioIn = {}
+        tracker = self._tracker
+        tracker.newTick()
         for m in self._members:
             bytes = m.getAudioForRoom()
             if bytes: audioIn[m] = bytes
+            tracker.update(m, bytes)
         if CONFDEBUG:
             print("room %r has %d members"%(self, len(self._members)))
             print("got %d samples this time"%len(audioIn))
@@ -186,61 +343,19 @@ class Room:
         if len(self._members) < 2:
             if CONFDEBUG:
                 print("less than 2 members, no sound")
-            self._audioOutDefault = ''
+            self._audioOutDefault = b''
             return
-        # Samples is (confsource, audio)
-        samples = audioIn.items()
-        # power is three-tuples of (rms,audio,confsource)
-        power = [ (audioop.rms(x[1],2),x[1], x[0]) for x in samples ]
-        power.sort(); power.reverse()
+        # The (up to) _maxSpeakers current speakers are mixed. Everyone
+        # who's not a speaker gets the 'default' audio, the mix of all of
+        # them; each speaker gets the mix of all the others.
+        speakers = tracker.select(audioIn, self._maxSpeakers)
         if CONFDEBUG:
-            for rms,audio,confsource in power:
-                print(confsource, rms)
-        # Speakers is a list of the _maxSpeakers loudest speakers
-        speakers = Set([x[2] for x in power[:self._maxSpeakers]])
-        # First we calculate the 'default' audio. Used for everyone who's
-        # not a speaker in the room.
-        samples = [ x[1] for x in power[:self._maxSpeakers] ]
-        scaledsamples = [ audioop.mul(x, 2, 1.0/len(samples)) for x in samples ]
-        if scaledsamples:
-            # ooo. a use of reduce. first time for everything...
-            try:
-                combined = reduce(lambda x,y: audioop.add(x, y, 2), scaledsamples)
-            except audioop.error as exc:
-                # XXX tofix!
-                print("combine got error %s"%(exc,))
-                print("lengths", [len(x) for x in scaledsamples])
-                combined = ''
-        else:
-            combined = ''
-        self._audioOutDefault = combined
-        # Now calculate output for each speaker.
-        allsamples = {}
-        for p,sample,speaker in power:
-            allsamples[speaker] = p, sample
-        for s in speakers:
-            # For each speaker, take the set of (other speakers), grab
-            # the top N speakers, and combine them. Add to the _audioOut
-            # dictionary
-            all = allsamples.copy()
-            del all[s]
-            power = all.values()
-            power.sort() ; power.reverse()
-            samples = [ x[1] for x in power[:self._maxSpeakers] ]
-            if samples:
-                scaled = [ audioop.mul(x, 2, 1.0/len(samples)) for x in samples]
-                try:
-                    out = reduce(lambda x,y: audioop.add(x, y, 2), scaled)
-                except audioop.error as exc:
-                    # XXX tofix!
-                    print("combine got error %s"%(exc,))
-                    print("lengths", [len(x) for x in scaled])
-                    out = ''
-            else:
-                out = ''
-            if CONFDEBUG:
-                print("calc for", s, "is", audioop.rms(out, 2))
-            self._audioOut[s] = out
+            for m in speakers:
+                print(m, tracker.energy[m])
+        default, outs = self._mixer.mix([ audioIn[m] for m in speakers ])
+        self._audioOutDefault = default
+        for speaker, out in zip(speakers, outs):
+            self._audioOut[speaker] = out
 
 _RegisterOfAllRooms = {}
 
@@ -251,9 +366,31 @@ def removeRoom(roomname):
     if roomname in _RegisterOfAllRooms and roomname not in _StickyRoomNames:
         del _RegisterOfAllRooms[roomname]
 
+# If not None, a shtoom.doug.confshard.ConferenceShards, and rooms live
+# in its worker processes rather than in _RegisterOfAllRooms.
+_shards = None
+
+def startSharding(workers=None):
+    """ Mix conference rooms created from now on in a pool of worker
+        processes (one per CPU, by default).
+    """
+    from shtoom.doug.confshard import ConferenceShards
+    global _shards
+    if _shards is None:
+        _shards = ConferenceShards(workers)
+    return _shards
+
+def stopSharding():
+    global _shards
+    if _shards is not None:
+        _shards.stop()
+        _shards = None
+
 def newConferenceMember(roomname, leg):
     global _RegisterOfAllRooms
 
+    if _shards is not None:
+        return _shards.newMember(roomname, leg)
     if not roomname in _RegisterOfAllRooms:
         _RegisterOfAllRooms[roomname] = Room(roomname)
     room = _RegisterOfAllRooms[roomname]
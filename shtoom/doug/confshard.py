@@ -0,0 +1,444 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+Conference rooms in worker processes.
+
+Normally every conference room is mixed in the main process, sharing
+one CPU with the SIP and RTP handling. With sharding turned on (see
+startSharding(), or the conference_workers preference in Doug), rooms
+are hashed onto a pool of worker processes instead. Each member gets a
+pair of shared-memory FrameRings: the leg's decoded audio goes in one,
+and the worker's mix for that member comes back in the other. Control
+messages (members joining and leaving) go over a pipe.
+
+newConferenceMember() works the same either way - with sharding on it
+hands back a RemoteConfSource rather than a ConfSource.
+"""
+
+import os, struct, time, zlib
+
+from twisted.python import log
+
+from shtoom.doug.source import Source
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# head (frames written) and tail (frames read) counters, on their own
+# cache lines
+_counter = struct.Struct('=Q')
+_HEAD, _TAIL = 0, 64
+_HEADER = 128
+_length = struct.Struct('=H')
+
+RING_SLOTS = 8
+SLOT_BYTES = 1024
+
+TICK = 0.020
+# How often (seconds) the main process checks its workers are still alive
+CHECK_INTERVAL = 1.0
+
+class FrameRing:
+    """ A single-producer, single-consumer ring of audio frames in shared
+        memory. The producer only ever writes the head counter and the
+        consumer only the tail, so no locking is needed.
+
+        put() returns False (and counts a drop) if the ring is full;
+        get() returns None if it's empty.
+    """
+
+    def __init__(self, name=None, slots=RING_SLOTS, slotBytes=SLOT_BYTES,
+                 create=True):
+        self.slots = slots
+        self.slotBytes = slotBytes
+        size = _HEADER + slots * (_length.size + slotBytes)
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                                  size=size)
+            self.shm.buf[:_HEADER] = b'\0' * _HEADER
+        else:
+            self.shm = _attach(name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.owner = create
+        self.dropped = 0
+
+    def _slot(self, n):
+        return _HEADER + (n % self.slots) * (_length.size + self.slotBytes)
+
+    def put(self, frame):
+        if len(frame) > self.slotBytes:
+            raise ValueError("frame of %d bytes won't fit in a %d byte slot"%(
+                                                len(frame), self.slotBytes))
+        buf = self.buf
+        head = _counter.unpack_from(buf, _HEAD)[0]
+        tail = _counter.unpack_from(buf, _TAIL)[0]
+        if head - tail >= self.slots:
+            self.dropped += 1
+            return False
+        off = self._slot(head)
+        _length.pack_into(buf, off, len(frame))
+        off += _length.size
+        buf[off:off+len(frame)] = frame
+        _counter.pack_into(buf, _HEAD, head + 1)
+        return True
+
+    def get(self):
+        buf = self.buf
+        head = _counter.unpack_from(buf, _HEAD)[0]
+        tail = _counter.unpack_from(buf, _TAIL)[0]
+        if head == tail:
+            return None
+        off = self._slot(tail)
+        n = _length.unpack_from(buf, off)[0]
+        off += _length.size
+        frame = bytes(buf[off:off+n])
+        _counter.pack_into(buf, _TAIL, tail + 1)
+        return frame
+
+    def __len__(self):
+        buf = self.buf
+        return (_counter.unpack_from(buf, _HEAD)[0] -
+                _counter.unpack_from(buf, _TAIL)[0])
+
+    def close(self):
+        if self.buf is None:
+            return
+        self.buf.release()
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def _attach(name):
+    """ Map an existing segment. The process that created it unlinks it,
+        so it's the one the resource tracker should hold it against.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always registers it. The worker shares the
+        # parent's tracker, which only keeps one registration per name,
+        # so that's harmless - unregistering here would drop the
+        # parent's.
+        return shared_memory.SharedMemory(name=name)
+
+
+class _RingMember:
+    "A room member, as seen from inside the worker"
+
+    def __init__(self, memberid, inring, outring):
+        self.memberid = memberid
+        self.inring = inring
+        self.outring = outring
+
+    def getAudioForRoom(self):
+        # Like ConfSource, keep no more than a few frames of backlog
+        while len(self.inring) > 3:
+            self.inring.get()
+        return self.inring.get()
+
+    def close(self):
+        self.inring.close()
+        self.outring.close()
+
+
+class ShardWorker:
+    """ The rooms belonging to one worker process. handle() takes control
+        messages from the parent; tick() mixes every room once.
+    """
+
+    def __init__(self):
+        from shtoom.doug.conferencing import Room
+        class _ShardRoom(Room):
+            # Driven by tick(), not the media clock
+            def start(self):
+                self._open = True
+            def shutdown(self):
+                self._open = False
+        self._roomClass = _ShardRoom
+        self.rooms = {}
+        self.members = {}
+        # roomname -> number of ticks it's failed to mix
+        self.failures = {}
+
+    def handle(self, msg):
+        op = msg[0]
+        if op == 'add':
+            memberid, roomname, inname, outname, slots, slotBytes = msg[1:]
+            inring = FrameRing(inname, slots, slotBytes, create=False)
+            try:
+                outring = FrameRing(outname, slots, slotBytes, create=False)
+            except:
+                inring.close()
+                raise
+            member = _RingMember(memberid, inring, outring)
+            room = self.rooms.get(roomname)
+            if room is None:
+                room = self.rooms[roomname] = self._roomClass(roomname)
+            room.addMember(member)
+            self.members[memberid] = (member, room)
+        elif op == 'remove':
+            member, room = self.members.pop(msg[1], (None, None))
+            if member is not None:
+                room.removeMember(member)
+                member.close()
+                if not room.memberCount():
+                    del self.rooms[room.getName()]
+                    self.failures.pop(room.getName(), None)
+        else:
+            raise ValueError("unknown message %r"%(msg,))
+
+    def tick(self):
+        for name, room in list(self.rooms.items()):
+            try:
+                room.mixAudio()
+                for member in room._members:
+                    out = room.readAudio(member)
+                    if out:
+                        member.outring.put(out)
+            except Exception:
+                # Don't let one room stop the others. Only log the first
+                # failure, or a broken room would log 50 times a second.
+                count = self.failures.get(name, 0) + 1
+                self.failures[name] = count
+                if count == 1:
+                    log.err(None, "mixing room %s failed"%(name,))
+
+    def close(self):
+        for member, room in self.members.values():
+            member.close()
+        self.members = {}
+        self.rooms = {}
+
+
+def _workerMain(conn):
+    "Main loop of a worker process"
+    import sys
+    log.startLogging(sys.stderr, setStdout=False)
+    worker = ShardWorker()
+    next = time.time() + TICK
+    try:
+        while True:
+            timeout = next - time.time()
+            while conn.poll(max(0, timeout)):
+                msg = conn.recv()
+                if msg[0] == 'stop':
+                    return
+                try:
+                    worker.handle(msg)
+                except Exception:
+                    log.err(None, "conference worker %d: %r failed"%(
+                                                    os.getpid(), msg))
+                if msg[0] == 'remove':
+                    # The parent can unlink the member's rings now
+                    conn.send(('removed', msg[1]))
+                timeout = next - time.time()
+            now = time.time()
+            if now - next > 5 * TICK:
+                # Way behind - don't try to catch up
+                next = now
+            worker.tick()
+            next += TICK
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        worker.close()
+
+
+class RemoteConfSource(Source):
+    """ The main process's end of a conference member whose room lives in
+        a worker process. Looks like a ConfSource to the leg.
+    """
+
+    def __init__(self, shards, roomname, leg):
+        self._user = leg.getDialog().getRemoteTag().getURI()
+        self._roomname = roomname
+        self._shards = shards
+        self._worker = shards.workerFor(roomname)
+        self.memberid = shards._nextMemberId()
+        self._toRoom = FrameRing()
+        self._fromRoom = FrameRing()
+        shards._members[self.memberid] = self
+        shards.send(self._worker, self._addMessage())
+        super(RemoteConfSource, self).__init__()
+
+    def _addMessage(self):
+        return ('add', self.memberid, self._roomname,
+                self._toRoom.name, self._fromRoom.name,
+                RING_SLOTS, SLOT_BYTES)
+
+    def isPlaying(self):
+        return True
+
+    def isRecording(self):
+        return True
+
+    def read(self):
+        if self._fromRoom is None:
+            return b''
+        self._shards.maybeCheckWorkers()
+        while len(self._fromRoom) > 3:
+            self._fromRoom.get()
+        frame = self._fromRoom.get()
+        if frame is None:
+            return b''
+        return frame
+
+    def write(self, bytes):
+        if self._toRoom is not None and bytes:
+            self._toRoom.put(bytes)
+
+    def close(self):
+        if self._toRoom is None:
+            return
+        # The worker may not have attached to the rings yet, so they're
+        # only unlinked once it says it's done with them.
+        self._shards.removeMember(self, (self._toRoom, self._fromRoom))
+        self._toRoom = self._fromRoom = None
+
+    def __repr__(self):
+        return "<ConferenceUser %s in room %s (worker %d) at %x>"%(
+                    self._user, self._roomname, self._worker.index, id(self))
+
+
+class _Worker:
+    def __init__(self, index, ctx):
+        self.index = index
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_workerMain, args=(child,),
+                                   name='shtoom-conf-%d'%(index,))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def send(self, msg):
+        self.conn.send(msg)
+
+    def stop(self):
+        try:
+            self.conn.send(('stop',))
+        except (OSError, EOFError):
+            pass
+        self.process.join(2)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class ConferenceShards:
+    "A pool of worker processes, each mixing some of the rooms"
+
+    def __init__(self, workers=None):
+        import multiprocessing
+        if shared_memory is None:
+            raise RuntimeError("need multiprocessing.shared_memory for "
+                               "sharded conferences")
+        if not workers:
+            workers = os.cpu_count() or 1
+        self._ctx = multiprocessing.get_context('spawn')
+        self.workers = [ _Worker(i, self._ctx) for i in range(workers) ]
+        self._memberId = 0
+        # memberid -> RemoteConfSource, for re-homing if a worker dies
+        self._members = {}
+        # memberid -> (worker, rings), for members that have gone but
+        # whose rings the worker might still be using
+        self._closing = {}
+        self._nextCheck = time.time() + CHECK_INTERVAL
+        log.msg("started %d conference workers"%(workers,), system='doug')
+
+    def _nextMemberId(self):
+        self._memberId += 1
+        return self._memberId
+
+    def workerFor(self, roomname):
+        "The same room always goes to the same worker"
+        h = zlib.crc32(roomname.encode('utf-8'))
+        return self.workers[h % len(self.workers)]
+
+    def newMember(self, roomname, leg):
+        return RemoteConfSource(self, roomname, leg)
+
+    def removeMember(self, member, rings):
+        self._members.pop(member.memberid, None)
+        worker = member._worker
+        self._closing[member.memberid] = (worker, rings)
+        if self.send(worker, ('remove', member.memberid)):
+            self.reap(worker)
+
+    def reap(self, worker):
+        "Unlink the rings of members the worker has finished removing"
+        try:
+            while worker.conn.poll(0):
+                op, memberid = worker.conn.recv()
+                if op == 'removed':
+                    self._closeRings(memberid)
+        except (OSError, EOFError):
+            # Picked up by checkWorkers()
+            pass
+
+    def _closeRings(self, memberid):
+        worker, rings = self._closing.pop(memberid, (None, ()))
+        for ring in rings:
+            ring.close()
+
+    def send(self, worker, msg):
+        """ Send a control message to a worker. If the worker's gone, start
+            another in its place. Returns False if the message wasn't sent.
+        """
+        try:
+            worker.send(msg)
+        except (OSError, EOFError, ValueError):
+            self.workerDied(worker)
+            return False
+        return True
+
+    def maybeCheckWorkers(self):
+        "Called every tick - checks the workers every CHECK_INTERVAL"
+        now = time.time()
+        if now >= self._nextCheck:
+            self._nextCheck = now + CHECK_INTERVAL
+            self.checkWorkers()
+
+    def checkWorkers(self):
+        for w in list(self.workers):
+            if not w.process.is_alive():
+                self.workerDied(w)
+            else:
+                self.reap(w)
+
+    def workerDied(self, worker):
+        """ Replace a dead worker with a new one, and move its rooms to the
+            new one. The members' rings belong to this process, so they
+            just need adding again.
+        """
+        if worker not in self.workers:
+            # Already replaced, or we're shutting down
+            return
+        log.msg("conference worker %d died (exit code %r), restarting"%(
+                    worker.index, worker.process.exitcode), system='doug')
+        worker.stop()
+        # Nothing's using the rings of members that were leaving
+        for memberid, (w, rings) in list(self._closing.items()):
+            if w is worker:
+                self._closeRings(memberid)
+        new = _Worker(worker.index, self._ctx)
+        self.workers[worker.index] = new
+        for member in list(self._members.values()):
+            if member._worker is worker:
+                member._worker = new
+                try:
+                    new.send(member._addMessage())
+                except (OSError, EOFError, ValueError):
+                    # Picked up by the next checkWorkers()
+                    log.err(None, "re-adding %r failed"%(member,))
+                    break
+
+    def stop(self):
+        for w in self.workers:
+            w.stop()
+        self.workers = []
+        for memberid in list(self._closing.keys()):
+            self._closeRings(memberid)
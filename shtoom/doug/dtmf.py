@@ -1,6 +1,6 @@
 """
-    DTMF generation and detection code. This replaces the old nasty
-    code with something a bit nicer (but a bit slower, too :-(
+    DTMF generation and detection code. Detection is a bank of Goertzel
+    filters, one per DTMF frequency, in numpy.
 """
 
 # DTMF tones (aka "the beeps when you hit a keypad consist of a pair
@@ -21,6 +21,9 @@ SAMPLETIME = 0.040
 SAMPLESIZE = int(1/SAMPLETIME)
 SCALING = 1/SAMPLETIME
 
+# Samples in one 20ms frame. Detection looks at two frames (40ms) at a time.
+FRAME = 160
+
 freq2dtmf = {
         (697,1209):'1', (697,1336):'2',(697,1477):'3',(697,1633):'A',
         (770,1209):'4', (770,1336):'5',(770,1477):'6',(770,1633):'B',
@@ -33,31 +36,154 @@ for f, d in freq2dtmf.items():
     dtmf2freq[d] = f
 del f, d
 
-import sets
-frequencies = freq2dtmf.keys()
-frequencies = sets.Set([ x[0] for x in frequencies ] +
-                       [ x[1] for x in frequencies ])
+rowFreqs = (697, 770, 852, 941)
+colFreqs = (1209, 1336, 1477, 1633)
+frequencies = set(rowFreqs + colFreqs)
+
+# digits, by row * 4 + column
+_digits = '123A456B789C*0#D'
+
+# A window counts as DTMF if:
+#  - the strongest row and column tones make up at least ENERGY_RATIO
+#    of the window's energy,
+#  - its average power is at least MIN_POWER (about -45dBm0),
+#  - the column tone is no more than FORWARD_TWIST dB louder, or
+#    REVERSE_TWIST dB quieter, than the row tone, and
+#  - each tone is at least RELATIVE_PEAK dB above the other tones in
+#    its group.
+ENERGY_RATIO = 0.5
+MIN_POWER = 2000.0
+FORWARD_TWIST = 4.0
+REVERSE_TWIST = 8.0
+RELATIVE_PEAK = 8.0
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _dB(x):
+    return 10.0 ** (x / 10.0)
 
 def getSineWave(freq, samplecount=320):
     """ Generate a sine wave of frequency 'freq'. The samples are
         generated at 8khz. The first 'samplecount' samples will be
         returned.
     """
-    from numarray import sin, arange
-    from math import pi
-    sine = sin(arange(HZ)/(HZ/freq) * 2.0 * pi)
-    sine = sine[:samplecount]
-    return sine
+    from math import sin, pi
+    return [ sin(x/(HZ/freq) * 2.0 * pi) for x in range(samplecount) ]
+
+
+class DtmfFilterBank:
+    """ Goertzel filters for the eight DTMF frequencies, run over many
+        streams of audio at once.
+
+        process() takes the next 20ms frame from every stream and returns
+        the digit (or '') heard in each stream's last 40ms. Rather than
+        joining each frame to the one before, the bank keeps each
+        filter's output for the previous frame and adds it on, phase
+        shifted - the result is the same as filtering the 40ms window.
+
+        The filters for a whole batch of frames are one matrix multiply:
+        the output of a Goertzel filter after N samples is the DFT term
+        for its frequency, so the bank is an (N x 8) matrix of them.
+    """
+
+    def __init__(self, streams=1):
+        if numpy is None:
+            raise RuntimeError("need numpy to do inband DTMF")
+        w = 2.0 * numpy.pi * numpy.array(rowFreqs + colFreqs) / HZ
+        n = numpy.arange(FRAME)[:, numpy.newaxis]
+        self._basis = numpy.exp(-1j * w * n)
+        # Phase of the second frame of a window, relative to the first
+        self._shift = numpy.exp(-1j * w * FRAME)
+        self.streams = 0
+        self._sums = numpy.zeros((0, 8), numpy.complex128)
+        self._energy = numpy.zeros(0)
+        self.resize(streams)
+
+    def resize(self, streams):
+        "Change the number of streams. New streams start with silence."
+        old = self.streams
+        if streams > old:
+            self._sums = numpy.concatenate(
+                (self._sums, numpy.zeros((streams-old, 8), numpy.complex128)))
+            self._energy = numpy.concatenate(
+                (self._energy, numpy.zeros(streams-old)))
+        else:
+            self._sums = self._sums[:streams]
+            self._energy = self._energy[:streams]
+        self.streams = streams
+
+    def move(self, src, dst):
+        "Move stream src's state to dst (for filling in a removed stream)"
+        self._sums[dst] = self._sums[src]
+        self._energy[dst] = self._energy[src]
+
+    def reset(self, stream):
+        self._sums[stream] = 0
+        self._energy[stream] = 0
+
+    def process(self, frames, rows=None):
+        """ frames is a sequence of one 20ms frame (bytes, 16 bit PCM) per
+            stream, or an (streams x 160) array of samples. Returns a list
+            of digits, '' for none. If rows is given, frames are for just
+            those streams, in that order.
+        """
+        if not isinstance(frames, numpy.ndarray):
+            frames = toArray(frames)
+        x = frames.astype(numpy.float64)
+        sums = numpy.dot(x, self._basis)
+        energy = numpy.einsum('ij,ij->i', x, x)
+        if rows is None:
+            prevSums, prevEnergy = self._sums, self._energy
+            self._sums, self._energy = sums, energy
+        else:
+            prevSums, prevEnergy = self._sums[rows], self._energy[rows]
+            self._sums[rows] = sums
+            self._energy[rows] = energy
+        power = numpy.abs(prevSums + sums * self._shift) ** 2
+        return classify(power, prevEnergy + energy, 2 * FRAME)
+
+def toArray(frames):
+    "Turn a list of frames (bytes) into an (n x 160) array of samples"
+    a = numpy.zeros((len(frames), FRAME), numpy.int16)
+    for i, f in enumerate(frames):
+        if f:
+            row = numpy.frombuffer(f, numpy.int16, min(len(f)//2, FRAME))
+            a[i, :len(row)] = row
+    return a
+
+def classify(power, energy, n):
+    """ power is an (streams x 8) array of each DTMF frequency's power over
+        n samples, energy each stream's sum of squared samples over the
+        same n. Returns a list of digits, '' for none.
+    """
+    rows, cols = power[:, :4], power[:, 4:]
+    ri, ci = rows.argmax(axis=1), cols.argmax(axis=1)
+    idx = numpy.arange(len(power))
+    rp, cp = rows[idx, ri], cols[idx, ci]
+    # The power of a tone of amplitude A is (A * n / 2) ** 2, and its
+    # energy A ** 2 * n / 2.
+    ok = (rp + cp) * (2.0 / n) >= ENERGY_RATIO * energy
+    ok &= energy >= MIN_POWER * n
+    ok &= cp <= rp * _dB(FORWARD_TWIST)
+    ok &= cp * _dB(REVERSE_TWIST) >= rp
+    # Second strongest in each group
+    rows2 = numpy.sort(rows, axis=1)[:, -2]
+    cols2 = numpy.sort(cols, axis=1)[:, -2]
+    ok &= rows2 * _dB(RELATIVE_PEAK) <= rp
+    ok &= cols2 * _dB(RELATIVE_PEAK) <= cp
+    digits = (ri * 4 + ci).tolist()
+    return [ ok and _digits[d] or '' for ok, d in zip(ok.tolist(), digits) ]
 
 
 class DtmfDetector:
     "This class detects DTMF tones from an audio stream."
+
     def __init__(self):
-        # Store away pre-calculated FFTs for each of the eight frequencies.
-        self.freqmatch = {}
+        self._bank = DtmfFilterBank(1)
         self.dtmf = freq2dtmf
-        for val in frequencies:
-            self.freqmatch[int(val/SCALING)+1] = val
 
     def detect(self, sample):
         """ Test for DTMF in a sample. Returns either a string with the
@@ -66,65 +192,94 @@ class DtmfDetector:
             samples (host endianness). This is _two_ samples at normal
             shtoom sampling rates.
         """
-        import numarray
-        from sets import Set
-        a = numarray.fromstring(sample, numarray.Int16)
-        if len(a) != 320:
-            raise ValueError("samples length %d != 320 (40ms)"%len(a))
-        peaks = self.getpeaks(a)
-        matched = Set()
-        for p in peaks:
-            m = self.freqmatch.get(p)
-            if m is None:
-                if p-1 in self.freqmatch:
-                    m = self.freqmatch.get(p-1)
-                elif p+1 in self.freqmatch:
-                    m = self.freqmatch.get(p+1)
-            matched.add(m)
-        # If we got a None, that means there was a significant component
-        # that wasn't a DTMF frequency.
-        if None in matched:
-            return ''
-        else:
-            m = list(matched)
-            m.sort()
-            return self.dtmf.get(tuple(m), '')
-
-    def getpeaks(self, sample):
-        from numarray import nonzero
-        from numarray.fft import real_fft
-        fft = abs(real_fft(sample))
-        # We compare each point to the point on either side - we must be
-        # greater than both.
-        # To do this, we left-shift and right-shift the array by one to
-        # compare.
-        peaks = nonzero((fft[1:-1] > fft[:-2]) * (fft[1:-1] > fft[2:]))
-        if not len(peaks) or not len(peaks[0]):
-            return ()
-        # Avoiding 'zip; sort; reverse' will give a big speedup.
-        try:
-            peakvals = zip(fft[1:-1].take(peaks)[0], peaks[0])
-        except:
-            print("pppp", peaks)
-            raise
-        peakvals.sort(); peakvals.reverse()
-        if len(peakvals) > 2:
-            (val1,ind1),(val2,ind2),(val3,ind3) = peakvals[:3]
-            # Peak 3 should be no more than 2/3 the size of peak 2
-            # For GSM/Speex mangled audio, peak3 is about 0.55 * peak2
-            # at the worst case.
-            if val2 > 1.5*val3:
-                # Add one to the index because we took [1:-1] before
-                return (ind2+1,ind1+1)
-            else:
-                return ()
-        elif len(peakvals) == 2:
-            (val2,ind2),(val1,ind1) = peakvals
-            # Add one to the index because we took [1:-1] before
-            return (ind2+1,ind1+1)
-        else:
-            (val1,ind1), = peakvals
-            return (ind1,0)
+        if len(sample) != 640:
+            raise ValueError("samples length %d != 320 (40ms)"%(
+                                                        len(sample)//2))
+        bank = self._bank
+        bank.reset(0)
+        view = memoryview(sample)
+        bank.process([view[:320]])
+        return bank.process([view[320:]])[0]
+
+class DtmfService:
+    """ Inband DTMF detection for every leg that wants it, in one batch
+        each media clock tick.
+
+        Detectors are added with add(). Each has a list of frames waiting
+        to be looked at (frames), the digit it last heard (digit), and an
+        update(digit) method, called only when that changes. Each tick,
+        the oldest frame from every detector that has one goes through
+        the filter bank together.
+    """
+
+    # Frames a detector may have waiting before the oldest are dropped
+    MAX_WAITING = 5
+
+    def __init__(self, clock=None):
+        self._clock = clock
+        self._bank = DtmfFilterBank(0)
+        self._detectors = []
+        self._call = None
+        self.ticks = 0
+
+    def add(self, detector):
+        detector._dtmfRow = row = len(self._detectors)
+        self._detectors.append(detector)
+        self._bank.resize(row + 1)
+        self._bank.reset(row)
+        if self._call is None:
+            from shtoom.audio.clock import getMediaClock, PRIORITY_LEG
+            clock = self._clock or getMediaClock()
+            self._call = clock.call(self.tick, PRIORITY_LEG)
+
+    def remove(self, detector):
+        row = detector._dtmfRow
+        if row is None:
+            return
+        detector._dtmfRow = None
+        last = len(self._detectors) - 1
+        if row != last:
+            # Move the last one into the gap
+            moved = self._detectors[row] = self._detectors[last]
+            moved._dtmfRow = row
+            self._bank.move(last, row)
+        del self._detectors[last]
+        self._bank.resize(last)
+        if not self._detectors and self._call is not None:
+            self._call.stop()
+            self._call = None
+
+    def __len__(self):
+        return len(self._detectors)
+
+    def tick(self):
+        self.ticks += 1
+        rows, frames = [], []
+        for row, d in enumerate(self._detectors):
+            if d.frames:
+                if len(d.frames) > self.MAX_WAITING:
+                    del d.frames[:-self.MAX_WAITING]
+                rows.append(row)
+                frames.append(d.frames.pop(0))
+        if not rows:
+            return
+        digits = self._bank.process(frames, rows)
+        changed = [ (self._detectors[row], digit)
+                        for row, digit in zip(rows, digits)
+                        if digit != self._detectors[row].digit ]
+        # Legs may add or remove detectors when told about digits
+        for d, digit in changed:
+            if d._dtmfRow is not None:
+                d.update(digit)
+
+_service = None
+
+def getDtmfService():
+    "Returns the process-wide inband DTMF detection service"
+    global _service
+    if _service is None:
+        _service = DtmfService()
+    return _service
 
 def dtmfGenerator(key, duration=160):
     import struct
@@ -135,15 +290,12 @@ def dtmfGenerator(key, duration=160):
     s1 = getSineWave(f1, duration)
     s2 = getSineWave(f2, duration)
     # combine them and make louder
-    s = [ (2**13)*(s1[x]+s2[x]) for x in range(duration) ]
+    s = [ int((2**13)*(s1[x]+s2[x])) for x in range(duration) ]
     # turn into a string
     s = struct.pack('%dh'%duration, *s)
     return s
 
 
-
-
-
 def test():
     import sys
     if len(sys.argv) != 2:
@@ -151,7 +303,7 @@ def test():
         print("file should be 8KHz raw 16 bit signed samples")
         print("use sox infile.au -s -w testfile.raw to make this")
         sys.exit(1)
-    audio = open(sys.argv[1], 'r')
+    audio = open(sys.argv[1], 'rb')
     D = DtmfDetector()
     old = ''
     offs = 0.0
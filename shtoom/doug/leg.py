@@ -12,8 +12,8 @@ from shtoom.doug.source import Source, SilenceSource, convertToSource
 from shtoom.audio.converters import DougConverter
 from shtoom.doug.events import CallAnsweredEvent, CallRejectedEvent
 from shtoom.doug.events import MediaPlayContentDoneEvent, DTMFReceivedEvent
+from shtoom.audio.clock import getMediaClock, PRIORITY_LEG
 from twisted.python import log
-from twisted.internet.task import LoopingCall
 
 class Leg(object):
 
@@ -37,14 +37,16 @@ class Leg(object):
         self.__collectedDTMFKeys = ''
         self.__dtmfSingleMode = True
         self.__inbandDTMFdetector = None
+        self.__passthrough = False
+        self.__done = False
         self._voiceapp = voiceapp
+        self.LC = None
         self._connectSource(self.__silenceSource)
         self._startAudio()
 
     def _startAudio(self):
         #print(self, "starting audio")
-        self.LC = LoopingCall(self._get_some_audio)
-        self.LC.start(0.020)
+        self.LC = getLegAudioService().add(self)
 
     def _stopAudio(self):
         if self.LC is not None:
@@ -52,12 +54,29 @@ class Leg(object):
             self.LC.stop()
             self.LC = None
 
-    def _get_some_audio(self):
+    def _readAudio(self):
+        """ Read a tick's audio from our source. If it comes already
+            encoded, it's sent straight away and None returned; otherwise
+            the audio to be encoded and sent is returned.
+        """
+        if self._voiceapp is not None:
+            samples = self.__connected.readEncoded(self.__converter.getFormat())
+            if samples is None:
+                return self.__connected.read()
+            elif not samples:
+                self._sendAudio(None)
+            else:
+                for sample in samples:
+                    self._sendAudio(sample)
+        return None
+
+    def _sendAudio(self, sample):
         if self._voiceapp is not None:
-            data = self.__connected.read()
-            sample = self.__converter.convertOutbound(data)
             self._voiceapp.va_outgoingRTP(sample, self._cookie)
 
+    def _getCodecker(self):
+        return self.__converter.codecker
+
     def getDialog(self):
         return self._dialog
 
@@ -122,7 +141,13 @@ class Leg(object):
                                                 self._cookie), system='doug')
 
     def hangupCall(self):
+        self.__done = True
         self._stopAudio()
+        # Finish off any recording, so its file gets closed properly
+        self.mediaStopRecording()
+        if self.__inbandDTMFdetector is not None:
+            self.__inbandDTMFdetector.close()
+            self.__inbandDTMFdetector = None
         if self._voiceapp:
             self._voiceapp.va_hangupCall(self._cookie)
 
@@ -136,7 +161,7 @@ class Leg(object):
             self._voiceapp._triggerEvent(MediaPlayContentDoneEvent(last, self))
         else:
             next = self.__playoutList.pop(0)
-            next = convertToSource(next, 'r')
+            next = convertToSource(next, 'r', format=self.getFormat())
             self._connectSource(next)
 
     def _sourceDone(self, source):
@@ -148,8 +173,29 @@ class Leg(object):
         old, self.__connected = self.__connected, target
         if old:
             old.leg = None
+        self._checkPassthrough()
         return old
 
+    def _checkPassthrough(self):
+        """ In passthrough, the other leg's RTP is sent out as-is, so we
+            don't need the media clock to read and encode audio.
+        """
+        on = self.__connected.passthrough
+        if on == self.__passthrough or self.__done:
+            return
+        self.__passthrough = on
+        if on:
+            self._stopAudio()
+        else:
+            self._startAudio()
+
+    def isPassthrough(self):
+        return self.__passthrough
+
+    def getFormat(self):
+        "The codec we're sending, once it's been negotiated"
+        return self.__converter.getFormat()
+
     def _connectSink(self, target):
         if target:
             target.leg = self
@@ -164,7 +210,7 @@ class Leg(object):
             self._playNextItem()
 
     def mediaPlay(self, playlist):
-        if isinstance(playlist, basestring):
+        if isinstance(playlist, str):
             playlist = [playlist]
         self.__playoutList.extend(playlist)
         self._maybeStartPlaying()
@@ -215,7 +261,32 @@ class Leg(object):
     def set_handler(self, handler):
         self.__converter.set_handler(handler)
 
+    def _passthroughLeg(self):
+        "The leg our RTP is relayed to, if we're in passthrough"
+        if self.__passthrough:
+            other = self.__connected.other
+            if other is not None and other.leg is not None:
+                if other.leg.isPassthrough():
+                    return other.leg
+        return None
+
+    def leg_relayRTP(self, packet):
+        "Send a packet from the other leg of a passthrough bridge"
+        if self._voiceapp is not None:
+            self._voiceapp.va_relayRTP(packet, self._cookie)
+
+    def leg_incomingNTE(self, packet):
+        other = self._passthroughLeg()
+        if other is not None:
+            other.leg_relayRTP(packet)
+
     def leg_incomingRTP(self, packet):
+        other = self._passthroughLeg()
+        if other is not None:
+            other.leg_relayRTP(packet)
+            if self.__sink is None and self.__inbandDTMFdetector is None:
+                # Nothing here needs the audio decoded
+                return
         data = self.__converter.convertInbound(packet)
         if self.__inbandDTMFdetector is not None:
             self.__inbandDTMFdetector(data)
@@ -230,15 +301,25 @@ class Leg(object):
 
     def dtmfMode(self, single=False, inband=False, timeout=0):
         self.__dtmfSingleMode = single
-        if inband:
-            if numarray is None:
-                raise RuntimeError("need numarray to do inband DTMF")
-            else:
-                self.__inbandDTMFdetector = InbandDtmfDetector(self)
-        else:
+        if inband and numpy is None:
+            raise RuntimeError("need numpy to do inband DTMF")
+        if self.__inbandDTMFdetector is not None:
+            self.__inbandDTMFdetector.close()
             self.__inbandDTMFdetector = None
+        if inband:
+            self.__inbandDTMFdetector = InbandDtmfDetector(self)
         # XXX handle timeout
 
+    def vadMode(self, on=True):
+        """ Don't send audio while there's nobody talking, just comfort
+            noise (see shtoom.audio.vad)
+        """
+        vad = None
+        if on:
+            from shtoom.audio.vad import VAD
+            vad = VAD()
+        self.__converter.codecker.setVAD(vad)
+
     def __repr__(self):
         return '<Leg at %x connected to %r>'%(id(self), self._voiceapp)
 
@@ -286,51 +367,194 @@ class BridgeSource(Source):
 class Bridge:
     """A bridge connects two legs together, and passes audio from one to
        the other. It creates two Source objects, that are connected to
-       each leg"""
-    def __init__(self, leg1, leg2):
-        self.connectLegs(leg1, leg2)
+       each leg.
+
+       If both legs are using the same codec (and passthrough is true),
+       RTP is relayed from one leg to the other without being decoded
+       and re-encoded. If the RTP is relayed at the socket level (see
+       VoiceApp.connectLegs), relay is the rtp.relay.RTPRelay."""
 
-    def connectLegs(self, l1, l2):
+    relay = None
+
+    def __init__(self, leg1, leg2, passthrough=True):
+        self.passthrough = False
+        self.connectLegs(leg1, leg2, passthrough)
+
+    def connectLegs(self, l1, l2, passthrough=True):
         bs1 = BridgeSource(self)
         bs2 = BridgeSource(self)
         bs1.connect(bs2)
         bs2.connect(bs1)
+        if passthrough and sameFormat(l1, l2):
+            log.msg("bridging %r and %r in passthrough"%(l1, l2),
+                                                        system='doug')
+            bs1.passthrough = bs2.passthrough = self.passthrough = True
         l1._connectSource(bs1)
         l2._connectSource(bs2)
 
     def closeBridge(self, bs):
-        # Nothing for now.
-        pass
-
+        if self.relay is not None:
+            self.relay.stop()
+            self.relay = None
+
+def sameFormat(l1, l2):
+    "Have the two legs negotiated the same codec?"
+    if not (hasattr(l1, 'getFormat') and hasattr(l2, 'getFormat')):
+        return False
+    f1, f2 = l1.getFormat(), l2.getFormat()
+    return f1 is not None and f1 == f2
+
+
+_FAILED = object()
+
+class _LegAudioCall:
+    "Returned by LegAudioService.add(), to stop() the leg's audio"
+
+    def __init__(self, service, leg):
+        self.service = service
+        self.leg = leg
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.service._remove(self)
+
+class LegAudioService:
+    """ Sends every leg's outbound audio, in one pass each media clock
+        tick. Each leg's source is read, then all the audio is encoded in
+        a batch (see shtoom.audio.converters.encodeBatch), so legs using
+        the same G.711 codec are encoded together, and then sent.
+    """
+
+    def __init__(self, clock=None):
+        self._clock = clock
+        self._calls = {}
+        self._call = None
+        # statistics
+        self.ticks = 0
+        self.frames = 0
+
+    def add(self, leg):
+        c = _LegAudioCall(self, leg)
+        self._calls[c] = True
+        if self._call is None:
+            clock = self._clock or getMediaClock()
+            self._call = clock.call(self.tick, PRIORITY_LEG)
+        return c
+
+    def _remove(self, c):
+        self._calls.pop(c, None)
+        if not self._calls and self._call is not None:
+            self._call.stop()
+            self._call = None
+
+    def __len__(self):
+        return len(self._calls)
+
+    def tick(self):
+        self.ticks += 1
+        reads = []
+        for c in list(self._calls):
+            # A leg may be stopped by one read before it
+            if not c.running:
+                continue
+            try:
+                data = c.leg._readAudio()
+            except:
+                log.err()
+                continue
+            if data is not None:
+                reads.append((c, data))
+        if not reads:
+            return
+        # Empty reads are silence - there's nothing to encode
+        toEncode = [ (c, data) for c, data in reads if data ]
+        self.frames += len(toEncode)
+        encoded = self._encode(toEncode)
+        for c, data in reads:
+            if not data:
+                sample = None
+            else:
+                sample = encoded.get(c, _FAILED)
+                if sample is _FAILED:
+                    continue
+            if not c.running:
+                continue
+            try:
+                c.leg._sendAudio(sample)
+            except:
+                log.err()
+
+    def _encode(self, reads):
+        "Encode a list of (call, data), returning a dict of call: sample"
+        from shtoom.audio.converters import encodeBatch
+        if not reads:
+            return {}
+        calls = [ c for c, data in reads ]
+        try:
+            samples = encodeBatch([ c.leg._getCodecker() for c in calls ],
+                                  [ data for c, data in reads ])
+            return dict(zip(calls, samples))
+        except:
+            log.err()
+        # Something in the batch is broken. Do them one at a time, so it
+        # only breaks its own leg.
+        encoded = {}
+        for c, data in reads:
+            try:
+                encoded[c] = c.leg._getCodecker().handle_audio(data)
+            except:
+                log.err()
+        return encoded
+
+_legAudio = None
+
+def getLegAudioService():
+    "Returns the process-wide leg audio service"
+    global _legAudio
+    if _legAudio is None:
+        _legAudio = LegAudioService()
+    return _legAudio
 
 
 try:
-    import numarray
+    import numpy
 except ImportError:
-    numarray = None
-
-if numarray is not None:
-    class InbandDtmfDetector:
-        def __init__(self, leg):
-            from shtoom.doug.dtmf import DtmfDetector
-            self.leg = leg
-            self.prev = None
-            self.D = DtmfDetector()
-            self.digit = ''
-        def __call__(self, samp):
-            if self.prev is None:
-                self.prev = samp
-                return
-            nd = self.D.detect(self.prev+samp)
-            if nd != self.digit:
-                if self.digit == '':
-                    self.digit = nd
-                    self.leg.leg_startDTMFevent(nd)
-                elif nd == '':
-                    old, self.digit = self.digit, nd
-                    self.leg.leg_stopDTMFevent(old)
-                else:
-                    old, self.digit = nd, self.digit
-                    self.leg.leg_stopDTMFevent(old)
-                    self.leg.leg_startDTMFevent(self.digit)
-            self.prev = samp
+    numpy = None
+
+class InbandDtmfDetector:
+    """ Watches a leg's inbound audio for DTMF. The detection itself is
+        done by the DtmfService, for all legs at once.
+    """
+
+    _dtmfRow = None
+
+    def __init__(self, leg, service=None):
+        from shtoom.doug.dtmf import getDtmfService
+        if service is None:
+            service = getDtmfService()
+        self.leg = leg
+        self.digit = ''
+        self.frames = []
+        self.service = service
+        service.add(self)
+
+    def __call__(self, samp):
+        self.frames.append(samp)
+
+    def close(self):
+        self.service.remove(self)
+
+    def update(self, nd):
+        if nd != self.digit:
+            if self.digit == '':
+                self.digit = nd
+                self.leg.leg_startDTMFevent(nd)
+            elif nd == '':
+                old, self.digit = self.digit, nd
+                self.leg.leg_stopDTMFevent(old)
+            else:
+                old, self.digit = self.digit, nd
+                self.leg.leg_stopDTMFevent(old)
+                self.leg.leg_startDTMFevent(self.digit)
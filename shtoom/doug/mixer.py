@@ -0,0 +1,69 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+Conference mixing.
+
+Each speaker in a room hears everyone but themselves (an "N-1" mix),
+and everyone else hears all the speakers. Rather than adding up N-1
+frames for every speaker, the mixer adds all N up once and takes each
+speaker's own frame back out. With numpy that's a couple of operations
+on an N x samples matrix, however many speakers there are.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Mixer:
+    """ Mixes frames of 16 bit linear audio.
+
+        mix(frames) returns (default, outs): default is the mix of all
+        the frames, for listeners; outs[i] is the mix of every frame but
+        frames[i]. Each mix is the average of its frames, so it doesn't
+        clip any more than the loudest speaker does. Short frames are
+        padded with silence.
+    """
+
+    def mix(self, frames):
+        if not frames:
+            return b'', []
+        if len(frames) == 1:
+            return frames[0], [b'']
+        if numpy is not None:
+            return self._mixNumpy(frames)
+        return self._mixAudioop(frames)
+
+    def _mixNumpy(self, frames):
+        n = len(frames)
+        samples = max([len(f) for f in frames]) // 2
+        m = numpy.zeros((n, samples), numpy.int32)
+        for i, f in enumerate(frames):
+            row = numpy.frombuffer(f, numpy.int16, len(f) // 2)
+            m[i, :len(row)] = row
+        total = m.sum(axis=0)
+        default = numpy.clip(total / float(n), -32768, 32767)
+        # total - m is every member's N-1 sum, in one go
+        outs = numpy.clip((total - m) / float(n - 1), -32768, 32767)
+        outs = outs.astype(numpy.int16)
+        return (default.astype(numpy.int16).tobytes(),
+                [row.tobytes() for row in outs])
+
+    def _mixAudioop(self, frames):
+        import audioop
+        n = len(frames)
+        size = max([len(f) for f in frames])
+        frames = [f + b'\0' * (size - len(f)) for f in frames]
+        scaled = [audioop.mul(f, 2, 1.0/n) for f in frames]
+        default = scaled[0]
+        for f in scaled[1:]:
+            default = audioop.add(default, f, 2)
+        outs = []
+        for i in range(n):
+            others = [audioop.mul(f, 2, 1.0/(n-1))
+                            for j, f in enumerate(frames) if j != i]
+            out = others[0]
+            for f in others[1:]:
+                out = audioop.add(out, f, 2)
+            outs.append(out)
+        return default, outs
@@ -0,0 +1,370 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+A cache of pre-encoded prompts.
+
+A voicemail greeting or an IVR menu gets played over and over, to
+callers who mostly use the same codec. Rather than every caller reading
+the file 320 bytes at a time and encoding it themselves, the first one
+to play a file in a given codec encodes the whole thing into 20ms
+frames, and everyone after that just sends the frames.
+
+Only prompts are cached - files under one of the prompt directories
+(the prompt_dirs preference, or addPromptDir()), or ones a voiceapp has
+marked with markCacheable(). A one-off file, like a voicemail being
+played back, would only push the prompts out.
+
+Encoding a prompt takes a while, so it's done in a thread: the caller
+who misses plays the file as it is, and the encoded prompt is there for
+the next one. Encoded prompts are kept in memory, least recently used
+first out once the cache is over its size. If a sidecar directory is
+given, they're also written there and mmap'd back in, so they survive a
+restart and live in the page cache rather than the Python heap.
+"""
+
+import os, struct, mmap, time
+from hashlib import md5
+from collections import OrderedDict
+
+from twisted.python import log
+
+from shtoom.doug.source import Source
+
+# 16 bit, 8KHz, 20ms
+FRAME_BYTES = 320
+
+DEFAULT_SIZE = 32 * 1024 * 1024
+
+# Seconds between checks that a cached prompt's file hasn't changed
+STAT_INTERVAL = 5.0
+
+# Sidecar header: magic, source file size and mtime, number of frames.
+# Then a uint16 length per frame, then the frames.
+_MAGIC = b'SHTP\x01'
+_header = struct.Struct('!5sQdI')
+
+class EncodedPrompt:
+    """ A prompt encoded in one format. frames is a list of views of
+        buf, one per 20ms.
+    """
+
+    def __init__(self, buf, lengths, stamp, fmt):
+        self.buf = buf
+        self.stamp = stamp
+        self.fmt = fmt
+        # When we last checked the file still matched stamp
+        self.checked = 0
+        view = memoryview(buf)
+        self.frames = frames = []
+        off = 0
+        for n in lengths:
+            frames.append(view[off:off+n])
+            off += n
+        # The buffer, plus the list of views
+        self.size = len(buf) + 8 * len(frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+
+def encodePrompt(pcm, fmt):
+    "Encode 16 bit 8KHz PCM into a list of fmt frames"
+    from shtoom.audio.converters import Codecker
+    extra = len(pcm) % FRAME_BYTES
+    if extra:
+        # Pad the last frame out with silence
+        pcm = bytes(pcm) + b'\0' * (FRAME_BYTES - extra)
+    samples = []
+    enc = Codecker(fmt)
+    enc.set_handler(samples.append)
+    enc.handle_audio(pcm)
+    return [s.data for s in samples if s.data]
+
+def _stamp(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime)
+
+
+class PromptCache:
+    """ Maps (file, format) to an EncodedPrompt, keeping no more than
+        maxBytes of them.
+    """
+
+    def __init__(self, maxBytes=DEFAULT_SIZE, sidecarDir=None,
+                 promptDirs=(), clock=time.time):
+        self.maxBytes = maxBytes
+        self.sidecarDir = sidecarDir
+        self.clock = clock
+        self._promptDirs = []
+        for d in promptDirs:
+            self.addPromptDir(d)
+        self._marked = set()
+        self._entries = OrderedDict()
+        # (path, format) -> Deferred, for prompts being encoded
+        self._loading = {}
+        self.size = 0
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def addPromptDir(self, dirname):
+        "Cache files under dirname"
+        self._promptDirs.append(os.path.join(os.path.abspath(dirname), ''))
+
+    def markCacheable(self, filename):
+        "Cache filename, wherever it lives"
+        self._marked.add(os.path.abspath(filename))
+
+    def isCacheable(self, filename):
+        path = os.path.abspath(filename)
+        if path in self._marked:
+            return True
+        for d in self._promptDirs:
+            if path.startswith(d):
+                return True
+        return False
+
+    def get(self, filename, fmt):
+        """ Returns the EncodedPrompt for filename in fmt, encoding it if
+            need be. This reads and encodes the file there and then - on
+            the reactor thread, use lookup() instead.
+        """
+        path = os.path.abspath(filename)
+        key = (path, fmt)
+        prompt = self._cached(key)
+        if prompt is None:
+            self.misses += 1
+            prompt = self._add(key, self._load(path, fmt))
+        return prompt
+
+    def lookup(self, filename, fmt):
+        """ Returns the EncodedPrompt for filename in fmt if it's cached.
+            If it's not, returns None and starts encoding it in a thread,
+            so it's there next time.
+        """
+        from twisted.internet import threads
+        path = os.path.abspath(filename)
+        key = (path, fmt)
+        prompt = self._cached(key)
+        if prompt is None and key not in self._loading:
+            self.misses += 1
+            d = threads.deferToThread(self._load, path, fmt)
+            self._loading[key] = d
+            def loaded(prompt):
+                del self._loading[key]
+                self._add(key, prompt)
+            def failed(failure):
+                del self._loading[key]
+                log.msg("couldn't encode prompt %s: %s"%(path,
+                            failure.getErrorMessage()), system='doug')
+            d.addCallbacks(loaded, failed)
+        return prompt
+
+    def _cached(self, key):
+        "The cached prompt for key, if there is one and it's up to date"
+        prompt = self._entries.get(key)
+        if prompt is None:
+            return None
+        now = self.clock()
+        if now - prompt.checked >= STAT_INTERVAL:
+            try:
+                stamp = _stamp(key[0])
+            except OSError:
+                stamp = None
+            if stamp != prompt.stamp:
+                # The file's changed underneath us
+                self._remove(key)
+                return None
+            prompt.checked = now
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return prompt
+
+    def _load(self, path, fmt):
+        """ Get an EncodedPrompt for path, from its sidecar or by encoding
+            it. Doesn't touch the cache, so can be run in a thread.
+        """
+        stamp = _stamp(path)
+        if self.sidecarDir is not None:
+            prompt = self._loadSidecar(path, stamp, fmt)
+            if prompt is not None:
+                return prompt
+        from shtoom.audio.aufile import mapAudioFile
+        frames = encodePrompt(mapAudioFile(path), fmt)
+        prompt = EncodedPrompt(b''.join(frames),
+                               [len(f) for f in frames], stamp, fmt)
+        if self.sidecarDir is not None:
+            self._writeSidecar(path, prompt, frames)
+        return prompt
+
+    def _add(self, key, prompt):
+        if key in self._entries:
+            self._remove(key)
+        prompt.checked = self.clock()
+        self._entries[key] = prompt
+        self.size += prompt.size
+        self._evict()
+        return prompt
+
+    def _remove(self, key):
+        prompt = self._entries.pop(key)
+        self.size -= prompt.size
+
+    def _evict(self):
+        # Always keep the newest, even if it's too big on its own
+        while self.size > self.maxBytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def _sidecarName(self, path, fmt):
+        h = md5(path.encode('utf-8')).hexdigest()
+        return os.path.join(self.sidecarDir,
+                            '%s.%s.prompt'%(h, fmt.name.lower()))
+
+    def _loadSidecar(self, path, stamp, fmt):
+        name = self._sidecarName(path, fmt)
+        try:
+            fp = open(name, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            try:
+                buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                return None
+        finally:
+            fp.close()
+        if len(buf) < _header.size:
+            return None
+        magic, size, mtime, count = _header.unpack_from(buf)
+        if magic != _MAGIC or (size, mtime) != stamp:
+            return None
+        start = _header.size + 2 * count
+        lengths = struct.unpack_from('!%dH'%(count,), buf, _header.size)
+        if start + sum(lengths) != len(buf):
+            return None
+        return EncodedPrompt(memoryview(buf)[start:], lengths, stamp, fmt)
+
+    def _writeSidecar(self, path, prompt, frames):
+        name = self._sidecarName(path, fmt=prompt.fmt)
+        tmp = '%s.%d'%(name, os.getpid())
+        try:
+            fp = open(tmp, 'wb')
+            try:
+                fp.write(_header.pack(_MAGIC, prompt.stamp[0], prompt.stamp[1],
+                                      len(frames)))
+                fp.write(struct.pack('!%dH'%(len(frames),),
+                                     *[len(f) for f in frames]))
+                fp.write(prompt.buf)
+            finally:
+                fp.close()
+            os.replace(tmp, name)
+        except (IOError, OSError) as e:
+            log.msg("couldn't write prompt cache file %s: %s"%(name, e),
+                                                            system='doug')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def getStats(self):
+        return { 'prompts': len(self._entries),
+                 'bytes': self.size,
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'evictions': self.evictions,
+               }
+
+
+class CachedPromptSource(Source):
+    """ Plays an EncodedPrompt. The leg gets the frames straight from
+        readEncoded(); if it wants some other format, read() falls back
+        to the file's PCM, like a MappedFileSource.
+    """
+
+    def __init__(self, filename, prompt):
+        self._filename = filename
+        self._prompt = prompt
+        self._pos = 0
+        self._pcm = None
+        self._mapping = False
+        super(CachedPromptSource, self).__init__()
+
+    def isPlaying(self):
+        return True
+
+    def isRecording(self):
+        return False
+
+    def readEncoded(self, fmt):
+        from shtoom.audio.converters import MediaSample
+        if fmt != self._prompt.fmt:
+            return None
+        frames = self._prompt.frames
+        if self._pos >= len(frames):
+            self.leg._sourceDone(self)
+            return []
+        frame = frames[self._pos]
+        self._pos += 1
+        return [MediaSample(fmt, frame)]
+
+    def read(self):
+        if self._pcm is None:
+            # Silence until it's mapped (and converted, in a thread)
+            if not self._mapping:
+                from shtoom.audio.aufile import mapAudioFileLater
+                self._mapping = True
+                d = mapAudioFileLater(self._filename)
+                d.addCallback(self._mapped)
+                d.addErrback(self._mapFailed)
+            if self._pcm is None:
+                return b''
+        off = self._pos * FRAME_BYTES
+        bytes = self._pcm[off:off+FRAME_BYTES]
+        self._pos += 1
+        if not bytes:
+            self.leg._sourceDone(self)
+            return b''
+        return bytes
+
+    def _mapped(self, pcm):
+        if self._mapping:
+            self._pcm = pcm
+
+    def _mapFailed(self, failure):
+        log.msg("can't play %s: %s"%(self._filename,
+                        failure.getErrorMessage()), system='doug')
+        if self._mapping and self.leg is not None:
+            self.leg._sourceDone(self)
+
+    def close(self):
+        self._pcm = None
+        self._mapping = False
+
+    def write(self, bytes):
+        pass
+
+    def __repr__(self):
+        return '<CachedPromptSource %s (%s) at %x>'%(self._filename,
+                                            self._prompt.fmt.name, id(self))
+
+
+_cache = None
+
+def getPromptCache(app=None):
+    """ Return the process-wide prompt cache, configured from app's
+        prompt_cache_size (in megabytes), prompt_cache_dir and prompt_dirs
+        preferences the first time it's asked for.
+    """
+    global _cache
+    if _cache is None:
+        size, sidecarDir, promptDirs = DEFAULT_SIZE, None, []
+        if app is not None:
+            if app.getPref('prompt_cache_size') is not None:
+                size = app.getPref('prompt_cache_size') * 1024 * 1024
+            sidecarDir = app.getPref('prompt_cache_dir') or None
+            dirs = app.getPref('prompt_dirs') or ''
+            promptDirs = [ d.strip() for d in dirs.split(',') if d.strip() ]
+        _cache = PromptCache(size, sidecarDir, promptDirs)
+    return _cache
@@ -0,0 +1,232 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+Recording calls to disk without blocking the reactor.
+
+A FileSource in record mode writes every 20ms frame to its file as it
+arrives, on the reactor thread. One slow disk and every call's media
+stalls. A RecordingSink instead collects frames in memory and hands
+them, a chunk of a few seconds at a time, to a writer thread shared by
+all recordings. Opening the file, writing it and patching up the WAV
+header at the end all happen in that thread.
+
+If the writer falls behind, its queue fills up and recordings hold on
+to their audio until there's room (counted as backpressure); if a
+recording gets too far behind, new frames are dropped (and counted).
+"""
+
+import struct, threading
+
+from queue import Queue, Full
+
+from twisted.python import log
+
+from shtoom.doug.source import Source
+
+# Hand this much audio at a time to the writer - 4 seconds
+CHUNK_BYTES = 64000
+# Chunks waiting for the writer, across all recordings
+QUEUE_CHUNKS = 256
+# Audio a recording will hold on to while the writer's backed up
+MAX_PENDING = 16 * CHUNK_BYTES
+
+_wavHeader = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+def wavHeader(datalen):
+    "A header for datalen bytes of 16 bit 8KHz mono WAV"
+    return _wavHeader.pack(b'RIFF', 36 + datalen, b'WAVE',
+                           b'fmt ', 16, 1, 1, 8000, 16000, 2, 16,
+                           b'data', datalen)
+
+
+class RecordingWriter:
+    """ A thread that writes RecordingSinks' audio out. Jobs are
+        (sink, op, data) tuples, done in order.
+    """
+
+    def __init__(self, maxChunks=QUEUE_CHUNKS):
+        self.queue = Queue(maxChunks)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                        name='shtoom-recorder', daemon=True)
+                self._thread.start()
+
+    def submit(self, sink, op, data=None):
+        "Queue a job. Returns False if the queue is full"
+        if self._thread is None:
+            self._start()
+        try:
+            self.queue.put((sink, op, data), False)
+        except Full:
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            sink, op, data = self.queue.get()
+            if sink is None:
+                return
+            try:
+                getattr(sink, '_do_' + op)(data)
+            except Exception as e:
+                sink.error = e
+                log.msg("recording to %s failed: %s"%(sink.filename, e),
+                                                            system='doug')
+
+    def stop(self):
+        if self._thread is not None:
+            self.queue.put((None, None, None))
+            self._thread.join()
+            self._thread = None
+
+
+class RecordingSink(Source):
+    """ Records the audio written to it into filename - as a WAV file if
+        the name ends in .wav, raw 16 bit 8KHz PCM otherwise.
+
+        done is a threading.Event that's set once the file has been
+        written and closed.
+    """
+
+    def __init__(self, filename, writer=None):
+        if writer is None:
+            writer = getRecordingWriter()
+        self.filename = filename
+        self.wav = filename.lower().endswith('.wav')
+        self._writer = writer
+        # Frames of the chunk being filled, and whole chunks waiting for
+        # the writer to take them
+        self._pending = []
+        self._partBytes = 0
+        self._chunks = []
+        # Audio we're holding on to, in both
+        self._pendingBytes = 0
+        self._closed = False
+        self.done = threading.Event()
+        self.error = None
+        # statistics
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.backpressure = 0
+        super(RecordingSink, self).__init__()
+
+    def isPlaying(self):
+        return False
+
+    def isRecording(self):
+        return not self._closed
+
+    def read(self):
+        return b''
+
+    def write(self, bytes):
+        if self._closed or not bytes:
+            return
+        if self._pendingBytes >= MAX_PENDING:
+            self.dropped += 1
+            return
+        self._pending.append(bytes)
+        self._partBytes += len(bytes)
+        self._pendingBytes += len(bytes)
+        self.frames += 1
+        if self._partBytes >= CHUNK_BYTES:
+            self._endChunk()
+            self._flush()
+
+    def _endChunk(self):
+        if self._pending:
+            self._chunks.append(b''.join(self._pending))
+            self._pending = []
+            self._partBytes = 0
+
+    def _flush(self):
+        """ Hand waiting chunks to the writer, oldest first. Returns False
+            if the writer's behind - they'll be tried again when the next
+            chunk's ready.
+        """
+        chunks = self._chunks
+        while chunks:
+            chunk = chunks[0]
+            if not self._writer.submit(self, 'write', chunk):
+                self.backpressure += 1
+                return False
+            del chunks[0]
+            self.bytes += len(chunk)
+            self._pendingBytes -= len(chunk)
+        return True
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._finish()
+
+    def _finish(self):
+        self._endChunk()
+        if self._flush() and self._writer.submit(self, 'close'):
+            return
+        from twisted.internet import reactor
+        reactor.callLater(0.1, self._finish)
+
+    # These run in the writer thread
+
+    _fp = None
+    _written = None
+
+    def _open(self):
+        self._written = 0
+        self._fp = open(self.filename, 'wb')
+        if self.wav:
+            self._fp.write(wavHeader(0))
+
+    def _do_write(self, data):
+        if self.error is not None:
+            return
+        if self._written is None:
+            self._open()
+        self._fp.write(data)
+        self._written += len(data)
+
+    def _do_close(self, data):
+        try:
+            if self.error is not None:
+                return
+            if self._written is None:
+                self._open()
+            if self.wav:
+                self._fp.seek(0)
+                self._fp.write(wavHeader(self._written))
+        finally:
+            fp, self._fp = self._fp, None
+            try:
+                if fp is not None:
+                    fp.close()
+            finally:
+                self.done.set()
+
+    def getStats(self):
+        return { 'frames': self.frames,
+                 'bytes': self.bytes,
+                 'pending': self._pendingBytes,
+                 'dropped': self.dropped,
+                 'backpressure': self.backpressure,
+               }
+
+    def __repr__(self):
+        return '<RecordingSink %s at %x>'%(self.filename, id(self))
+
+
+_writer = None
+
+def getRecordingWriter():
+    "Returns the process-wide recording writer thread"
+    global _writer
+    if _writer is None:
+        _writer = RecordingWriter()
+    return _writer
@@ -1,11 +1,17 @@
 import sys
 
+from twisted.python import log
+
 class Source(object):
     "A Source object is a source and sink of audio data"
 
     # Can this Source handle DMTF?
     wantsDTMF = False
 
+    # Does the leg send RTP straight through to another leg, rather than
+    # reading audio from this Source? (see leg.Bridge)
+    passthrough = False
+
     def __init__(self):
         self.leg = None
 
@@ -21,6 +27,13 @@ class Source(object):
     def read(self):
         return NotImplementedError
 
+    def readEncoded(self, fmt):
+        """ Return this tick's audio already encoded in format fmt, as a
+            list of MediaSamples (empty for silence), or None if the
+            caller should read() and encode it themselves.
+        """
+        return None
+
     def close(self):
         return NotImplementedError
 
@@ -42,7 +55,7 @@ class SilenceSource(Source):
         pass # noop - you cannot close what does not live!
 
     def read(self):
-        return ''
+        return b''
 
     def write(self, bytes):
         pass
@@ -56,7 +69,8 @@ class EchoSource(Source):
     """
 
     def __init__(self, delay=0.0):
-        self._buffer = ''
+        from shtoom.audio.framebuffer import FrameBuffer
+        self._buffer = FrameBuffer()
         self._delay = delay
 
     def isPlaying(self):
@@ -66,19 +80,18 @@ class EchoSource(Source):
         return True
 
     def close(self):
-        self._buffer = ''
+        self._buffer.clear()
         return
 
     def read(self):
         # 2 bytes per sample, 8000 samples per second
         if len(self._buffer) >= 320+(self._delay * 16000.0):
-            r, self._buffer = self._buffer[:320], self._buffer[320:]
-            return r
+            return self._buffer.read(320)
         else:
-            return ''
+            return b''
 
     def write(self, bytes):
-        self._buffer += bytes
+        self._buffer.write(bytes)
 
 class FileSource(Source):
     "A FileSource connects to a file for either reading or writing"
@@ -116,16 +129,82 @@ class FileSource(Source):
                 print("write failed %s: %r"%(e,v))
                 self.leg._sourceDone(self)
 
-def convertToSource(thing, mode='r'):
+class MappedFileSource(FileSource):
+    """ A FileSource for playing .wav, .au or raw files. The whole file is
+        mapped when it's opened - see aufile.mapAudioFile - so read()
+        never waits on the disk, and returns views of the mapping rather
+        than copies. A file that has to be converted first is converted
+        in a thread, and plays silence until it's ready.
+    """
+
+    def __init__(self, filename):
+        from shtoom.audio.aufile import mapAudioFileLater
+        self._filename = filename
+        self._pcm = None
+        self._failed = False
+        self._closed = False
+        self._pos = 0
+        super(MappedFileSource, self).__init__(None, 'r')
+        d = self._ready = mapAudioFileLater(filename)
+        d.addCallbacks(self._mapped, self._mapFailed)
+
+    def _mapped(self, pcm):
+        if not self._closed:
+            self._pcm = pcm
+
+    def _mapFailed(self, failure):
+        log.msg("can't play %s: %s"%(self._filename,
+                        failure.getErrorMessage()), system='doug')
+        self._failed = True
+
+    def close(self):
+        self._closed = True
+        self._pcm = None
+
+    def read(self):
+        if self._pcm is None:
+            if self._failed:
+                self._failed = False
+                self.leg._sourceDone(self)
+            return b''
+        pos = self._pos
+        bytes = self._pcm[pos:pos+320]
+        if not bytes:
+            self.leg._sourceDone(self)
+            return b''
+        self._pos = pos + 320
+        return bytes
+
+    def write(self, bytes):
+        pass
+
+    def __repr__(self):
+        return '<MappedFileSource %s at %x>'%(self._filename, id(self))
+
+def convertToSource(thing, mode='r', format=None):
+    """ Turn thing (a Source or a filename) into a Source. If format is
+        given and the file's a prompt, it's served already encoded in that
+        format, from the prompt cache, once it's been encoded. Files
+        opened for writing are recorded by a RecordingSink.
+    """
     if isinstance(thing, Source):
         return thing
-    elif isinstance(thing, basestring):
+    elif isinstance(thing, str):
+        if mode == 'r' and format is not None:
+            from shtoom.doug.promptcache import getPromptCache
+            from shtoom.doug.promptcache import CachedPromptSource
+            from shtoom.audio.converters import known_formats
+            cache = getPromptCache()
+            if format in known_formats and cache.isCacheable(thing):
+                prompt = cache.lookup(thing, format)
+                if prompt is not None:
+                    return CachedPromptSource(thing, prompt)
         if mode == 'r':
-            fp = open(thing, 'rb')
+            return MappedFileSource(thing)
         elif mode == 'w':
-            fp = open(thing, 'wb')
+            from shtoom.doug.recorder import RecordingSink
+            return RecordingSink(thing)
         else:
             raise ValueError("mode must be r or w")
     else:
         raise ValueError('source must be filename or source, not %r'%(type(thing)))
-    return FileSource(fp, mode)
@@ -72,6 +72,16 @@ class VoiceApp(StateMachine):
         else:
             return leg.leg_incomingRTP(packet)
 
+    def va_incomingNTE(self, packet, callcookie):
+        leg = self.getLeg(callcookie)
+        if leg is not None:
+            leg.leg_incomingNTE(packet)
+
+    def va_relayRTP(self, packet, cookie=None):
+        if cookie is None:
+            cookie = self.__cookie
+        self.__appl.relayRTP(cookie, packet)
+
     def va_outgoingRTP(self, sample, cookie=None):
         if cookie is None:
             cookie = self.__cookie
@@ -169,7 +179,11 @@ class VoiceApp(StateMachine):
     def va_hangupCall(self, cookie):
         self.__appl.dropCall(cookie)
 
-    def connectLegs(self, leg1, leg2=None):
+    def connectLegs(self, leg1, leg2=None, relay=False):
+        """ Bridge two legs together. With relay true (and the same codec
+            on both legs), the RTP is forwarded between the two calls'
+            sockets directly, and this voiceapp won't see it (or any DTMF).
+        """
         from shtoom.doug.leg import Bridge
 
         if leg2 is None:
@@ -178,6 +192,9 @@ class VoiceApp(StateMachine):
             raise ValueError("can't join %r to itself!"%(leg1))
         else:
             b = Bridge(leg1, leg2)
+            if relay and b.passthrough:
+                b.relay = self.__appl.relayLegs(leg1.getCookie(),
+                                                leg2.getCookie())
             return b
 
     def sendDTMF(self, digits, cookie=None, duration=0.1, delay=0.05):
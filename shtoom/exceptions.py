@@ -22,6 +22,8 @@ class     UserBusy(CallFailed):
     sipCode = 600
 
 class     STUNFailed(CallFailed): pass
+class     NoRTPPortsAvailable(CallFailed):
+    sipCode = 503
 class     UserBogosity(CallFailed): pass
 class     HostNotKnown(UserBogosity): pass
 class     InvalidSIPURL(UserBogosity): pass
@@ -32,6 +32,17 @@ def buildOptions(app):
 
     network.add(NumberOption('force_rtp_port',
                             _('force RTP to use this port')))
+    network.add(BooleanOption('rtp_batched_io',
+                    _('batch RTP socket reads and writes (Linux)'), False))
+    network.add(BooleanOption('vad',
+                    _('send comfort noise, not audio, when nobody\'s talking'),
+                    False))
+    network.add(StringOption('rtp_port_range',
+                    _('use RTP ports in this range (e.g. 11000-20000)')))
+    network.add(NumberOption('rtp_port_quarantine',
+                    _('seconds before a released RTP port is reused')))
+    network.add(NumberOption('rtp_socket_pool',
+                    _('share this many sockets between all calls\' RTP')))
     opts.add(network)
 
     identity = OptionGroup('identity', _('Identity Settings'))
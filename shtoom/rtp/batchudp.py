@@ -0,0 +1,341 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+Batched datagram I/O for RTP sockets.
+
+A twisted UDP port calls datagramReceived() once per packet, and each
+transport.write() is a separate system call. With hundreds of RTP streams
+that's a lot of trips through the reactor. BatchedUDPPort drains up to
+batchSize datagrams per reactor wakeup and hands them to the protocol's
+datagramsReceived(list) method in one call; outgoing datagrams are queued
+and flushed together at the end of the reactor iteration.
+
+On Linux we use recvmmsg(2) and sendmmsg(2) through ctypes, so a batch is
+a single system call. Elsewhere (or if the C library is too old) the same
+batching is done with recvfrom()/sendto() loops. Protocols that don't have
+a datagramsReceived() method get the usual per-packet datagramReceived().
+"""
+
+import socket, struct, sys, os
+
+from twisted.internet import udp
+from twisted.python import log
+
+from errno import EAGAIN, EWOULDBLOCK, EINTR, ECONNREFUSED
+
+BATCH_SIZE = 32
+MAX_PACKET_SIZE = 2048
+
+MSG_DONTWAIT = 0x40
+MSG_TRUNC = 0x20
+
+class _MMsgLib:
+    "ctypes glue for recvmmsg(2)/sendmmsg(2)"
+
+    def __init__(self):
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.recvmmsg = libc.recvmmsg
+        self.sendmmsg = libc.sendmmsg
+        self.ctypes = ctypes
+
+        class iovec(ctypes.Structure):
+            _fields_ = [('iov_base', ctypes.c_void_p),
+                        ('iov_len', ctypes.c_size_t)]
+
+        class msghdr(ctypes.Structure):
+            _fields_ = [('msg_name', ctypes.c_void_p),
+                        ('msg_namelen', ctypes.c_uint32),
+                        ('msg_iov', ctypes.POINTER(iovec)),
+                        ('msg_iovlen', ctypes.c_size_t),
+                        ('msg_control', ctypes.c_void_p),
+                        ('msg_controllen', ctypes.c_size_t),
+                        ('msg_flags', ctypes.c_int)]
+
+        class mmsghdr(ctypes.Structure):
+            _fields_ = [('msg_hdr', msghdr),
+                        ('msg_len', ctypes.c_uint)]
+
+        self.iovec, self.mmsghdr = iovec, mmsghdr
+        self._scratch = {}
+
+    def scratch(self, batchSize, packetSize):
+        """ Return (buffer, names, iovecs, msgs) for a batch. These are
+            shared by every port - we're single threaded, and nothing
+            is left in them once a recv or send call returns.
+        """
+        key = (batchSize, packetSize)
+        s = self._scratch.get(key)
+        if s is None:
+            ctypes = self.ctypes
+            buf = ctypes.create_string_buffer(batchSize * packetSize)
+            names = ctypes.create_string_buffer(batchSize * 128)
+            iovs = (self.iovec * batchSize)()
+            msgs = (self.mmsghdr * batchSize)()
+            base = ctypes.addressof(buf)
+            namebase = ctypes.addressof(names)
+            for i in range(batchSize):
+                iovs[i].iov_base = base + i * packetSize
+                iovs[i].iov_len = packetSize
+                hdr = msgs[i].msg_hdr
+                hdr.msg_name = namebase + i * 128
+                hdr.msg_namelen = 128
+                hdr.msg_iov = ctypes.pointer(iovs[i])
+                hdr.msg_iovlen = 1
+            s = self._scratch[key] = (buf, names, iovs, msgs)
+        return s
+
+def _loadMMsg():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        lib = _MMsgLib()
+    except (ImportError, OSError, AttributeError):
+        return None
+    return lib
+
+mmsg = _loadMMsg()
+
+def _unpackSockaddr(name):
+    "Turn a struct sockaddr_in/_in6 into a (host, port) tuple"
+    family, = struct.unpack_from('=H', name)
+    port, = struct.unpack_from('!H', name, 2)
+    if family == socket.AF_INET6:
+        return (socket.inet_ntop(socket.AF_INET6, name[8:24]), port)
+    return (socket.inet_ntop(socket.AF_INET, name[4:8]), port)
+
+def _packSockaddr(addr):
+    host, port = addr[:2]
+    if ':' in host:
+        return (struct.pack('=H', socket.AF_INET6) + struct.pack('!HI', port, 0)
+                + socket.inet_pton(socket.AF_INET6, host) + b'\0' * 4)
+    return (struct.pack('=H', socket.AF_INET) + struct.pack('!H', port)
+            + socket.inet_aton(host) + b'\0' * 8)
+
+
+class BatchedUDPPort(udp.Port):
+    """ A UDP port that reads and writes datagrams in batches.
+
+        The protocol's datagramsReceived() (if it has one) is called with
+        a list of (datagram, addr) tuples. Writes are queued and sent
+        when the reactor gets back to us, or when batchSize datagrams are
+        waiting, whichever is first.
+    """
+
+    # Counters, for the curious
+    readBatches = 0
+    writeBatches = 0
+    dropped = 0
+    # Received datagrams bigger than maxPacketSize, which are dropped
+    truncated = 0
+    # Datagrams written that were too big to batch, and sent on their own
+    oversize = 0
+
+    def __init__(self, port, proto, interface='',
+                 maxPacketSize=MAX_PACKET_SIZE, reactor=None,
+                 batchSize=BATCH_SIZE, useMMsg=True):
+        udp.Port.__init__(self, port, proto, interface, maxPacketSize,
+                          reactor)
+        self.batchSize = batchSize
+        if useMMsg:
+            self._mmsg = mmsg
+        else:
+            self._mmsg = None
+        self._sendQueue = []
+        self._flushCall = None
+        self._sockaddrs = {}
+
+    def doRead(self):
+        "Called when my socket is ready for reading."
+        try:
+            if self._mmsg is not None:
+                batch = self._recvmmsg()
+            else:
+                batch = self._recvfrom()
+        except socket.error as se:
+            no = se.args[0]
+            if no in udp._sockErrReadRefuse:
+                if self._connectedAddr:
+                    self.protocol.connectionRefused()
+                return
+            raise
+        if not batch:
+            return
+        self.readBatches += 1
+        datagramsReceived = getattr(self.protocol, 'datagramsReceived', None)
+        if datagramsReceived is not None:
+            try:
+                datagramsReceived(batch)
+            except:
+                log.err()
+        else:
+            for datagram, addr in batch:
+                try:
+                    self.protocol.datagramReceived(datagram, addr)
+                except:
+                    log.err()
+
+    def _recvfrom(self):
+        batch = []
+        recvfrom = self.socket.recvfrom
+        # Ask for one more byte than we'll take, to spot ones that are
+        # too big
+        size = self.maxPacketSize + 1
+        while len(batch) < self.batchSize:
+            try:
+                datagram, addr = recvfrom(size)
+            except socket.error as se:
+                if se.args[0] in udp._sockErrReadIgnore:
+                    break
+                raise
+            if len(datagram) == size:
+                self.truncated += 1
+                continue
+            batch.append((datagram, addr[:2]))
+        return batch
+
+    def _recvmmsg(self):
+        lib = self._mmsg
+        ctypes = lib.ctypes
+        buf, names, iovs, msgs = lib.scratch(self.batchSize,
+                                             self.maxPacketSize)
+        for i in range(self.batchSize):
+            msgs[i].msg_hdr.msg_namelen = 128
+        while True:
+            n = lib.recvmmsg(self.fileno(), msgs, self.batchSize,
+                             MSG_DONTWAIT, None)
+            if n >= 0:
+                break
+            err = ctypes.get_errno()
+            if err == EINTR:
+                continue
+            elif err in (EAGAIN, EWOULDBLOCK):
+                return []
+            raise socket.error(err, os.strerror(err))
+        batch = []
+        string_at = ctypes.string_at
+        bufaddr = ctypes.addressof(buf)
+        nameaddr = ctypes.addressof(names)
+        for i in range(n):
+            if msgs[i].msg_hdr.msg_flags & MSG_TRUNC:
+                self.truncated += 1
+                continue
+            datagram = string_at(bufaddr + i * self.maxPacketSize,
+                                 msgs[i].msg_len)
+            addr = _unpackSockaddr(string_at(nameaddr + i * 128, 28))
+            batch.append((datagram, addr))
+        return batch
+
+    def write(self, datagram, addr=None):
+        """ Queue a datagram for sending. It's copied, so callers may
+            reuse their buffer as soon as this returns.
+        """
+        if self._connectedAddr:
+            addr = None
+        elif addr is None:
+            raise ValueError("need an address for an unconnected port")
+        if len(datagram) > self.maxPacketSize:
+            # Too big for a slot in the batch buffer. Send it on its own,
+            # after anything that's already queued.
+            self.oversize += 1
+            self.flush()
+            if self.socket is not None:
+                self._sendto([(bytes(datagram), addr)])
+            return
+        self._sendQueue.append((bytes(datagram), addr))
+        if len(self._sendQueue) >= self.batchSize:
+            self.flush()
+        elif self._flushCall is None:
+            self._flushCall = self.reactor.callLater(0, self.flush)
+
+    def flush(self):
+        "Send everything that's queued."
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        queue, self._sendQueue = self._sendQueue, []
+        if not queue or self.socket is None:
+            return
+        self.writeBatches += 1
+        while queue:
+            batch, queue = queue[:self.batchSize], queue[self.batchSize:]
+            if self._mmsg is not None:
+                self._sendmmsg(batch)
+            else:
+                self._sendto(batch)
+
+    def _sendto(self, batch):
+        for datagram, addr in batch:
+            try:
+                if addr is None:
+                    self.socket.send(datagram)
+                else:
+                    self.socket.sendto(datagram, addr)
+            except socket.error as se:
+                if se.args[0] == ECONNREFUSED and self._connectedAddr:
+                    self.protocol.connectionRefused()
+                    return
+                self.dropped += 1
+
+    def _sendmmsg(self, batch):
+        lib = self._mmsg
+        ctypes = lib.ctypes
+        buf, names, iovs, msgs = lib.scratch(self.batchSize,
+                                             self.maxPacketSize)
+        bufaddr = ctypes.addressof(buf)
+        nameaddr = ctypes.addressof(names)
+        for i, (datagram, addr) in enumerate(batch):
+            ctypes.memmove(bufaddr + i * self.maxPacketSize, datagram,
+                           len(datagram))
+            iovs[i].iov_len = len(datagram)
+            hdr = msgs[i].msg_hdr
+            if addr is None:
+                hdr.msg_name = None
+                hdr.msg_namelen = 0
+            else:
+                name = self._sockaddrs.get(addr)
+                if name is None:
+                    name = self._sockaddrs[addr] = _packSockaddr(addr)
+                ctypes.memmove(nameaddr + i * 128, name, len(name))
+                hdr.msg_name = nameaddr + i * 128
+                hdr.msg_namelen = len(name)
+        sent = 0
+        try:
+            while sent < len(batch):
+                n = lib.sendmmsg(self.fileno(), ctypes.byref(msgs[sent]),
+                                 len(batch) - sent, MSG_DONTWAIT)
+                if n < 0:
+                    err = ctypes.get_errno()
+                    if err == EINTR:
+                        continue
+                    if err == ECONNREFUSED and self._connectedAddr:
+                        self.protocol.connectionRefused()
+                    # The rest of this batch is lost. It's UDP.
+                    self.dropped += len(batch) - sent
+                    break
+                sent += n
+        finally:
+            # Put the scratch area back the way recvmmsg expects it.
+            for i in range(len(batch)):
+                iovs[i].iov_len = self.maxPacketSize
+                msgs[i].msg_hdr.msg_name = nameaddr + i * 128
+
+    def connectionLost(self, reason=None):
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        self._sendQueue = []
+        udp.Port.connectionLost(self, reason)
+
+
+def listenBatchedUDP(port, protocol, interface='',
+                     maxPacketSize=MAX_PACKET_SIZE, reactor=None,
+                     batchSize=BATCH_SIZE):
+    """ Like reactor.listenUDP, but returns a BatchedUDPPort.
+    """
+    p = BatchedUDPPort(port, protocol, interface, maxPacketSize, reactor,
+                       batchSize)
+    p.startListening()
+    return p
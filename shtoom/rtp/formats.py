@@ -114,6 +114,8 @@ class SDPGenerator:
         md.addRtpMap(PT_PCMU)
         md.addRtpMap(PT_CN)
         md.addRtpMap(PT_NTE)
+        if getattr(rtp, 'rtcpMux', False):
+            md.addAttribute('rtcp-mux')
         return s
 
 RTPDict = {}
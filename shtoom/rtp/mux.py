@@ -0,0 +1,271 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+Shared RTP sockets.
+
+Normally every call gets its own pair of UDP ports (RTP and RTCP). With
+thousands of calls that's thousands of file descriptors, and finding a
+free pair gets slow. In pooled mode a small, fixed set of sockets carries
+the media for every call: inbound packets are routed to the right
+RTPProtocol by (remote address, SSRC), and RTCP is multiplexed onto the
+RTP port (RFC 5761, negotiated with a=rtcp-mux in the SDP). Each RTP
+socket's odd neighbour is bound too, for peers that don't do rtcp-mux
+and send their RTCP there.
+"""
+
+import struct
+
+from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
+from twisted.internet.protocol import DatagramProtocol
+from twisted.python import log
+
+_ssrcAt = struct.Struct('!I').unpack_from
+
+def isRTCP(datagram):
+    """ RFC 5761, section 4: an RTCP packet has a second octet in the
+        range 192-223 (RTCP packet types 200-204, mostly). RTP payload
+        types 64-95 would clash, so they must not be used with muxing.
+    """
+    return 192 <= datagram[1] <= 223
+
+
+class MuxedTransport:
+    """ The transport an RTPProtocol sees when its media is going over a
+        shared socket. Looks enough like a twisted UDP port for the
+        RTPProtocol not to care.
+    """
+
+    def __init__(self, demux, session):
+        self.demux = demux
+        self.session = session
+        self.dest = None
+
+    def write(self, datagram, addr=None):
+        if addr is None:
+            addr = self.dest
+        return self.demux.transport.write(datagram, addr)
+
+    def connect(self, host, port):
+        "Start accepting packets from (host, port) for this session"
+        self.dest = (host, port)
+        self.demux.expect(self.session, self.dest)
+        if not getattr(self.session, 'rtcpMux', True):
+            # Their RTCP comes from the port above
+            self.demux.expect(self.session, (host, port + 1))
+
+    def getHost(self):
+        return self.demux.transport.getHost()
+
+    def stopListening(self):
+        # The socket itself stays open for the next call
+        self.demux.removeSession(self.session)
+
+
+class RTPDemultiplexer(DatagramProtocol):
+    """ Receives RTP and RTCP for many sessions on one socket, and passes
+        each packet to the session it belongs to.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool
+        # (addr, ssrc) -> session, for streams we've seen
+        self._bySource = {}
+        # addr -> [session, ...], every session expecting packets from
+        # that address, oldest first
+        self._byAddr = {}
+        # session -> {addr: ssrc}, the stream each session last got from
+        # each of its addresses (None if nothing yet)
+        self._streams = {}
+        self.unknown = 0
+
+    def sessionCount(self):
+        return len(self._streams)
+
+    def addSession(self, session):
+        self._streams[session] = {}
+        return MuxedTransport(self, session)
+
+    def expect(self, session, addr):
+        "session is about to receive packets from addr"
+        streams = self._streams[session]
+        if addr not in streams:
+            streams[addr] = None
+            self._byAddr.setdefault(addr, []).append(session)
+
+    def removeSession(self, session):
+        for addr, ssrc in self._streams.pop(session, {}).items():
+            if self._bySource.get((addr, ssrc)) is session:
+                del self._bySource[(addr, ssrc)]
+            waiting = self._byAddr.get(addr)
+            if waiting and session in waiting:
+                waiting.remove(session)
+                if not waiting:
+                    del self._byAddr[addr]
+
+    def _route(self, addr, ssrc):
+        session = self._bySource.get((addr, ssrc))
+        if session is not None:
+            return session
+        waiting = self._byAddr.get(addr)
+        if not waiting:
+            return None
+        if len(waiting) == 1:
+            # The only session talking to that address. Whatever comes
+            # from there is theirs - the far end may have changed SSRC
+            # (a transfer, or a media server switching streams).
+            session = waiting[0]
+        else:
+            # Several calls to the same far end address. A new stream
+            # goes to the session that's been waiting longest for one;
+            # if they've all got one, there's no telling whose it is.
+            for session in waiting:
+                if self._streams[session][addr] is None:
+                    break
+            else:
+                return None
+        streams = self._streams[session]
+        old = streams[addr]
+        if old is not None and self._bySource.get((addr, old)) is session:
+            del self._bySource[(addr, old)]
+        streams[addr] = ssrc
+        self._bySource[(addr, ssrc)] = session
+        return session
+
+    def datagramReceived(self, datagram, addr):
+        if len(datagram) < 8:
+            self.unknown += 1
+            return
+        if isRTCP(datagram):
+            # Sender SSRC directly follows the RTCP header
+            session = self._route(addr, _ssrcAt(datagram, 4)[0])
+            if session is not None:
+                session.RTCP.datagramReceived(datagram, addr)
+                return
+        elif len(datagram) >= 12:
+            session = self._route(addr, _ssrcAt(datagram, 8)[0])
+            if session is not None:
+                session.datagramReceived(datagram, addr)
+                return
+        self.unknown += 1
+
+    def datagramsReceived(self, datagrams):
+        datagramReceived = self.datagramReceived
+        for datagram, addr in datagrams:
+            datagramReceived(datagram, addr)
+
+
+class _RTCPPort(DatagramProtocol):
+    "The odd port above a pooled RTP socket, for RTCP from non-mux peers"
+
+    def __init__(self, demux):
+        self.demux = demux
+
+    def datagramReceived(self, datagram, addr):
+        self.demux.datagramReceived(datagram, addr)
+
+
+class RTPSocketPool:
+    """ A fixed set of RTP sockets, shared between calls.
+
+        size sockets are opened on even ports from the port allocator, or
+        on even ports from basePort up (skipping any that are in use) if
+        basePort is given, each with an RTCP socket on the port above.
+        Each new session goes to the least loaded socket.
+    """
+
+    def __init__(self, size, basePort=None, interface='', listenUDP=None,
+                 allocator=None):
+        self.size = size
+        # 0 (no force_rtp_port) means use the allocator
+        self.basePort = basePort or None
+        if allocator is None and self.basePort is None:
+            from shtoom.rtp.ports import getPortAllocator
+            allocator = getPortAllocator()
+        self.allocator = allocator
+        self.interface = interface
+        if listenUDP is None:
+            listenUDP = reactor.listenUDP
+        self._listenUDP = listenUDP
+        self._demuxers = []
+        self._listeners = []
+        self._rtcpListeners = []
+
+    def start(self):
+        port = self.basePort
+        if port is not None and port % 2:
+            port += 1
+        while len(self._demuxers) < self.size:
+            if self.basePort is None:
+                port = self.allocator.allocate()
+            demux = RTPDemultiplexer(self)
+            try:
+                listener = self._listenUDP(port, demux,
+                                           interface=self.interface)
+            except CannotListenError:
+                if self.basePort is None:
+                    self.allocator.markBusy(port)
+                else:
+                    port += 2
+                continue
+            try:
+                rtcpListener = self._listenUDP(port + 1, _RTCPPort(demux),
+                                               interface=self.interface)
+            except CannotListenError:
+                listener.stopListening()
+                if self.basePort is None:
+                    self.allocator.markBusy(port)
+                else:
+                    port += 2
+                continue
+            self._demuxers.append(demux)
+            self._listeners.append(listener)
+            self._rtcpListeners.append(rtcpListener)
+            if self.basePort is not None:
+                port += 2
+        log.msg("RTP socket pool listening on %r"%(
+                        [l.getHost().port for l in self._listeners]),
+                        system='rtp')
+
+    def stop(self):
+        for l in self._rtcpListeners:
+            l.stopListening()
+        for l in self._listeners:
+            port = l.getHost().port
+            l.stopListening()
+            if self.basePort is None:
+                self.allocator.release(port)
+        self._demuxers = []
+        self._listeners = []
+        self._rtcpListeners = []
+
+    def allocate(self, session):
+        "Returns a transport for session on one of the pool's sockets"
+        if not self._demuxers:
+            self.start()
+        demux = min(self._demuxers, key=lambda d: d.sessionCount())
+        return demux.addSession(session)
+
+    def sessionCount(self):
+        return sum([d.sessionCount() for d in self._demuxers])
+
+
+_pool = None
+
+def getSocketPool(app=None):
+    """ Return the process-wide RTP socket pool, or None if pooling isn't
+        turned on (the rtp_socket_pool preference).
+    """
+    from shtoom.rtp.ports import getPortAllocator
+    global _pool
+    if _pool is None and app is not None:
+        size = app.getPref('rtp_socket_pool')
+        if size:
+            listenUDP = None
+            if app.getPref('rtp_batched_io'):
+                from shtoom.rtp.batchudp import listenBatchedUDP
+                listenUDP = listenBatchedUDP
+            _pool = RTPSocketPool(size, app.getPref('force_rtp_port'),
+                                  listenUDP=listenUDP,
+                                  allocator=getPortAllocator(app))
+    return _pool
@@ -7,11 +7,11 @@ class RTPPacket:
     """ Contains RTP data. """
     class Header:
         def __init__(self, ssrc, pt, ct, seq, ts, marker=0,
-                     xhdrtype=None, xhdrdata=''):
+                     xhdrtype=None, xhdrdata=b''):
             """
             If xhdrtype is not None then it is required to be an
             int >= 0 and < 2**16 and xhdrdata is required to be
-            a string whose length is a multiple of 4.
+            a bytes object whose length is a multiple of 4.
             """
             assert isinstance(ts, (int)), "ts: %s :: %s" % (ts, type(ts))
             assert isinstance(ssrc, (int))
@@ -19,7 +19,7 @@ class RTPPacket:
                     and xhdrtype >= 0 and xhdrtype < 2**16
             # Sorry, RFC standard specifies that len is in 4-byte words,
             # and I'm not going to do the padding and unpadding for you.
-            assert xhdrtype is None or (isinstance(xhdrdata, str) and \
+            assert xhdrtype is None or (isinstance(xhdrdata, bytes) and \
                     len(xhdrdata) % 4 == 0), \
                     "xhdrtype: %s, len(xhdrdata): %s, xhdrdata: %s" % (
                     xhdrtype, len(xhdrdata), 'xhdrdata',)
@@ -38,17 +38,17 @@ class RTPPacket:
             if self.xhdrtype is not None:
                 firstbyte = 0x90
                 xhdrnetbytes = struct.pack('!HH', self.xhdrtype,
-                                    len(self.xhdrdata)/4) + self.xhdrdata
+                                    len(self.xhdrdata)//4) + self.xhdrdata
             else:
                 firstbyte = 0x80
-                xhdrnetbytes = ''
+                xhdrnetbytes = b''
             return struct.pack('!BBHII', firstbyte,
                                         self.pt | self.marker << 7,
                                         self.seq % 2**16,
                                         self.ts, self.ssrc) + xhdrnetbytes
 
     def __init__(self, ssrc, seq, ts, data, pt=None, ct=None, marker=0,
-                 authtag='', xhdrtype=None, xhdrdata=''):
+                 authtag=b'', xhdrtype=None, xhdrdata=b''):
         assert pt is None or isinstance(pt, int) and pt >= 0 and pt < 2**8, \
             "pt is required to be a simple byte, suitable for stuffing " + \
             "into an RTP packet and sending. pt: %s" % pt
@@ -80,48 +80,144 @@ class RTPPacket:
         "Return network-formatted packet."
         return self.header.netbytes() + self.data + self.authtag
 
-def parse_rtppacket(bytes, authtaglen=0):
-    # Most variables are named for the fields in the RTP RFC.
-    hdrpieces = struct.unpack('!BBHII', bytes[:12])
+_RTPHeader = struct.Struct('!BBHII')
+_RTPExtHeader = struct.Struct('!HH')
+
+class RTPFrame(object):
+    """ A compact, parsed RTP packet.
+
+        The payload is a memoryview onto the datagram it was parsed from,
+        so no audio is copied during parsing. RTPFrame quacks enough like
+        an RTPPacket (frame.header is the frame itself, frame.data gives
+        the payload as bytes) to be passed to code expecting one.
+    """
+    __slots__ = ('ssrc', 'pt', 'ct', 'seq', 'ts', 'marker', 'payload',
+                 'authtag', 'xhdrtype', 'xhdrdata', '_data')
+
+    def __init__(self, ssrc, pt, seq, ts, marker, payload, authtag=b'',
+                 xhdrtype=None, xhdrdata=None, ct=None):
+        self.ssrc = ssrc
+        self.pt = pt
+        self.ct = ct
+        self.seq = seq
+        self.ts = ts
+        self.marker = marker
+        self.payload = payload
+        self.authtag = authtag
+        self.xhdrtype = xhdrtype
+        self.xhdrdata = xhdrdata
+        self._data = None
+
+    @property
+    def header(self):
+        return self
+
+    def _getData(self):
+        # Only copy the payload out of the datagram if someone asks.
+        if self._data is None:
+            self._data = bytes(self.payload)
+        return self._data
+
+    def _setData(self, data):
+        self._data = None
+        self.payload = data
+
+    data = property(_getData, _setData)
+
+    def toRTPPacket(self):
+        "Return an old-style RTPPacket holding a copy of this frame"
+        if self.xhdrdata is not None:
+            xhdrdata = bytes(self.xhdrdata)
+        else:
+            xhdrdata = None
+        packet = RTPPacket(self.ssrc, self.seq, self.ts, self.data,
+                           pt=self.pt, ct=self.ct, marker=self.marker,
+                           authtag=bytes(self.authtag),
+                           xhdrtype=self.xhdrtype, xhdrdata=xhdrdata)
+        return packet
+
+    def __repr__(self):
+        if self.ct is not None:
+            ptrepr = "%r" % (self.ct,)
+        else:
+            ptrepr = "pt %s" % (self.pt,)
+        return "<%s #%d %s at %x>"%(self.__class__.__name__, self.seq,
+                                    ptrepr, id(self))
 
+def parse_rtpframe(datagram, authtaglen=0, unpack=_RTPHeader.unpack_from):
+    """ Parse an RTP datagram into an RTPFrame without copying the payload.
+
+        datagram may be bytes, a bytearray or a memoryview. The frame's
+        payload, authtag and extension data are views into it.
+    """
+    view = memoryview(datagram)
+    # Most variables are named for the fields in the RTP RFC.
+    b0, b1, seq, ts, ssrc = unpack(view)
     # XXX we ignore v (version)
-    # Padding?
-    p = (hdrpieces[0] & 32) and 1 or 0
-    # Extension header present?
-    x = (hdrpieces[0] & 16) and 1 or 0
-    # CSRC Count
-    cc = hdrpieces[0] & 15
-    # Marker bit
-    marker = hdrpieces[1] & 128
-    # Payload type
-    pt = hdrpieces[1] & 127
-    # Sequence number
-    seq = hdrpieces[2]
-    # Timestamp
-    ts = hdrpieces[3]
-    ssrc = hdrpieces[4]
-    headerlen = 12 + cc * 4
     # XXX throwing away csrc info for now
-    bytes = bytes[headerlen:]
-    if x:
+    start = 12 + (b0 & 15) * 4
+    end = len(view)
+    if b0 & 16:
         # Only one extension header
-        (xhdrtype, xhdrlen,) = struct.unpack('!HH', bytes[:4])
-        xhdrdata = bytes[4:4+xhdrlen*4]
-        bytes = bytes[xhdrlen*4 + 4:]
+        xhdrtype, xhdrlen = _RTPExtHeader.unpack_from(view, start)
+        xhdrdata = view[start+4:start+4+xhdrlen*4]
+        start = start + 4 + xhdrlen*4
     else:
         xhdrtype, xhdrdata = None, None
     if authtaglen:
-        authtag = bytes[-authtaglen:]
-        bytes = bytes[:-authtaglen]
+        end = end - authtaglen
+        authtag = view[end:]
     else:
-        authtag = ''
-    if p:
-        # padding
-        padlen = struct.unpack('!B', bytes[-1])[0]
-        if padlen:
-            bytes = bytes[:-padlen]
-    return RTPPacket(ssrc, seq, ts, bytes, marker=marker, pt=pt,
-                     authtag=authtag, xhdrtype=xhdrtype, xhdrdata=xhdrdata)
+        authtag = b''
+    if b0 & 32:
+        # padding - the last octet of the payload is the pad count
+        end = end - view[end-1]
+    return RTPFrame(ssrc, b1 & 127, seq, ts, b1 >> 7, view[start:end],
+                    authtag, xhdrtype, xhdrdata)
+
+def parse_rtppacket(bytes, authtaglen=0):
+    "Parse an RTP datagram into an RTPPacket. See also parse_rtpframe."
+    return parse_rtpframe(bytes, authtaglen).toRTPPacket()
+
+
+_RTPSeqTS = struct.Struct('!BHI')
+
+class RTPSendTemplate(object):
+    """ A send-side RTP header for one stream and payload type.
+
+        The version, payload type and SSRC are packed once. packet()
+        patches in the marker bit, sequence number and timestamp and
+        copies the payload in behind them, in a buffer that is reused
+        for every packet. The memoryview it returns is only good until
+        the next call to packet() - write it out straight away.
+    """
+    __slots__ = ('ssrc', 'pt', '_buf', '_view')
+
+    def __init__(self, ssrc, pt, size=512):
+        assert isinstance(pt, int) and pt >= 0 and pt < 2**7, \
+            "pt is required to be a 7 bit payload type. pt: %s" % pt
+        self.ssrc = ssrc
+        self.pt = pt
+        self._buf = None
+        self._view = None
+        self._grow(size)
+
+    def _grow(self, size):
+        # Anyone still holding a view of the old buffer keeps it alive.
+        self._buf = bytearray(size)
+        _RTPHeader.pack_into(self._buf, 0, 0x80, self.pt, 0, 0, self.ssrc)
+        self._view = memoryview(self._buf)
+
+    def packet(self, seq, ts, data, marker=0):
+        "Return a view of the network-formatted packet."
+        end = 12 + len(data)
+        if end > len(self._buf):
+            self._grow(end * 2)
+        buf = self._buf
+        _RTPSeqTS.pack_into(buf, 1, self.pt | (marker and 128),
+                            seq & 0xffff, ts & 0xffffffff)
+        buf[12:end] = data
+        return self._view[:end]
 
 
 class NTE:
@@ -133,16 +229,16 @@ class NTE:
         self.counter = 3
         self.key = key
         if key >= '0' and key <= '9':
-            self._payKey = chr(int(key))
+            self._payKey = bytes([int(key)])
         elif key == '*':
-            self._payKey = chr(10)
+            self._payKey = b'\x0a'
         elif key == '#':
-            self._payKey = chr(11)
+            self._payKey = b'\x0b'
         elif key >= 'A' and key <= 'D':
             # A - D are 12-15
-            self._payKey = chr(ord(key)-53)
+            self._payKey = bytes([ord(key)-53])
         elif key == 'flash':
-            self._payKey = chr(16)
+            self._payKey = b'\x10'
         else:
             raise ValueError("%s is not a valid NTE"%(key))
 
@@ -159,7 +255,7 @@ class NTE:
                 end = 128
             else:
                 end = 0
-            payload = self._payKey + chr(10|end) + \
+            payload = self._payKey + bytes([10|end]) + \
                                 struct.pack('!H', ts - self.startTS)
             self.counter -= 1
             return payload
@@ -0,0 +1,126 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+RTP port allocation.
+
+RTP wants an even port, with RTCP on the odd port above it. Rather than
+picking a random port and probing upwards until a bind works, we keep a
+free list of even ports in a configured range. Released ports sit in
+quarantine for a while before they're handed out again, so that stray
+packets from the previous call don't turn up in the next one.
+"""
+
+import time
+from collections import deque
+
+from shtoom.exceptions import NoRTPPortsAvailable
+
+DEFAULT_RANGE = (11000, 20000)
+DEFAULT_QUARANTINE = 8.0
+
+class PortAllocator:
+    """ Hands out even RTP ports (the odd port above is for RTCP) from
+        the range [low, high].
+
+        allocate(), release() and markBusy() are all O(1) (amortised).
+    """
+
+    def __init__(self, low=DEFAULT_RANGE[0], high=DEFAULT_RANGE[1],
+                 quarantine=DEFAULT_QUARANTINE, clock=time.time):
+        if low % 2:
+            low += 1
+        if high < low + 1:
+            raise ValueError("port range %d-%d is too small"%(low, high))
+        self.low = low
+        self.high = high
+        self.quarantine = quarantine
+        self._clock = clock
+        self._free = deque(range(low, high, 2))
+        # (time it can be reused, port), oldest first
+        self._quarantined = deque()
+        self._inuse = set()
+        self.allocations = 0
+        self.bindFailures = 0
+        self.exhausted = 0
+
+    def _reap(self):
+        now = self._clock()
+        q = self._quarantined
+        while q and q[0][0] <= now:
+            self._free.append(q.popleft()[1])
+
+    def allocate(self):
+        "Returns an even port number. Raises NoRTPPortsAvailable."
+        self._reap()
+        if not self._free:
+            self.exhausted += 1
+            raise NoRTPPortsAvailable("no free RTP ports in %d-%d"%(
+                                                    self.low, self.high))
+        port = self._free.popleft()
+        self._inuse.add(port)
+        self.allocations += 1
+        return port
+
+    def release(self, port):
+        "The call using port (and port+1) is done with it"
+        if port not in self._inuse:
+            raise ValueError("port %d was not allocated"%(port,))
+        self._inuse.remove(port)
+        self._quarantined.append((self._clock() + self.quarantine, port))
+
+    def markBusy(self, port):
+        """ We couldn't bind to port (someone else has it). Put it to one
+            side for a quarantine period, and try another.
+        """
+        self.bindFailures += 1
+        self.release(port)
+
+    def inUse(self):
+        return len(self._inuse)
+
+    def free(self):
+        self._reap()
+        return len(self._free)
+
+    def quarantined(self):
+        self._reap()
+        return len(self._quarantined)
+
+    def getStats(self):
+        return { 'inuse': self.inUse(),
+                 'free': self.free(),
+                 'quarantined': self.quarantined(),
+                 'allocations': self.allocations,
+                 'bindfailures': self.bindFailures,
+                 'exhausted': self.exhausted,
+               }
+
+    def __repr__(self):
+        return "<%s %d-%d, %d in use, %d free at %x>"%(
+                            self.__class__.__name__, self.low, self.high,
+                            self.inUse(), self.free(), id(self))
+
+
+def parsePortRange(text):
+    "'11000-20000' -> (11000, 20000)"
+    low, high = text.split('-', 1)
+    return int(low), int(high)
+
+_allocator = None
+
+def getPortAllocator(app=None):
+    """ Return the process-wide port allocator, configured from app's
+        rtp_port_range and rtp_port_quarantine preferences the first
+        time it's asked for.
+    """
+    global _allocator
+    if _allocator is None:
+        low, high = DEFAULT_RANGE
+        quarantine = DEFAULT_QUARANTINE
+        if app is not None:
+            if app.getPref('rtp_port_range'):
+                low, high = parsePortRange(app.getPref('rtp_port_range'))
+            if app.getPref('rtp_port_quarantine') is not None:
+                quarantine = app.getPref('rtp_port_quarantine')
+        _allocator = PortAllocator(low, high, quarantine)
+    return _allocator
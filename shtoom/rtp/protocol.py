@@ -3,7 +3,8 @@
 # $Id: rtp.py,v 1.40 2004/03/07 14:41:39 anthony Exp $
 #
 
-import struct, sys, random, os, md5, socket
+import struct, sys, random, os, socket
+from hashlib import md5
 from time import sleep, time
 
 from twisted.internet import reactor, defer
@@ -11,12 +12,15 @@ from twisted.internet.protocol import DatagramProtocol
 from twisted.python import log
 
 from shtoom.rtp.formats import SDPGenerator, PT_CN, PT_xCN, PT_NTE, PT_PCMU
-from shtoom.rtp.packets import RTPPacket, parse_rtppacket
+from shtoom.rtp.packets import RTPPacket, parse_rtppacket, parse_rtpframe
+from shtoom.rtp.packets import RTPSendTemplate
+from shtoom.rtp.ports import getPortAllocator
 from shtoom.audio.converters import MediaSample
+from shtoom.exceptions import NoRTPPortsAvailable
 
-TWO_TO_THE_16TH = 2L<<16
-TWO_TO_THE_32ND = 2L<<32
-TWO_TO_THE_48TH = 2L<<48
+TWO_TO_THE_16TH = 2<<16
+TWO_TO_THE_32ND = 2<<32
+TWO_TO_THE_48TH = 2<<48
 
 from shtoom.rtp.packets import NTE
 
@@ -42,13 +46,41 @@ class RTPProtocol(DatagramProtocol):
         self.seq = self.genRandom(bits=16)
         self.ts = self.genInitTS()
         self.ssrc = self.genSSRC()
+        # Precompiled send-side headers, keyed by PT
+        self._sendTemplates = {}
         self._silent = None
+        # What we send as comfort noise - the noise level, as last given
+        # to us by the audio layer (RFC 3389)
+        self._cnPayload = b'\x7f'
+        # RTCP on the RTP port (RFC 5761)? Only when using a socket pool.
+        self.rtcpMux = False
+        # Port we got from the port allocator, to give back when we're done
+        self._allocatedPort = None
+        # Stream we're relaying (see relay_packet), the offsets from its
+        # seq and ts to ours, its last seq and ts, and how far its ts
+        # moves each packet
+        self._relaySSRC = None
+        self._relaySeq = 0
+        self._relayTS = 0
+        self._relayLast = None
+        self._relayStep = 160
+        # RTPRelay that has our socket, if any (see relay.py)
+        self._relay = None
         # only for debugging -- the way to prevent the sending of RTP packets
         # onto the Net is to reopen the audio device with a None (default)
         # media sample handler instead of this RTP object as the media sample handler.
         self.sending = False
 
     def getSDP(self, othersdp=None):
+        if othersdp and self.rtcpMux:
+            md = othersdp.getMediaDescription('audio')
+            if md is None or not md.hasAttribute('rtcp-mux'):
+                # Their RTCP goes to the port above our shared socket,
+                # which the pool keeps for just that
+                log.msg("other end doesn't do rtcp-mux, RTCP for %r on "
+                        "port %d"%(self.cookie, self._extRTPPort + 1),
+                        system='rtp')
+                self.rtcpMux = False
         sdp = SDPGenerator().getSDP(self)
         if othersdp:
             sdp.intersect(othersdp)
@@ -86,22 +118,41 @@ class RTPProtocol(DatagramProtocol):
     def _socketCreationAttempt(self, locIP=None):
         from twisted.internet.error import CannotListenError
         from shtoom.rtp import rtcp
+        from shtoom.rtp.mux import getSocketPool
         self.RTCP = rtcp.RTCPProtocol()
 
+        pool = getSocketPool(self.app)
+        if pool is not None:
+            return self._joinSocketPool(pool, locIP)
+
+        listenUDP = reactor.listenUDP
+        if self.app.getPref('rtp_batched_io'):
+            from shtoom.rtp.batchudp import listenBatchedUDP
+            listenUDP = listenBatchedUDP
+
         # RTP port must be even, RTCP must be odd
-        # We select a RTP port at random, and try to get a pair of ports
-        # next to each other. What fun!
         # Note that it's kinda pointless when we're behind a NAT that
         # rewrites ports. We can at least send RTCP out in that case,
         # but there's no way we'll get any back.
         rtpPort = self.app.getPref('force_rtp_port')
         if not rtpPort:
-            rtpPort = 11000 + random.randint(0, 9000)
+            try:
+                rtpPort = self._allocatePorts(listenUDP)
+            except NoRTPPortsAvailable as e:
+                log.msg("can't start RTP: %s"%(e,), system='rtp')
+                d = self._socketCompleteDef
+                del self._socketCompleteDef
+                d.errback(e)
+                return
+            self._socketsBound(rtpPort, locIP)
+            return
+        # We've been told which port to use. Try to get a pair of ports
+        # next to each other, starting there. What fun!
         if (rtpPort % 2) == 1:
             rtpPort += 1
         while True:
             try:
-                self.rtpListener = reactor.listenUDP(rtpPort, self)
+                self.rtpListener = listenUDP(rtpPort, self)
             except CannotListenError:
                 rtpPort += 2
                 continue
@@ -119,6 +170,29 @@ class RTPProtocol(DatagramProtocol):
                 continue
             else:
                 break
+        self._socketsBound(rtpPort, locIP)
+
+    def _allocatePorts(self, listenUDP):
+        "Bind RTP and RTCP to a pair of ports from the port allocator"
+        from twisted.internet.error import CannotListenError
+        allocator = getPortAllocator(self.app)
+        while True:
+            rtpPort = allocator.allocate()
+            try:
+                self.rtpListener = listenUDP(rtpPort, self)
+            except CannotListenError:
+                allocator.markBusy(rtpPort)
+                continue
+            try:
+                self.rtcpListener = reactor.listenUDP(rtpPort+1, self.RTCP)
+            except CannotListenError:
+                self.rtpListener.stopListening()
+                allocator.markBusy(rtpPort)
+                continue
+            self._allocatedPort = rtpPort
+            return rtpPort
+
+    def _socketsBound(self, rtpPort, locIP):
         #self.rtpListener.stopReading()
         if self.needSTUN is False:
             # The pain can stop right here
@@ -133,6 +207,23 @@ class RTPProtocol(DatagramProtocol):
             # adjacent port numbers. Please, someone make the pain stop.
             self.natMapping()
 
+    def _joinSocketPool(self, pool, locIP):
+        # Our media (and, with rtcp-mux, our RTCP) goes over one of the
+        # pool's shared sockets.
+        self.rtcpMux = True
+        self.transport = self.RTCP.transport = pool.allocate(self)
+        self.rtpListener = self.transport
+        self.rtcpListener = None
+        if self.needSTUN:
+            log.msg("can't STUN a pooled RTP socket, using local address",
+                                                            system='rtp')
+            self.needSTUN = False
+        self._extRTPPort = self.transport.getHost().port
+        self._extIP = locIP
+        d = self._socketCompleteDef
+        del self._socketCompleteDef
+        d.callback(self.cookie)
+
     def getVisibleAddress(self):
         ''' returns the local IP address used for RTP (as visible from the
             outside world if STUN applies) as ( 'w.x.y.z', rtpPort)
@@ -239,26 +330,105 @@ class RTPProtocol(DatagramProtocol):
 
     def stopSendingAndReceiving(self):
         self.Done = 1
+        if self._relay is not None:
+            self._relay.stop()
         d = self.unmapRTP()
         d.addCallback(lambda x: self.rtpListener.stopListening())
-        d.addCallback(lambda x: self.rtcpListener.stopListening())
-
-    def _send_packet(self, pt, data, marker=0, xhdrtype=None, xhdrdata=''):
-        packet = RTPPacket(self.ssrc, self.seq, self.ts, data, pt=pt,
-                                    marker=marker,
-                                    xhdrtype=xhdrtype, xhdrdata=xhdrdata)
+        if self.rtcpListener is not None:
+            d.addCallback(lambda x: self.rtcpListener.stopListening())
+        if self._allocatedPort is not None:
+            d.addCallback(lambda x: self._releasePorts())
+
+    def _releasePorts(self):
+        port, self._allocatedPort = self._allocatedPort, None
+        if port is not None:
+            getPortAllocator(self.app).release(port)
+
+    def _send_packet(self, pt, data, marker=0, xhdrtype=None, xhdrdata=b''):
+        if xhdrtype is None:
+            template = self._sendTemplates.get(pt)
+            if template is None:
+                template = RTPSendTemplate(self.ssrc, pt)
+                self._sendTemplates[pt] = template
+            datagram = template.packet(self.seq, self.ts, data, marker)
+        else:
+            datagram = RTPPacket(self.ssrc, self.seq, self.ts, data, pt=pt,
+                                 marker=marker, xhdrtype=xhdrtype,
+                                 xhdrdata=xhdrdata).netbytes()
 
         self.seq += 1
-        # Note that seqno gets modulo 2^16 in RTPPacket, so it doesn't need
-        # to be wrapped at 16 bits here.
+        # Note that seqno gets modulo 2^16 when the packet is built, so it
+        # doesn't need to be wrapped at 16 bits here.
         if self.seq >= TWO_TO_THE_48TH:
             self.seq = self.seq - TWO_TO_THE_48TH
 
         try:
-            self.transport.write(packet.netbytes(), self.dest)
+            self.transport.write(datagram, self.dest)
         except Exception as le:
             pass
 
+    def relay_packet(self, packet):
+        """ Send out a packet received by another RTPProtocol, without
+            decoding it. The payload goes out unchanged, under our SSRC,
+            with its seq and ts moved into our own numbering - gaps and
+            timing are kept, so the far end still sees the loss and jitter
+            of the original stream. Used to bridge two calls that use the
+            same codec.
+        """
+        if self.Done or not self.sending:
+            return
+        h = packet.header
+        pt = self.ptdict.get(h.ct)
+        if pt is None:
+            log.msg('not relaying packet with CT %r, which was not in the negotiated SDP'%(h.ct,), system='rtp')
+            return
+        marker = h.marker
+        if h.ssrc != self._relaySSRC:
+            # A new stream - carry on from where our numbering has got to
+            self._relaySSRC = h.ssrc
+            self._relaySeq = self.seq - h.seq
+            self._relayTS = self.ts - h.ts
+            self._relayLast = None
+            marker = 1
+        if h.ct is not PT_NTE:
+            # NTE packets keep the ts of the event's start, and the first
+            # packet of a talkspurt follows a jump in ts, so neither says
+            # how long a packet is
+            last = self._relayLast
+            if last is None:
+                self._relayLast = (h.seq, h.ts)
+            else:
+                packets = (h.seq - last[0]) & 0xffff
+                step = (h.ts - last[1]) & 0xffffffff
+                if 0 < packets < 0x8000:
+                    if 0 < step < 0x80000000 and not h.marker:
+                        self._relayStep = step // packets
+                    self._relayLast = (h.seq, h.ts)
+        seq = (h.seq + self._relaySeq) & 0xffff
+        ts = (h.ts + self._relayTS) & 0xffffffff
+        template = self._sendTemplates.get(pt)
+        if template is None:
+            template = RTPSendTemplate(self.ssrc, pt)
+            self._sendTemplates[pt] = template
+        payload = getattr(packet, 'payload', None)
+        if payload is None:
+            payload = packet.data
+        try:
+            self.transport.write(template.packet(seq, ts, payload, marker),
+                                 self.dest)
+        except Exception as le:
+            pass
+        # Keep our own counters ahead of what's been relayed, so that
+        # handle_media_sample() carries on from here if the bridge goes
+        delta = (seq - self.seq) & 0xffff
+        if delta < 0x8000:
+            self.seq += delta + 1
+        if h.ct is not PT_NTE:
+            delta = (ts - self.ts) & 0xffffffff
+            if delta < 0x80000000:
+                self.ts = (self.ts + delta + self._relayStep) & 0xffffffff
+        self._silent = None
+
     def _send_cn_packet(self, logit=False):
         assert hasattr(self, 'dest'), "_send_cn_packet called before start %r" % (self,)
         # PT 13 is CN.
@@ -274,7 +444,7 @@ class RTPProtocol(DatagramProtocol):
             log.msg("sending CN(%s) to seed firewall to %s:%d"%(cnpt,
                                     self.dest[0], self.dest[1]), system='rtp')
 
-        self._send_packet(cnpt, chr(127))
+        self._send_packet(cnpt, self._cnPayload)
 
     def start(self, dest, fp=None):
         self.dest = dest
@@ -289,7 +459,7 @@ class RTPProtocol(DatagramProtocol):
         self._send_cn_packet(logit=True)
 
     def datagramReceived(self, datagram, addr, t=time):
-        packet = parse_rtppacket(datagram)
+        packet = parse_rtpframe(datagram)
 
         try:
             packet.header.ct = self.ptdict[packet.header.pt]
@@ -307,18 +477,24 @@ class RTPProtocol(DatagramProtocol):
         packet.header.ct = self.ptdict[packet.header.pt]
         self.app.incomingRTP(self.cookie, packet)
 
+    def datagramsReceived(self, datagrams):
+        "A batch of (datagram, addr) tuples from a BatchedUDPPort"
+        datagramReceived = self.datagramReceived
+        for datagram, addr in datagrams:
+            datagramReceived(datagram, addr)
+
     def genSSRC(self):
         # Python-ish hack at RFC1889, Appendix A.6
-        m = md5.new()
-        m.update(str(time()))
-        m.update(str(id(self)))
+        m = md5()
+        m.update(str(time()).encode())
+        m.update(str(id(self)).encode())
         if hasattr(os, 'getuid'):
-            m.update(str(os.getuid()))
-            m.update(str(os.getgid()))
-        m.update(str(socket.gethostname()))
+            m.update(str(os.getuid()).encode())
+            m.update(str(os.getgid()).encode())
+        m.update(str(socket.gethostname()).encode())
         hex = m.hexdigest()
         nums = hex[:8], hex[8:16], hex[16:24], hex[24:]
-        nums = [ long(x, 17) for x in nums ]
+        nums = [ int(x, 17) for x in nums ]
         ssrc = 0
         for n in nums: ssrc = ssrc ^ n
         ssrc = ssrc & (2**32 - 1)
@@ -326,12 +502,12 @@ class RTPProtocol(DatagramProtocol):
 
     def genInitTS(self):
         # Python-ish hack at RFC1889, Appendix A.6
-        m = md5.new()
-        m.update(str(self.genSSRC()))
-        m.update(str(time()))
+        m = md5()
+        m.update(str(self.genSSRC()).encode())
+        m.update(str(time()).encode())
         hex = m.hexdigest()
         nums = hex[:8], hex[8:16], hex[16:24], hex[24:]
-        nums = [ long(x, 16) for x in nums ]
+        nums = [ int(x, 16) for x in nums ]
         ts = 0
         for n in nums: ts = ts ^ n
         ts = ts & (2**32 - 1)
@@ -347,12 +523,12 @@ class RTPProtocol(DatagramProtocol):
     def genRandom(self, bits):
         """Generate up to 128 bits of randomness."""
         if os.path.exists("/dev/urandom"):
-            hex = open('/dev/urandom').read(16).encode("hex")
+            hex = open('/dev/urandom', 'rb').read(16).hex()
         else:
-            m = md5.new()
-            m.update(str(time()))
-            m.update(str(random.random()))
-            m.update(str(id(self.dest)))
+            m = md5()
+            m.update(str(time()).encode())
+            m.update(str(random.random()).encode())
+            m.update(str(id(self.dest)).encode())
             hex = m.hexdigest()
         return int(hex[:bits//4],16)
 
@@ -375,7 +551,16 @@ class RTPProtocol(DatagramProtocol):
             return
 
         marker = 0
-        if sample is not None:
+        if sample is not None and sample.ct is PT_CN:
+            # The audio layer's detected silence. Tell the other end how
+            # loud the background noise is, then stay quiet.
+            self._cnPayload = sample.data
+            if PT_CN in self.ptdict or PT_xCN in self.ptdict:
+                self._send_cn_packet()
+            self._silent = 1
+            incrTS = True
+
+        elif sample is not None:
             if self._silent is not None:
                 # Set the marker bit
                 marker = 1
@@ -391,9 +576,10 @@ class RTPProtocol(DatagramProtocol):
             if self._silent is None:
                 self._silent = 0
             if (self._silent % 25) == 0:
-                incrTS = True
                 self._send_cn_packet()
             self._silent += 1
+            # Time goes on, even when we're not sending anything
+            incrTS = True
 
 
         # Now send any pending DTMF keystrokes
@@ -0,0 +1,241 @@
+# Copyright (C) 2005 Anthony Baxter
+
+"""
+Relaying RTP between two calls.
+
+A voiceapp that just joins two calls together (call forwarding, a
+B2BUA) doesn't need to look at the media at all. Normally each packet
+still goes through datagramReceived(), gets parsed, passed up to the
+app, the voiceapp and the leg, and back down to the other RTPProtocol.
+An RTPRelay takes the two RTP sockets away from their protocols and
+reads them itself: each packet is received into a fixed buffer, its
+header patched in place (payload type, seq, ts and SSRC moved into the
+other call's numbering) and sent straight out of the other socket. The
+payload is never copied or parsed.
+
+RTCP is left alone - each RTPProtocol's RTCP carries on as before.
+Pooled RTP sockets (see mux.py) are shared between calls, so they can't
+be relayed.
+"""
+
+import struct
+
+from errno import EAGAIN, EWOULDBLOCK, EINTR, ECONNREFUSED
+
+from twisted.python import log
+
+# Most packets to read from a socket before going back to the reactor
+BATCH_SIZE = 32
+MAX_PACKET_SIZE = 2048
+
+_seqTSSSRC = struct.Struct('!HII')
+# payload type/marker, seq, ts, ssrc - everything after the first octet
+_rewrite = struct.Struct('!BHII')
+
+_DROP = 255
+
+# ts step per packet until we've seen the stream's - 20ms at 8KHz
+TS_STEP = 160
+
+class _RelayHalf:
+    """ One direction of a relay: reads src's RTP socket and sends out of
+        dst's. Looks enough like an IReadDescriptor for the reactor.
+    """
+
+    def __init__(self, src, dst, batchSize=BATCH_SIZE):
+        self.src = src
+        self.dst = dst
+        self.port = src.rtpListener
+        self.sock = self.port.socket
+        self.out = dst.rtpListener.socket
+        self.dest = dst.dest
+        # sendto() on a connected socket fails on BSD (EISCONN)
+        self.connected = getattr(dst.rtpListener, '_connectedAddr', None)
+        self.ssrc = dst.ssrc
+        self.batchSize = batchSize
+        self.ptmap = _ptMap(src.ptdict, dst.ptdict)
+        self.buf = bytearray(MAX_PACKET_SIZE)
+        self.view = memoryview(self.buf)
+        # Stream we're relaying, the next seq we expect on it, the ts of
+        # the last packet, and the offsets from its numbering to ours
+        self.inSSRC = None
+        self.inSeq = 0
+        self.inTS = 0
+        self.seqOffset = 0
+        self.tsOffset = 0
+        # How far ts moves each packet, as last seen on the stream
+        self.tsStep = TS_STEP
+        # Next seq and ts of our own to use
+        self.nextSeq = dst.seq & 0xffff
+        self.nextTS = dst.ts & 0xffffffff
+        # statistics
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.lost = 0
+        self.late = 0
+        self.sendErrors = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def logPrefix(self):
+        return 'RTPRelay'
+
+    def connectionLost(self, reason):
+        pass
+
+    def doRead(self):
+        "Called when src's socket is ready for reading."
+        recv = self.sock.recvfrom_into
+        send, sendto = self.out.send, self.out.sendto
+        connected = self.connected
+        buf, view, ptmap, dest = self.buf, self.view, self.ptmap, self.dest
+        for i in range(self.batchSize):
+            try:
+                n, addr = recv(buf)
+            except OSError as e:
+                if e.errno in (EAGAIN, EWOULDBLOCK, EINTR):
+                    return
+                if e.errno == ECONNREFUSED:
+                    continue
+                raise
+            pt = ptmap[buf[1]]
+            if n < 12 or (buf[0] & 0xc0) != 0x80 or pt == _DROP:
+                self.dropped += 1
+                continue
+            seq, ts, ssrc = _seqTSSSRC.unpack_from(buf, 2)
+            if ssrc != self.inSSRC:
+                # A new stream - carry on from where our numbering is at
+                self.inSSRC = ssrc
+                self.inSeq = seq
+                self.inTS = ts
+                self.seqOffset = self.nextSeq - seq
+                self.tsOffset = self.nextTS - ts
+                pt = pt | 128
+            gap = (seq - self.inSeq) & 0xffff
+            if gap < 0x8000:
+                self.lost += gap
+                self.inSeq = (seq + 1) & 0xffff
+                step = (ts - self.inTS) & 0xffffffff
+                # The first packet of a talkspurt (marked) comes after a
+                # jump in ts, so it doesn't tell us the packet size
+                if 0 < step < 0x80000000 and not buf[1] & 128:
+                    self.tsStep = step // (gap + 1)
+                self.inTS = ts
+            else:
+                self.late += 1
+            outSeq = (seq + self.seqOffset) & 0xffff
+            outTS = (ts + self.tsOffset) & 0xffffffff
+            _rewrite.pack_into(buf, 1, pt, outSeq, outTS, self.ssrc)
+            try:
+                if connected:
+                    send(view[:n])
+                else:
+                    sendto(view[:n], dest)
+            except OSError:
+                self.sendErrors += 1
+                continue
+            self.packets += 1
+            self.bytes += n
+            if ((outSeq - self.nextSeq) & 0xffff) < 0x8000:
+                self.nextSeq = (outSeq + 1) & 0xffff
+            if ((outTS - self.nextTS) & 0xffffffff) < 0x80000000:
+                self.nextTS = (outTS + self.tsStep) & 0xffffffff
+
+    def finish(self):
+        "Hand our numbering back to dst, so its own packets follow on"
+        dst = self.dst
+        dst.seq += (self.nextSeq - dst.seq) & 0xffff
+        dst.ts = self.nextTS
+
+    def getStats(self):
+        return { 'packets': self.packets,
+                 'bytes': self.bytes,
+                 'dropped': self.dropped,
+                 'lost': self.lost,
+                 'late': self.late,
+                 'senderrors': self.sendErrors,
+               }
+
+
+def _ptMap(src, dst):
+    """ A 256 byte table from the second octet of an inbound packet
+        (marker and payload type) to the one we send. Payload types the
+        other call didn't negotiate map to _DROP.
+    """
+    ptmap = bytearray([_DROP]) * 256
+    for pt in range(128):
+        ct = src.get(pt)
+        if ct is None:
+            continue
+        out = dst.get(ct)
+        if out is not None:
+            ptmap[pt] = out
+            ptmap[pt | 128] = out | 128
+    return ptmap
+
+
+class RTPRelay:
+    """ Forwards RTP between two RTPProtocols, in both directions, without
+        passing it up to the app. start() takes over both sockets, stop()
+        gives them back.
+    """
+
+    def __init__(self, rtp1, rtp2, reactor=None, batchSize=BATCH_SIZE):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.rtps = (rtp1, rtp2)
+        self.halves = (_RelayHalf(rtp1, rtp2, batchSize),
+                       _RelayHalf(rtp2, rtp1, batchSize))
+        self.running = False
+
+    def start(self):
+        for half in self.halves:
+            self.reactor.removeReader(half.port)
+            self.reactor.addReader(half)
+            half.src._relay = self
+        self.running = True
+        log.msg("relaying RTP between %s and %s"%(self.rtps[0].cookie,
+                                        self.rtps[1].cookie), system='rtp')
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        for half in self.halves:
+            self.reactor.removeReader(half)
+            half.finish()
+            half.src._relay = None
+            if half.port.connected:
+                self.reactor.addReader(half.port)
+        log.msg("stopped relaying RTP between %s and %s: %r"%(
+                    self.rtps[0].cookie, self.rtps[1].cookie,
+                    self.getStats()), system='rtp')
+
+    def getStats(self):
+        "Statistics for each direction, rtp1 to rtp2 first"
+        return [ half.getStats() for half in self.halves ]
+
+
+def canRelay(rtp1, rtp2):
+    "Can we relay between these two RTPProtocols?"
+    for rtp in rtp1, rtp2:
+        if rtp.rtcpMux or rtp.dest is None or rtp.Done:
+            return False
+        if getattr(rtp.rtpListener, 'socket', None) is None:
+            return False
+    return True
+
+def relayRTP(rtp1, rtp2, reactor=None):
+    """ Start relaying between rtp1 and rtp2, returning the RTPRelay, or
+        None if they can't be relayed.
+    """
+    if not canRelay(rtp1, rtp2):
+        log.msg("can't relay RTP between %s and %s"%(rtp1.cookie,
+                                            rtp2.cookie), system='rtp')
+        return None
+    relay = RTPRelay(rtp1, rtp2, reactor)
+    relay.start()
+    return relay
@@ -18,7 +18,7 @@ RTCP_PT_SDES = 202
 RTCP_PT_BYE = 203
 RTCP_PT_APP = 204
 rtcpPTdict = {RTCP_PT_SR: 'SR', RTCP_PT_RR: 'RR', RTCP_PT_SDES:'SDES', RTCP_PT_BYE:'BYE'}
-for k,v in rtcpPTdict.items():
+for k,v in list(rtcpPTdict.items()):
     rtcpPTdict[v] = k
 
 RTCP_SDES_CNAME = 1
@@ -39,7 +39,7 @@ rtcpSDESdict = {RTCP_SDES_CNAME: 'CNAME',
                 RTCP_SDES_NOTE: 'NOTE',
                 RTCP_SDES_PRIV: 'PRIV',
                }
-for k,v in rtcpSDESdict.items():
+for k,v in list(rtcpSDESdict.items()):
     rtcpSDESdict[v] = k
 
 
@@ -184,13 +184,18 @@ class MediaDescription:
     def setKeyManagement(self, km):
         parse_a(self, 'keymgmt', km)
 
+    def addAttribute(self, attrname, attrval=None):
+        self._a.setdefault(attrname, []).append(attrval)
+
+    def hasAttribute(self, attrname):
+        return attrname in self._a
+
     def clearRtpMap(self):
         self.rtpmap = OrderedDict()
 
     def addRtpMap(self, fmt):
         if fmt.pt is None:
-            pts = self.rtpmap.keys()
-            pts.sort()
+            pts = sorted(self.rtpmap.keys())
             if pts and pts[-1] > 100:
                 payload = pts[-1] + 1
             else:
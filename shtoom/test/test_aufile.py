@@ -0,0 +1,151 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for the file mapping in shtoom.audio.aufile
+"""
+
+import os, wave, sunau, mmap
+
+from twisted.trial import unittest
+
+class FakeLeg:
+    done = False
+    def _sourceDone(self, source):
+        self.done = True
+
+# 100 samples of a ramp, 16 bit native
+def ramp():
+    import array
+    return array.array('h', range(-5000, 5000, 100)).tobytes()
+
+class MapAudioFileTest(unittest.TestCase):
+
+    def path(self, name):
+        d = self.mktemp()
+        os.makedirs(d)
+        return os.path.join(d, name)
+
+    def writeWav(self, name, rate=8000, channels=1, data=None):
+        path = self.path(name)
+        w = wave.open(path, 'wb')
+        w.setparams((channels, 2, rate, 0, 'NONE', 'not compressed'))
+        w.writeframes(data or ramp())
+        w.close()
+        return path
+
+    def test_raw(self):
+        from shtoom.audio.aufile import mapAudioFile
+        path = self.path('prompt.raw')
+        open(path, 'wb').write(ramp())
+        pcm = mapAudioFile(path)
+        self.assertEqual(bytes(pcm), ramp())
+        # No copy - a view of the mapping
+        self.assertTrue(isinstance(pcm.obj, mmap.mmap))
+
+    def test_wav8k(self):
+        from shtoom.audio.aufile import mapAudioFile
+        pcm = mapAudioFile(self.writeWav('prompt.wav'))
+        self.assertEqual(bytes(pcm), ramp())
+        self.assertTrue(isinstance(pcm.obj, mmap.mmap))
+
+    def test_wavConverted(self):
+        import audioop
+        from shtoom.audio import aufile
+        ae = self.assertEqual
+        stereo = audioop.tostereo(ramp(), 2, 1, 1)
+        path = self.writeWav('stereo16k.wav', rate=16000, channels=2,
+                             data=stereo)
+        pcm = aufile.mapAudioFile(path)
+        ae(len(pcm), len(ramp()) // 2)
+        # Converted once, and kept
+        self.assertTrue(aufile.mapAudioFile(path) is pcm)
+
+    def test_auUlaw(self):
+        import audioop
+        from shtoom.audio.aufile import mapAudioFile
+        path = self.path('prompt.au')
+        ulaw = audioop.lin2ulaw(ramp(), 2)
+        # sunau does the u-law encoding itself
+        a = sunau.open(path, 'wb')
+        a.setparams((1, 2, 8000, 0, 'ULAW', 'CCITT G.711 u-law'))
+        a.writeframes(ramp())
+        a.close()
+        self.assertEqual(bytes(mapAudioFile(path)), audioop.ulaw2lin(ulaw, 2))
+
+    def test_convertInThreads(self):
+        import audioop, threading
+        from shtoom.audio import aufile
+        ae = self.assertEqual
+        self.patch(aufile, 'MAX_CONVERTED', 1000)
+        self.patch(aufile, '_converted', aufile.OrderedDict())
+        self.patch(aufile, '_convertedBytes', 0)
+        stereo = audioop.tostereo(ramp(), 2, 1, 1)
+        paths = [ self.writeWav('s%d.wav'%(n,), rate=16000, channels=2,
+                                data=stereo) for n in range(4) ]
+        errors = []
+        def convert():
+            try:
+                for i in range(50):
+                    for path in paths:
+                        aufile.mapAudioFile(path)
+            except Exception as e:
+                errors.append(e)
+        threads = [ threading.Thread(target=convert) for n in range(4) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ae(errors, [])
+        ae(aufile._convertedBytes,
+           sum([len(p) for p in aufile._converted.values()]))
+
+    def test_mappedFileSource(self):
+        from shtoom.doug.source import MappedFileSource
+        ae = self.assertEqual
+        path = self.path('prompt.raw')
+        data = ramp() * 4
+        open(path, 'wb').write(data)
+        s = MappedFileSource(path)
+        s.leg = FakeLeg()
+        ae(s.isPlaying(), True)
+        ae(bytes(s.read()), data[:320])
+        ae(bytes(s.read()), data[320:640])
+        ae(bytes(s.read()), data[640:])
+        ae(s.leg.done, False)
+        ae(s.read(), b'')
+        ae(s.leg.done, True)
+        s.close()
+
+    def test_mappedFileSourceConverts(self):
+        import audioop
+        from shtoom.doug.source import MappedFileSource
+        ae = self.assertEqual
+        stereo = audioop.tostereo(ramp(), 2, 1, 1)
+        path = self.writeWav('stereo16k.wav', rate=16000, channels=2,
+                             data=stereo)
+        s = MappedFileSource(path)
+        s.leg = FakeLeg()
+        # Silence while it's converted, in a thread
+        ae(s.read(), b'')
+        def converted(result):
+            ae(len(s.read()), len(ramp()) // 2)
+            ae(s.read(), b'')
+            ae(s.leg.done, True)
+            s.close()
+        return s._ready.addCallback(converted)
+
+class MissingModulesTest(unittest.TestCase):
+
+    def test_importWithout313Modules(self):
+        # audioop, sunau, aifc and sndhdr are gone in Python 3.13
+        import subprocess, sys
+        import shtoom
+        top = os.path.dirname(os.path.dirname(os.path.abspath(
+                                                    shtoom.__file__)))
+        code = '\n'.join([
+            "import sys",
+            "for name in 'audioop', 'sunau', 'aifc', 'sndhdr':",
+            "    sys.modules[name] = None",
+            "from shtoom.audio.converters import Codecker",
+            "from shtoom.rtp.formats import PT_PCMU",
+            "assert len(Codecker(PT_PCMU).handle_audio(b'\\0' * 320).data) == 160",
+            ])
+        subprocess.check_call([sys.executable, '-c', code], cwd=top)
@@ -0,0 +1,132 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.rtp.batchudp
+"""
+
+import select, socket
+
+from twisted.trial import unittest
+
+from shtoom.rtp import batchudp
+
+class BatchCollector:
+    transport = None
+    def __init__(self):
+        self.batches = []
+    def makeConnection(self, transport):
+        self.transport = transport
+    def doStop(self):
+        pass
+    def datagramsReceived(self, datagrams):
+        self.batches.append(datagrams)
+
+class PacketCollector:
+    transport = None
+    def __init__(self):
+        self.packets = []
+    def makeConnection(self, transport):
+        self.transport = transport
+    def doStop(self):
+        pass
+    def datagramReceived(self, datagram, addr):
+        self.packets.append((datagram, addr))
+
+class BatchedUDPTest(unittest.TestCase):
+
+    useMMsg = True
+
+    def setUp(self):
+        if self.useMMsg and batchudp.mmsg is None:
+            raise unittest.SkipTest("no recvmmsg/sendmmsg here")
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(('127.0.0.1', 0))
+        self.ports = []
+
+    def tearDown(self):
+        self.client.close()
+        for p in self.ports:
+            p.stopListening()
+
+    def listen(self, proto, **kw):
+        p = batchudp.BatchedUDPPort(0, proto, interface='127.0.0.1',
+                                    useMMsg=self.useMMsg, **kw)
+        p.startListening()
+        self.ports.append(p)
+        return p
+
+    def send(self, port, count):
+        addr = ('127.0.0.1', port.getHost().port)
+        for n in range(count):
+            self.client.sendto(b'packet %d' % n, addr)
+        select.select([port.socket], [], [], 1.0)
+
+    def test_batchedRead(self):
+        ae = self.assertEqual
+        proto = BatchCollector()
+        port = self.listen(proto, batchSize=4)
+        self.send(port, 6)
+        port.doRead()
+        port.doRead()
+        port.doRead()
+        ae([len(b) for b in proto.batches], [4, 2])
+        ae([d for b in proto.batches for d, a in b],
+           [b'packet %d' % n for n in range(6)])
+        ae(proto.batches[0][0][1], self.client.getsockname())
+        ae(port.readBatches, 2)
+
+    def test_perPacketFallback(self):
+        ae = self.assertEqual
+        proto = PacketCollector()
+        port = self.listen(proto)
+        self.send(port, 3)
+        port.doRead()
+        ae([d for d, a in proto.packets], [b'packet 0', b'packet 1', b'packet 2'])
+
+    def test_batchedWrite(self):
+        ae = self.assertEqual
+        proto = BatchCollector()
+        port = self.listen(proto, batchSize=4)
+        dest = self.client.getsockname()
+        buf = bytearray(b'reused buffer 0')
+        for n in range(6):
+            buf[-1:] = b'%d' % n
+            port.write(memoryview(buf), dest)
+        # The first four went out as soon as the batch filled up
+        ae(len(port._sendQueue), 2)
+        port.flush()
+        ae(port._sendQueue, [])
+        self.client.settimeout(1.0)
+        got = [self.client.recvfrom(2048) for n in range(6)]
+        ae([d for d, a in got], [b'reused buffer %d' % n for n in range(6)])
+        ae(got[0][1], ('127.0.0.1', port.getHost().port))
+        ae(port.writeBatches, 2)
+
+    def test_oversizeWrite(self):
+        ae = self.assertEqual
+        proto = BatchCollector()
+        port = self.listen(proto, batchSize=4, maxPacketSize=64)
+        dest = self.client.getsockname()
+        port.write(b'small', dest)
+        port.write(b'x' * 1000, dest)
+        port.write(b'after', dest)
+        port.flush()
+        ae(port.oversize, 1)
+        self.client.settimeout(1.0)
+        got = [self.client.recvfrom(2048)[0] for n in range(3)]
+        ae(got, [b'small', b'x' * 1000, b'after'])
+
+    def test_oversizeRead(self):
+        ae = self.assertEqual
+        proto = BatchCollector()
+        port = self.listen(proto, batchSize=4, maxPacketSize=64)
+        addr = ('127.0.0.1', port.getHost().port)
+        self.client.sendto(b'y' * 64, addr)
+        self.client.sendto(b'z' * 65, addr)
+        self.client.sendto(b'ok', addr)
+        select.select([port.socket], [], [], 1.0)
+        port.doRead()
+        ae([d for b in proto.batches for d, a in b], [b'y' * 64, b'ok'])
+        ae(port.truncated, 1)
+
+
+class BatchedUDPFallbackTest(BatchedUDPTest):
+    useMMsg = False
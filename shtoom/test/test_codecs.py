@@ -162,5 +162,55 @@ class CodecTest(unittest.TestCase):
         p = RTPPacket(0, 0, 0, data=test, ct=PT_RAW)
         ae(d.convertInbound(p), test)
 
-
-
+    def testEncodeBatch(self):
+        from shtoom.audio.converters import encodeBatch, decodeBatch
+        from shtoom.rtp.formats import PT_PCMA
+        import struct
+        ae = self.assertEqual
+        fmts = [PT_PCMU, PT_PCMA, PT_PCMU, PT_RAW, PT_PCMU]
+        frames = [ struct.pack('160h', *[(n * 1000 + x * 37) % 30000
+                                         for x in range(160)])
+                   for n in range(len(fmts)) ]
+        frames[4] = frames[4][:100]
+        expected = []
+        for fmt, frame in zip(fmts, frames):
+            expected.append(Codecker(fmt).handle_audio(frame))
+        codeckers = [ Codecker(fmt) for fmt in fmts ]
+        samples = encodeBatch(codeckers, frames)
+        ae([ s and s.ct for s in samples ], [ s and s.ct for s in expected ])
+        ae([ s and s.data for s in samples ],
+           [ s and s.data for s in expected ])
+        # The short frame was buffered, as handle_audio() would
+        ae(samples[4], None)
+        ae(codeckers[4]._pending[PT_PCMU].read(), frames[4])
+
+        packets = [ RTPPacket(0, 0, 0, data=s.data, ct=s.ct)
+                    for s in samples[:4] ]
+        audio = decodeBatch(codeckers[:4], packets)
+        ae(audio, [ Codecker(p.header.ct).decode(p) for p in packets ])
+        ae(audio[3], frames[3])
+
+    def testSharedCodecs(self):
+        from shtoom.audio.converters import codecClasses
+        ae = self.assertEqual
+        c1, c2 = Codecker(PT_PCMU), Codecker(PT_PCMU)
+        # Nothing's created until it's used
+        ae(c1.format_to_codec._codecs, {})
+        a = c1.format_to_codec.get(PT_PCMU)
+        ae(list(c1.format_to_codec._codecs.keys()), [PT_PCMU])
+        self.assertTrue(a is c2.format_to_codec.get(PT_PCMU))
+        ae(c1.format_to_codec.get(PT_QCELP), None)
+        for fmt, klass in codecClasses.items():
+            if not klass.stateless:
+                self.assertFalse(c1.format_to_codec.get(fmt) is
+                                 c2.format_to_codec.get(fmt))
+        # Partial frames are kept apart, even though the codec's shared
+        out1, out2 = [], []
+        c1.set_handler(out1.append)
+        c2.set_handler(out2.append)
+        for n in range(4):
+            c1.handle_audio(instr[n*80:(n+1)*80])
+            c2.handle_audio(b'\0' * 80)
+        ae([s.data for s in out1],
+           [Codecker(PT_PCMU).handle_audio(instr[:320]).data])
+        ae([s.data for s in out2], [b'\xff' * 160])
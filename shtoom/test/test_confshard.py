@@ -0,0 +1,202 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.doug.confshard
+"""
+
+from twisted.trial import unittest
+import struct, time
+
+def frame(value, n=160):
+    return struct.pack('=%dh'%n, *([value] * n))
+
+class FakeURI:
+    def getURI(self):
+        return 'sip:someone@example.com'
+class FakeDialog:
+    def getRemoteTag(self):
+        return FakeURI()
+class FakeLeg:
+    def getDialog(self):
+        return FakeDialog()
+
+class FrameRingTest(unittest.TestCase):
+
+    def setUp(self):
+        from shtoom.doug import confshard
+        if confshard.shared_memory is None:
+            raise unittest.SkipTest("no multiprocessing.shared_memory")
+
+    def test_putGet(self):
+        from shtoom.doug.confshard import FrameRing
+        ae = self.assertEqual
+        ring = FrameRing(slots=4, slotBytes=16)
+        other = FrameRing(ring.name, 4, 16, create=False)
+        try:
+            ae(other.get(), None)
+            for i in range(4):
+                self.assertTrue(ring.put(b'frame %d'%i))
+            self.assertFalse(ring.put(b'too many'))
+            ae(ring.dropped, 1)
+            ae(len(other), 4)
+            ae(other.get(), b'frame 0')
+            # wrap around
+            for i in range(10):
+                ring.put(b'x%d'%i)
+                other.get()
+            ae(len(other), 3)
+            self.assertRaises(ValueError, ring.put, b'0123456789abcdefg')
+        finally:
+            other.close()
+            ring.close()
+
+class ShardWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        from shtoom.doug import confshard
+        if confshard.shared_memory is None:
+            raise unittest.SkipTest("no multiprocessing.shared_memory")
+
+    def test_mixing(self):
+        from shtoom.doug.confshard import ShardWorker, FrameRing
+        ae = self.assertEqual
+        w = ShardWorker()
+        rings = []
+        try:
+            for i in range(3):
+                inr, outr = FrameRing(), FrameRing()
+                rings.append((inr, outr))
+                w.handle(('add', i, 'room', inr.name, outr.name, 8, 1024))
+            ae(list(w.rooms.keys()), ['room'])
+            rings[0][0].put(frame(2000))
+            rings[1][0].put(frame(1000))
+            w.tick()
+            ae(rings[0][1].get(), frame(1000))
+            ae(rings[1][1].get(), frame(2000))
+            ae(rings[2][1].get(), frame(1500))
+            for i in range(3):
+                w.handle(('remove', i))
+            ae(w.rooms, {})
+        finally:
+            w.close()
+            for inr, outr in rings:
+                inr.close()
+                outr.close()
+
+    def test_badRoom(self):
+        from shtoom.doug.confshard import ShardWorker, FrameRing
+        ae = self.assertEqual
+        w = ShardWorker()
+        rings = []
+        try:
+            for i, name in enumerate(['bad', 'good', 'good']):
+                inr, outr = FrameRing(), FrameRing()
+                rings.append((inr, outr))
+                w.handle(('add', i, name, inr.name, outr.name, 8, 1024))
+            def broken():
+                raise ZeroDivisionError
+            w.rooms['bad'].mixAudio = broken
+            rings[1][0].put(frame(1000))
+            w.tick()
+            w.tick()
+            ae(w.failures, {'bad': 2})
+            self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+            # The other room still got mixed
+            ae(rings[2][1].get(), frame(1000))
+            # A member whose rings have gone
+            inr, outr = FrameRing(), FrameRing()
+            inname = inr.name
+            inr.close()
+            self.assertRaises(FileNotFoundError, w.handle,
+                              ('add', 3, 'good', inname, outr.name, 8, 1024))
+            outr.close()
+            ae(sorted(w.members.keys()), [0, 1, 2])
+        finally:
+            w.close()
+            for inr, outr in rings:
+                inr.close()
+                outr.close()
+
+class ShardingTest(unittest.TestCase):
+
+    def setUp(self):
+        from shtoom.doug import confshard
+        if confshard.shared_memory is None:
+            raise unittest.SkipTest("no multiprocessing.shared_memory")
+
+    def test_workerProcess(self):
+        from shtoom.doug import conferencing
+        from shtoom.doug.confshard import RemoteConfSource
+        ae = self.assertEqual
+        shards = conferencing.startSharding(2)
+        try:
+            # rooms always hash to the same worker
+            ae(shards.workerFor('a room'), shards.workerFor('a room'))
+            talker = conferencing.newConferenceMember('a room', FakeLeg())
+            listener = conferencing.newConferenceMember('a room', FakeLeg())
+            self.assertTrue(isinstance(talker, RemoteConfSource))
+            heard = b''
+            deadline = time.time() + 30
+            while not heard and time.time() < deadline:
+                talker.write(frame(1234))
+                time.sleep(0.02)
+                heard = listener.read()
+            ae(heard, frame(1234))
+            talker.close()
+            listener.close()
+        finally:
+            conferencing.stopSharding()
+        ae(conferencing._shards, None)
+
+
+    def test_workerDies(self):
+        from shtoom.doug import conferencing
+        ae = self.assertEqual
+        shards = conferencing.startSharding(1)
+        try:
+            talker = conferencing.newConferenceMember('a room', FakeLeg())
+            old = shards.workers[0]
+            old.process.terminate()
+            old.process.join(10)
+            # Adding a member notices the broken pipe, and restarts it
+            listener = conferencing.newConferenceMember('a room', FakeLeg())
+            new = shards.workers[0]
+            self.assertTrue(new is not old)
+            ae(talker._worker, new)
+            ae(listener._worker, new)
+            heard = b''
+            deadline = time.time() + 30
+            while not heard and time.time() < deadline:
+                talker.write(frame(1234))
+                time.sleep(0.02)
+                heard = listener.read()
+            ae(heard, frame(1234))
+            # As does the periodic check
+            new.process.terminate()
+            new.process.join(10)
+            shards.checkWorkers()
+            self.assertTrue(shards.workers[0] is not new)
+            ae(listener._worker, shards.workers[0])
+            talker.close()
+            listener.close()
+        finally:
+            conferencing.stopSharding()
+
+    def test_ringsOutliveRemove(self):
+        from shtoom.doug import conferencing
+        from shtoom.doug.confshard import FrameRing
+        ae = self.assertEqual
+        shards = conferencing.startSharding(1)
+        try:
+            member = conferencing.newConferenceMember('a room', FakeLeg())
+            name = member._toRoom.name
+            # Gone before the worker's even seen the add
+            member.close()
+            self.assertTrue(member.memberid in shards._closing)
+            deadline = time.time() + 30
+            while shards._closing and time.time() < deadline:
+                time.sleep(0.02)
+                shards.checkWorkers()
+            ae(shards._closing, {})
+            # Only unlinked once the worker was done with it
+            self.assertRaises(FileNotFoundError, FrameRing, name, create=False)
+        finally:
+            conferencing.stopSharding()
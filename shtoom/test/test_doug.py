@@ -210,3 +210,24 @@ class DougDTMFTest(unittest.TestCase):
         self.assertEqual(s2.val, 'completed')
         lapp.stopSIP()
         capp.stopSIP()
+
+class IncomingNTETest(unittest.TestCase):
+
+    def test_incomingNTE(self):
+        from shtoom.rtp.packets import RTPPacket, parse_rtpframe
+        from shtoom.rtp.formats import PT_NTE
+        events = []
+        class FakeVoiceApp:
+            def va_incomingNTE(self, packet, cookie):
+                pass
+            def va_startDTMFevent(self, key, cookie):
+                events.append(('start', key))
+            def va_stopDTMFevent(self, key, cookie):
+                events.append(('stop', key))
+        app = TestDougApplication(NullApp)
+        app._voiceapps['cookie'] = FakeVoiceApp()
+        for data in b'\x05\x8a\x00\xa0', b'\x0b\x0a\x01\x40':
+            packet = parse_rtpframe(RTPPacket(1, 1, 0, data, pt=101).netbytes())
+            packet.header.ct = PT_NTE
+            app.incomingRTP('cookie', packet)
+        self.assertEqual(events, [('start', '5'), ('stop', '#')])
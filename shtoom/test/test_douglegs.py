@@ -95,3 +95,133 @@ class DougLegTests(unittest.TestCase):
         # rejectCall triggers an errback, so we get
         # Failure(DefaultException(reason))
         ae(a.res.value.args, ('because',))
+
+    def test_bridgePassthrough(self):
+        from shtoom.rtp.formats import PT_PCMU
+        ae = self.assertEqual
+        class VoiceApp:
+            def __init__(self):
+                self.relayed = []
+            def va_relayRTP(self, packet, cookie):
+                self.relayed.append((cookie, packet))
+            def va_outgoingRTP(self, sample, cookie):
+                pass
+        class Packet:
+            class header:
+                ct = PT_PCMU
+            data = b'\xff' * 160
+        va = VoiceApp()
+        l1 = Leg('c1', None, voiceapp=va)
+        l2 = Leg('c2', None, voiceapp=va)
+        l1.selectDefaultFormat([PT_PCMU])
+        l2.selectDefaultFormat([PT_PCMU])
+        b = Bridge(l1, l2)
+        ae(l1.isPassthrough(), True)
+        ae(l2.isPassthrough(), True)
+        # No more reading and encoding audio on the media clock
+        ae(l1.LC, None)
+        ae(l2.LC, None)
+        p = Packet()
+        l1.leg_incomingRTP(p)
+        l2.leg_incomingNTE(p)
+        ae(va.relayed, [('c2', p), ('c1', p)])
+        # Playing something on one leg takes both out of passthrough
+        l2._connectSource(BridgeSource(None))
+        ae(l2.isPassthrough(), False)
+        self.assertNotEqual(l2.LC, None)
+        l1.leg_incomingRTP(p)
+        ae(len(va.relayed), 2)
+        l1._stopAudio()
+        l2._stopAudio()
+
+    def test_bridgeDifferentCodecs(self):
+        from shtoom.rtp.formats import PT_PCMU, PT_PCMA
+        l1 = Leg('c1', None)
+        l2 = Leg('c2', None)
+        l1.selectDefaultFormat([PT_PCMU])
+        l2.selectDefaultFormat([PT_PCMA])
+        Bridge(l1, l2)
+        self.assertEqual(l1.isPassthrough(), False)
+        self.assertNotEqual(l1.LC, None)
+        l1._stopAudio()
+        l2._stopAudio()
+
+    def test_legAudioService(self):
+        from twisted.internet import task
+        from shtoom.audio.clock import MediaClock
+        from shtoom.audio.converters import Codecker
+        from shtoom.doug.leg import LegAudioService
+        from shtoom.doug.source import Source
+        from shtoom.rtp.formats import PT_PCMU, PT_PCMA
+        ae = self.assertEqual
+        class PCMSource(Source):
+            def __init__(self, data):
+                self.data = data
+                Source.__init__(self)
+            def read(self):
+                return self.data
+        class VoiceApp:
+            def __init__(self):
+                self.sent = []
+            def va_outgoingRTP(self, sample, cookie):
+                self.sent.append((cookie, sample))
+        reactor = task.Clock()
+        service = LegAudioService(MediaClock(reactor=reactor))
+        va = VoiceApp()
+        fmts = [PT_PCMU, PT_PCMA, PT_PCMU]
+        legs = []
+        for n, fmt in enumerate(fmts):
+            leg = Leg('c%d'%n, None, voiceapp=va)
+            leg._stopAudio()
+            leg.selectDefaultFormat([fmt])
+            leg._connectSource(PCMSource(bytes([n * 10 + 1, 2]) * 160))
+            leg.LC = service.add(leg)
+            legs.append(leg)
+        ae(len(service), 3)
+        reactor.advance(0.02)
+        ae([ c for c, s in va.sent ], ['c0', 'c1', 'c2'])
+        for (c, s), leg, fmt in zip(va.sent, legs, fmts):
+            ae(s.ct, fmt)
+            ae(s.data, Codecker(fmt).handle_audio(leg._Leg__connected.data).data)
+        for leg in legs:
+            leg._stopAudio()
+        ae(len(service), 0)
+        ae(service._call, None)
+
+    def test_legAudioServiceSurvivesBadLegs(self):
+        from twisted.internet import task
+        from shtoom.audio.clock import MediaClock
+        from shtoom.doug.leg import LegAudioService
+        from shtoom.doug.source import Source
+        from shtoom.rtp.formats import PT_PCMU
+        ae = self.assertEqual
+        class ToneSource(Source):
+            def read(self):
+                return b'\x10\x20' * 160
+        class BrokenSource(Source):
+            def read(self):
+                return 'not bytes'
+        class VoiceApp:
+            def __init__(self):
+                self.sent = []
+            def va_outgoingRTP(self, sample, cookie):
+                self.sent.append((cookie, sample and sample.ct))
+        service = LegAudioService(MediaClock(reactor=task.Clock()))
+        va = VoiceApp()
+        legs = []
+        # An idle leg (reading silence), a broken one, and one playing
+        for n, src in enumerate((None, BrokenSource(), ToneSource())):
+            leg = Leg('c%d'%n, None, voiceapp=va)
+            leg._stopAudio()
+            leg.selectDefaultFormat([PT_PCMU])
+            if src is not None:
+                leg._connectSource(src)
+            leg.LC = service.add(leg)
+            legs.append(leg)
+        try:
+            service.tick()
+        finally:
+            for leg in legs:
+                leg._stopAudio()
+        self.flushLoggedErrors(AssertionError)
+        ae(va.sent, [('c0', None), ('c2', PT_PCMU)])
@@ -10,10 +10,9 @@ def getDTMFAudioFile():
 class DTMFDetectTest(unittest.TestCase):
     def setUp(self):
         try:
-            import numarray
-            import numarray.fft
-        except:
-            raise unittest.SkipTest('numarray needed for dtmf detection')
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('numpy needed for dtmf detection')
 
     def test_dtmfdetection_canned(self):
         from shtoom.doug.dtmf import DtmfDetector
@@ -78,7 +77,101 @@ class DTMFDetectTest(unittest.TestCase):
             self.assertTrue(len(s2res) == 1, s2res)
             s = s1res[0]+s2res[0]
             digit = detect.detect(s)
-            self.assertEqual(k, digit, msg="k: %s, digit: %s, s=%s" % (k, digit, `s`,))
-            silence = '\0'*320
+            self.assertEqual(k, digit, msg="k: %s, digit: %s, s=%r" % (k, digit, s,))
+            silence = b'\0'*320
             for frame in codec.buffer_and_encode(silence):
                 codec.decode(frame)
+
+    def test_filterBankSliding(self):
+        # 20ms at a time, each frame looked at with the one before
+        from shtoom.doug.dtmf import DtmfFilterBank
+        fp = open(getDTMFAudioFile(),'rb')
+        bank = DtmfFilterBank(1)
+        seen = []
+        cur = None
+        while True:
+            data = fp.read(320)
+            if len(data) != 320:
+                break
+            digit = bank.process([data])[0]
+            if digit != cur:
+                seen.append(digit)
+                cur = digit
+        self.assertEqual(seen, ['', '3', '', '1', '', '4', '', '1', '', '#'])
+
+    def test_filterBankBatch(self):
+        from shtoom.doug import dtmf
+        ae = self.assertEqual
+        keys = '159#'
+        tones = [dtmf.dtmfGenerator(k, 480) for k in keys]
+        bank = dtmf.DtmfFilterBank(5)
+        # Four streams of tones, and one of silence
+        first = [t[:320] for t in tones] + [b'\0' * 320]
+        second = [t[320:640] for t in tones] + [b'\0' * 320]
+        third = [t[640:] for t in tones]
+        bank.process(first)
+        ae(bank.process(second), list(keys) + [''])
+        # When a stream goes away, the last one can be moved into its place
+        bank.move(3, 0)
+        bank.resize(3)
+        ae(bank.process([third[3], third[1], third[2]]), ['#', '5', '9'])
+
+    def test_noDTMFInNoise(self):
+        import random
+        import struct
+        from shtoom.doug.dtmf import DtmfFilterBank
+        r = random.Random(1)
+        noise = struct.pack('320h', *[r.randint(-8000, 8000)
+                                      for x in range(320)])
+        bank = DtmfFilterBank(1)
+        self.assertEqual(bank.process([noise[:320]]), [''])
+        self.assertEqual(bank.process([noise[320:]]), [''])
+
+class FakeLeg:
+    def __init__(self):
+        self.events = []
+    def leg_startDTMFevent(self, digit):
+        self.events.append(('start', digit))
+    def leg_stopDTMFevent(self, digit):
+        self.events.append(('stop', digit))
+
+class DTMFServiceTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('numpy needed for dtmf detection')
+
+    def test_service(self):
+        from twisted.internet import task
+        from shtoom.audio.clock import MediaClock
+        from shtoom.doug.dtmf import DtmfService, dtmfGenerator
+        from shtoom.doug.leg import InbandDtmfDetector
+        ae = self.assertEqual
+        reactor = task.Clock()
+        service = DtmfService(MediaClock(reactor=reactor))
+        legs = [FakeLeg() for x in range(3)]
+        dets = [InbandDtmfDetector(leg, service) for leg in legs]
+        ae(len(service), 3)
+        tone = dtmfGenerator('5', 960)
+        silence = b'\0' * 320
+        for n in range(6):
+            dets[0](tone[n*320:(n+1)*320])
+            dets[1](silence)
+        # The third leg has no audio at all
+        for n in range(2):
+            dets[0](silence)
+            dets[1](silence)
+        reactor.pump([0.02] * 10)
+        ae(legs[0].events, [('start', '5'), ('stop', '5')])
+        ae(legs[1].events, [])
+        ae(legs[2].events, [])
+        ae(dets[0].frames, [])
+        # Removing a leg moves the last one into its place
+        dets[0].close()
+        ae(dets[2]._dtmfRow, 0)
+        ae(len(service), 2)
+        dets[1].close()
+        dets[2].close()
+        ae(len(service), 0)
+        ae(reactor.getDelayedCalls(), [])
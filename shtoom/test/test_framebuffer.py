@@ -0,0 +1,60 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.audio.framebuffer
+"""
+
+from twisted.trial import unittest
+
+class FrameBufferTest(unittest.TestCase):
+
+    def testFrames(self):
+        from shtoom.audio.framebuffer import FrameBuffer
+        ae = self.assertEqual
+        b = FrameBuffer()
+        ae(len(b), 0)
+        ae(b.frames(4), [])
+        b.write(b'abcdefghij')
+        ae(b.frames(4), [b'abcd', b'efgh'])
+        ae(len(b), 2)
+        b.write(memoryview(b'klmnop'))
+        ae(b.frames(4), [b'ijkl', b'mnop'])
+        ae(len(b), 0)
+        ae(b._buf, bytearray())
+
+    def testRead(self):
+        from shtoom.audio.framebuffer import FrameBuffer
+        ae = self.assertEqual
+        b = FrameBuffer(b'0123456789')
+        ae(b.read(3), b'012')
+        ae(b.read(0), b'')
+        ae(b.read(), b'3456789')
+        ae(b.read(3), b'')
+        b.write(b'xy')
+        ae(b.read(5), b'xy')
+        b.write(b'z')
+        b.clear()
+        ae(len(b), 0)
+
+    def testCompaction(self):
+        from shtoom.audio import framebuffer
+        ae = self.assertEqual
+        data = bytes(range(256)) * 64
+        b = framebuffer.FrameBuffer(data)
+        b.write(b'tail')
+        out = []
+        while len(b) >= 320:
+            out.extend(b.frames(320))
+            # What's been read doesn't hang around
+            self.assertTrue(b._off < framebuffer.COMPACT_SIZE or
+                            b._off * 2 < len(b._buf))
+        ae(b''.join(out) + b.read(), data + b'tail')
+
+    def testEchoSource(self):
+        from shtoom.doug.source import EchoSource
+        ae = self.assertEqual
+        e = EchoSource()
+        ae(e.read(), b'')
+        e.write(b'\1' * 500)
+        ae(e.read(), b'\1' * 320)
+        ae(e.read(), b'')
+        e.write(b'\2' * 140)
+        ae(e.read(), b'\1' * 180 + b'\2' * 140)
@@ -0,0 +1,75 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.audio.g711
+"""
+
+import struct
+
+from twisted.trial import unittest
+
+# Every 16 bit sample, and every code
+allSamples = struct.pack('65536h', *range(-32768, 32768))
+allCodes = bytes(range(256))
+
+def _audioop():
+    try:
+        import audioop
+    except ImportError:
+        raise unittest.SkipTest("no audioop to compare against")
+    return audioop
+
+class G711Test(unittest.TestCase):
+
+    def testULawMatchesAudioop(self):
+        from shtoom.audio import g711
+        audioop = _audioop()
+        ae = self.assertEqual
+        ae(g711.lin2ulaw(allSamples), audioop.lin2ulaw(allSamples, 2))
+        ae(g711.ulaw2lin(allCodes), audioop.ulaw2lin(allCodes, 2))
+
+    def testALawMatchesAudioop(self):
+        from shtoom.audio import g711
+        audioop = _audioop()
+        ae = self.assertEqual
+        ae(g711.lin2alaw(allSamples), audioop.lin2alaw(allSamples, 2))
+        ae(g711.alaw2lin(allCodes), audioop.alaw2lin(allCodes, 2))
+
+    def testKnownValues(self):
+        from shtoom.audio import g711
+        ae = self.assertEqual
+        silence = struct.pack('4h', 0, 0, 32767, -32768)
+        ae(g711.lin2ulaw(silence), b'\xff\xff\x80\x00')
+        ae(g711.lin2alaw(silence), b'\xd5\xd5\xaa\x2a')
+        ae(struct.unpack('2h', g711.ulaw2lin(b'\xff\x00')), (0, -32124))
+        ae(struct.unpack('2h', g711.alaw2lin(b'\xd5\xaa')), (8, 32256))
+
+    def testRoundTrip(self):
+        from shtoom.audio import g711
+        ae = self.assertEqual
+        for law in g711.ulaw, g711.alaw:
+            pcm = law.decode(allCodes)
+            ae(law.decode(law.encode(pcm)), pcm)
+
+    def testPurePython(self):
+        from shtoom.audio import g711
+        ae = self.assertEqual
+        numpy = g711.numpy
+        expected = [g711.lin2ulaw(allSamples), g711.ulaw2lin(allCodes)]
+        g711.numpy = None
+        try:
+            ae([g711.lin2ulaw(allSamples), g711.ulaw2lin(allCodes)], expected)
+        finally:
+            g711.numpy = numpy
+
+    def testBatch(self):
+        from shtoom.audio import g711
+        if g711.numpy is None:
+            raise unittest.SkipTest("no numpy")
+        numpy = g711.numpy
+        ae = self.assertEqual
+        frames = numpy.arange(-32768, 32768, dtype=numpy.int16)
+        frames = frames.reshape((256, 256))
+        codes = g711.alaw.encodeSamples(frames)
+        ae(codes.shape, frames.shape)
+        ae(codes.tobytes(), g711.lin2alaw(frames.tobytes()))
+        ae(g711.alaw.decodeCodes(codes).tobytes(),
+           g711.alaw2lin(codes.tobytes()))
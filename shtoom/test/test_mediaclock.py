@@ -0,0 +1,79 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.audio.clock
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+class MediaClockTest(unittest.TestCase):
+
+    def setUp(self):
+        from shtoom.audio.clock import MediaClock
+        self.reactor = task.Clock()
+        self.clock = MediaClock(reactor=self.reactor)
+
+    def test_ticks(self):
+        ae = self.assertEqual
+        calls = []
+        c = self.clock.call(lambda: calls.append(1))
+        self.assertTrue(self.clock.isRunning())
+        self.reactor.pump([0.02] * 10)
+        ae(len(calls), 10)
+        c.stop()
+        self.assertFalse(self.clock.isRunning())
+        self.reactor.pump([0.02] * 10)
+        ae(len(calls), 10)
+        ae(self.reactor.getDelayedCalls(), [])
+
+    def test_priority(self):
+        from shtoom.audio.clock import PRIORITY_DEVICE, PRIORITY_ROOM
+        from shtoom.audio.clock import PRIORITY_LEG
+        order = []
+        self.clock.call(lambda: order.append('leg'), PRIORITY_LEG)
+        self.clock.call(lambda: order.append('room'), PRIORITY_ROOM)
+        self.clock.call(lambda: order.append('device'), PRIORITY_DEVICE)
+        self.clock.tick()
+        self.assertEqual(order, ['device', 'room', 'leg'])
+
+    def test_catchup(self):
+        ae = self.assertEqual
+        calls = []
+        self.clock.call(lambda: calls.append(self.reactor.seconds()))
+        # The reactor's 50ms late - we get three ticks at once
+        self.reactor.advance(0.07)
+        ae(len(calls), 3)
+        ae(self.clock.lateTicks, 2)
+        # And we're back on the original schedule
+        self.reactor.advance(0.01)
+        ae(len(calls), 4)
+
+    def test_skipAhead(self):
+        from shtoom.audio.clock import MAX_CATCHUP_TICKS
+        ae = self.assertEqual
+        calls = []
+        self.clock.call(lambda: calls.append(1))
+        self.reactor.advance(1.0)
+        ae(len(calls), MAX_CATCHUP_TICKS)
+        ae(self.clock.skippedTicks, 50 - MAX_CATCHUP_TICKS)
+
+    def test_stopDuringTick(self):
+        ae = self.assertEqual
+        calls = []
+        def first():
+            calls.append('first')
+            second.stop()
+        self.clock.call(first)
+        second = self.clock.call(lambda: calls.append('second'))
+        self.reactor.advance(0.02)
+        ae(calls, ['first'])
+        ae(self.clock.clientCount(), 1)
+
+    def test_errorsDontStopClock(self):
+        calls = []
+        def broken():
+            raise ValueError("oops")
+        self.clock.call(broken)
+        self.clock.call(lambda: calls.append(1))
+        self.reactor.pump([0.02] * 3)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 3)
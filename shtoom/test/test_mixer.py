@@ -0,0 +1,282 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.doug.mixer and conference room mixing
+"""
+
+from twisted.trial import unittest
+import struct
+
+def frame(*samples):
+    return struct.pack('=%dh'%len(samples), *samples)
+
+def unframe(data):
+    return list(struct.unpack('=%dh'%(len(data)//2), data))
+
+class MixerTest(unittest.TestCase):
+
+    def mixers(self):
+        from shtoom.doug.mixer import Mixer, numpy
+        m = Mixer()
+        yield m.mix
+        if numpy is not None:
+            yield m._mixAudioop
+
+    def test_nMinusOne(self):
+        ae = self.assertEqual
+        frames = [frame(300, 300), frame(600, -600), frame(900, 0)]
+        for mix in self.mixers():
+            default, outs = mix(frames)
+            ae(unframe(default), [600, -100])
+            ae([unframe(o) for o in outs],
+               [[750, -300], [600, 150], [450, -150]])
+
+    def test_single(self):
+        from shtoom.doug.mixer import Mixer
+        default, outs = Mixer().mix([frame(1, 2)])
+        self.assertEqual(default, frame(1, 2))
+        self.assertEqual(outs, [b''])
+        self.assertEqual(Mixer().mix([]), (b'', []))
+
+    def test_shortFramesPadded(self):
+        for mix in self.mixers():
+            default, outs = mix([frame(100, 100), frame(100)])
+            self.assertEqual(unframe(default), [100, 50])
+            self.assertEqual(unframe(outs[0]), [100, 0])
+
+    def test_loudDoesntWrap(self):
+        for mix in self.mixers():
+            default, outs = mix([frame(32767, -32768)] * 3)
+            for out in default, outs[2]:
+                hi, lo = unframe(out)
+                # (near enough - the audioop version rounds down)
+                self.assertTrue(hi >= 32765, hi)
+                self.assertTrue(lo <= -32766, lo)
+
+    def test_manySpeakers(self):
+        from shtoom.doug.mixer import Mixer
+        frames = [frame(*([i * 10] * 160)) for i in range(40)]
+        default, outs = Mixer().mix(frames)
+        self.assertEqual(len(outs), 40)
+        total = sum([i * 10 for i in range(40)])
+        self.assertEqual(unframe(outs[5])[0], (total - 50) // 39)
+
+
+class FakeMember:
+    def __init__(self, audio):
+        self.audio = audio
+    def getAudioForRoom(self):
+        return self.audio
+
+class RoomMixTest(unittest.TestCase):
+
+    def test_mixAudio(self):
+        from shtoom.doug.conferencing import Room
+        ae = self.assertEqual
+        room = Room('testroom', MaxSpeakers=2)
+        try:
+            loud = FakeMember(frame(3000, 3000))
+            medium = FakeMember(frame(1000, 1000))
+            quiet = FakeMember(frame(10, 10))
+            listener = FakeMember(None)
+            for m in loud, medium, quiet, listener:
+                room._members.add(m)
+            room.mixAudio()
+            ae(unframe(room.readAudio(listener)), [2000, 2000])
+            ae(unframe(room.readAudio(quiet)), [2000, 2000])
+            ae(room.readAudio(loud), frame(1000, 1000))
+            ae(room.readAudio(medium), frame(3000, 3000))
+        finally:
+            room.shutdown()
+
+
+class SpeakerTrackerTest(unittest.TestCase):
+
+    def run_ticks(self, tracker, levels, ticks, maxSpeakers=2):
+        "levels is {member: sample value}"
+        for i in range(ticks):
+            tracker.newTick()
+            audioIn = {}
+            for m, level in levels.items():
+                audio = level and frame(*([level, -level] * 80)) or None
+                if audio:
+                    audioIn[m] = audio
+                tracker.update(m, audio)
+            speakers = tracker.select(audioIn, maxSpeakers)
+        return speakers
+
+    def test_hysteresis(self):
+        from shtoom.doug.conferencing import SpeakerTracker
+        ae = self.assertEqual
+        t = SpeakerTracker()
+        ae(self.run_ticks(t, {'a': 2000, 'b': 1500, 'c': 1000}, 10),
+           ['a', 'b'])
+        # c gets a bit louder than b - not enough to take over
+        ae(self.run_ticks(t, {'a': 2000, 'b': 1500, 'c': 1800}, 10),
+           ['a', 'b'])
+        # much louder - c's in, b's out
+        ae(self.run_ticks(t, {'a': 2000, 'b': 1500, 'c': 5000}, 10),
+           ['c', 'a'])
+
+    def test_quietTalkers(self):
+        from shtoom.doug.conferencing import SpeakerTracker
+        ae = self.assertEqual
+        t = SpeakerTracker()
+        # Below ON_LEVEL, but there's room for them
+        ae(self.run_ticks(t, {'a': 300, 'b': 150, 'c': 5}, 10, 4),
+           ['a', 'b'])
+        t = SpeakerTracker()
+        self.run_ticks(t, {'a': 150}, 10, 1)
+        # Not loud enough to take over...
+        ae(self.run_ticks(t, {'a': 150, 'b': 300}, 10, 1), ['a'])
+        # ... but someone who is needn't be twice as loud as a quiet one
+        ae(self.run_ticks(t, {'a': 150, 'b': 450}, 10, 1), ['b'])
+
+    def test_decay(self):
+        from shtoom.doug.conferencing import SpeakerTracker
+        ae = self.assertEqual
+        t = SpeakerTracker()
+        self.run_ticks(t, {'a': 2000, 'b': 1000}, 10)
+        # b pauses for a breath, then carries on, and stays a speaker
+        self.run_ticks(t, {'a': 2000, 'b': 10}, 3)
+        ae(t.speakers, ['a', 'b'])
+        # ... but not if they stop for good
+        self.run_ticks(t, {'a': 2000, 'b': 10}, 50)
+        ae(t.speakers, ['a'])
+
+    def test_gatedMembersNotMeasured(self):
+        from shtoom.doug.conferencing import SpeakerTracker
+        ae = self.assertEqual
+        t = SpeakerTracker()
+        listeners = dict([(i, 5) for i in range(100)])
+        self.run_ticks(t, listeners, 2)
+        t.measured = 0
+        self.run_ticks(t, listeners, 50)
+        # each listener is only looked at every PROBE_TICKS ticks
+        ae(t.measured, 100 * 50 // t.PROBE_TICKS)
+        # and a listener who starts talking is noticed
+        listeners[7] = 3000
+        ae(self.run_ticks(t, listeners, t.PROBE_TICKS + 1), [7])
+
+    def test_rms(self):
+        from shtoom.doug import conferencing
+        ae = self.assertEqual
+        audio = frame(*([3000, -3000, 400, -400] * 40))
+        ae(conferencing.rms(b''), 0)
+        ae(conferencing.rms(frame(*([0] * 160))), 0)
+        expected = conferencing.rms(audio)
+        ae(expected, 2140)
+        numpy, audioop = conferencing.numpy, getattr(conferencing,
+                                                     'audioop', None)
+        conferencing.numpy = conferencing.audioop = None
+        try:
+            ae(conferencing.rms(audio), expected)
+        finally:
+            conferencing.numpy, conferencing.audioop = numpy, audioop
+
+    def test_smallRoomGating(self):
+        from shtoom.doug.conferencing import Room
+        ae = self.assertEqual
+        room = Room('smallroom')
+        try:
+            room._members.add(FakeMember(frame(*([5] * 160))))
+            for i in range(20):
+                room.mixAudio()
+            # On their own, they're still only probed every so often
+            tracker = room._tracker
+            ae(tracker.tick, 20)
+            ae(tracker.measured, 1 + (20 - 1) // tracker.PROBE_TICKS)
+        finally:
+            room.shutdown()
+
+    def test_remove(self):
+        from shtoom.doug.conferencing import SpeakerTracker
+        t = SpeakerTracker()
+        self.run_ticks(t, {'a': 2000}, 2)
+        t.remove('a')
+        self.assertEqual(t.speakers, [])
+        self.assertEqual(t.energy, {})
+
+
+class SharedEncodingTest(unittest.TestCase):
+
+    def test_listenersShareEncoding(self):
+        from shtoom.doug.conferencing import Room
+        from shtoom.rtp.formats import PT_PCMU, PT_PCMA
+        ae = self.assertEqual
+        room = Room('sharedroom', MaxSpeakers=2)
+        try:
+            talker = FakeMember(frame(*([3000] * 160)))
+            listeners = [FakeMember(None) for i in range(3)]
+            for m in [talker] + listeners:
+                room._members.add(m)
+            room.mixAudio()
+            # the talker has their own mix (silence, here)
+            ae(room.readEncoded(talker, PT_PCMU), None)
+            first = room.readEncoded(listeners[0], PT_PCMU)
+            ae(len(first), 1)
+            ae(first[0].ct, PT_PCMU)
+            self.assertTrue(room.readEncoded(listeners[1], PT_PCMU) is first)
+            alaw = room.readEncoded(listeners[2], PT_PCMA)
+            self.assertTrue(alaw is not first)
+            ae(len(room._encodedDefault), 2)
+            # Next tick, it's encoded afresh
+            room.mixAudio()
+            self.assertTrue(room.readEncoded(listeners[1], PT_PCMU)
+                            is not first)
+        finally:
+            room.shutdown()
+
+    def test_silence(self):
+        from shtoom.doug.conferencing import Room
+        from shtoom.rtp.formats import PT_PCMU
+        room = Room('quietroom')
+        try:
+            a, b = FakeMember(None), FakeMember(None)
+            room._members.add(a)
+            room._members.add(b)
+            room.mixAudio()
+            self.assertEqual(room.readEncoded(a, PT_PCMU), [])
+        finally:
+            room.shutdown()
+
+    def test_legUsesSharedEncoding(self):
+        from shtoom.doug.leg import Leg
+        from shtoom.doug.source import Source
+        from shtoom.audio.converters import MediaSample
+        from shtoom.rtp.formats import PT_PCMU
+        ae = self.assertEqual
+        shared = [MediaSample(PT_PCMU, b'\xff' * 160)]
+        class SharedSource(Source):
+            encoded = shared
+            def readEncoded(self, fmt):
+                self.fmt = fmt
+                return self.encoded
+            def read(self):
+                return frame(*([100] * 160))
+        class App:
+            def __init__(self):
+                self.sent = []
+            def va_outgoingRTP(self, sample, cookie):
+                self.sent.append(sample)
+        from twisted.internet import task
+        from shtoom.audio.clock import MediaClock
+        from shtoom.doug.leg import LegAudioService
+        app = App()
+        leg = Leg('cookie', None, voiceapp=app)
+        try:
+            leg._stopAudio()
+            service = LegAudioService(MediaClock(reactor=task.Clock()))
+            leg.LC = service.add(leg)
+            src = SharedSource()
+            leg._connectSource(src)
+            service.tick()
+            ae(src.fmt, PT_PCMU)
+            ae(app.sent, shared)
+            src.encoded = []
+            service.tick()
+            ae(app.sent[-1], None)
+            src.encoded = None
+            service.tick()
+            ae(app.sent[-1].ct, PT_PCMU)
+            ae(len(app.sent[-1].data), 160)
+        finally:
+            leg._stopAudio()
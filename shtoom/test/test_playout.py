@@ -0,0 +1,249 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.audio.playout
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+PACKET = 320    # 20ms of 16 bit 8KHz audio
+
+class DummyWriter:
+    def __init__(self):
+        self.b = []
+    def write(self, data):
+        self.b.append(data)
+
+class DummyMediaLayer:
+    def __init__(self):
+        self._d = DummyWriter()
+
+def packet(seq):
+    return ('%d'%(seq,)).encode('ascii').ljust(PACKET, b'\0')
+
+class PlayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        from shtoom.audio import playout
+        self.clock = task.Clock()
+        self.patch(playout, 'reactor', self.clock)
+        self.patch(playout, 'PLAYOUT_BUFFER_SECONDS', 0.03)
+        self.ml = DummyMediaLayer()
+        self.p = playout.Playout(self.ml, clock=self.clock.seconds)
+        self.npackets = int(playout.JITTER_BUFFER_SECONDS * playout.BPS
+                            / PACKET)
+
+    def played(self):
+        return [int(x.rstrip(b'\0')) for x in self.ml._d.b]
+
+    def test_refillThenPlay(self):
+        ae = self.assertEqual
+        for seq in range(self.npackets - 1):
+            self.p.write(packet(seq), seq)
+        ae(self.played(), [])
+        self.assertTrue(self.p.refillmode)
+        self.p.write(packet(self.npackets - 1), self.npackets - 1)
+        self.assertFalse(self.p.refillmode)
+        # 30ms of playout buffer - two packets go straight out
+        ae(self.played(), [0, 1])
+        self.clock.advance(0.021)
+        ae(self.played(), [0, 1, 2])
+
+    def test_reordered(self):
+        ae = self.assertEqual
+        order = []
+        for seq in range(0, self.npackets, 2):
+            order.extend([seq + 1, seq])
+        for seq in order:
+            self.p.write(packet(seq), seq)
+        self.assertFalse(self.p.refillmode)
+        for i in range(self.npackets):
+            self.clock.advance(0.02)
+        ae(self.played(), list(range(self.npackets)))
+
+    def test_gapSkippedOnRefill(self):
+        ae = self.assertEqual
+        # A short run, a gap, then a full jitter buffer's worth
+        for seq in range(5):
+            self.p.write(packet(seq), seq)
+        for seq in range(10, 10 + self.npackets):
+            self.p.write(packet(seq), seq)
+        self.assertFalse(self.p.refillmode)
+        ae(self.played()[:2], [10, 11])
+        # Stragglers from before the run are too late now
+        self.p.write(packet(7), 7)
+        ae(self.p._has(7), False)
+
+    def test_duplicate(self):
+        from shtoom.audio import playout
+        self.p.write(packet(1), 1)
+        self.p.write(packet(1), 1)
+        self.assertEqual(self.p._headrun(), 0)
+        self.assertEqual(self.p._runbytes[1 & self.p._mask], PACKET)
+
+    def test_runsJoin(self):
+        ae = self.assertEqual
+        p = self.p
+        for seq in (100, 101, 103, 104, 105):
+            p.write(packet(seq), seq)
+        mask = p._mask
+        ae(p._other[100 & mask], 101)
+        ae(p._other[103 & mask], 105)
+        p.write(packet(102), 102)
+        ae(p._other[100 & mask], 105)
+        ae(p._other[105 & mask], 100)
+        ae(p._runbytes[100 & mask], 6 * PACKET)
+
+    def test_sequenceWrap(self):
+        ae = self.assertEqual
+        seqs = [(65536 - self.npackets//2 + i) & 0xffff
+                for i in range(self.npackets)]
+        for seq in seqs:
+            self.p.write(packet(seq), seq)
+        self.assertFalse(self.p.refillmode)
+        for i in range(self.npackets):
+            self.clock.advance(0.02)
+        ae(self.played(), seqs)
+
+    def test_catchup(self):
+        from shtoom.audio import playout
+        ae = self.assertEqual
+        catchup = int(playout.CATCHUP_TRIGGER_SECONDS * playout.BPS / PACKET)
+        for seq in range(catchup + 2):
+            self.p.write(packet(seq), seq)
+        # Once more than CATCHUP_TRIGGER_SECONDS is waiting, the oldest
+        # packet is dropped rather than played.
+        played = self.played()
+        ae(played[:2], [0, 1])
+        self.assertTrue(self.p._headrun() < catchup * PACKET)
+        self.assertTrue(self.p.s > max(played))
+
+    def test_underrunRefills(self):
+        ae = self.assertEqual
+        for seq in range(self.npackets):
+            self.p.write(packet(seq), seq)
+        for i in range(self.npackets + 2):
+            self.clock.advance(0.02)
+        ae(len(self.played()), self.npackets)
+        self.p.write(packet(self.npackets + 5), self.npackets + 5)
+        self.assertTrue(self.p.refillmode)
+
+class AdaptivePlayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        from shtoom.audio import playout
+        self.clock = task.Clock()
+        self.patch(playout, 'reactor', self.clock)
+        self.patch(playout, 'PLAYOUT_BUFFER_SECONDS', 0.03)
+        self.ml = DummyMediaLayer()
+        self.p = playout.AdaptivePlayout(self.ml, clock=self.clock.seconds)
+
+    def tearDown(self):
+        self.p.close()
+
+    def played(self):
+        return [int(x.rstrip(b'\0')) for x in self.ml._d.b]
+
+    def feed(self, seqs, jitter=0.0, start=0):
+        for i, seq in enumerate(seqs):
+            self.p.write(packet(seq), seq, ts=seq * 160,
+                         marker=(seq == start))
+            # alternate early and late arrivals
+            self.clock.advance(0.02 + (i % 2 and jitter or -jitter))
+
+    def test_cleanNetworkShrinksDelay(self):
+        from shtoom.audio import playout
+        self.feed(range(50))
+        self.assertTrue(self.p.jitter < 0.001)
+        self.feed(range(100, 150), start=100)
+        self.assertEqual(self.p.target, playout.MIN_DELAY_SECONDS)
+        # Much less than the fixed policy's 0.8s before audio starts
+        self.assertTrue(len(self.played()) > 80)
+
+    def test_jitterGrowsDelay(self):
+        from shtoom.audio import playout
+        self.feed(range(100), jitter=0.015)
+        self.assertTrue(self.p.jitter > 0.014, self.p.jitter)
+        self.feed(range(200, 210), jitter=0.015, start=200)
+        self.assertTrue(self.p.target > 0.075, self.p.target)
+        self.assertTrue(self.p.target > playout.MIN_DELAY_SECONDS)
+        self.assertAlmostEqual(self.p.jitterbuffer, self.p.target)
+
+    def test_talkspurtStartsAfterTarget(self):
+        ae = self.assertEqual
+        p = self.p
+        p.write(packet(0), 0, ts=0, marker=1)
+        target = p.target
+        ae(self.played(), [])
+        self.clock.advance(target - 0.001)
+        ae(self.played(), [])
+        self.clock.advance(0.002)
+        ae(self.played(), [0])
+
+    def test_timestampWrap(self):
+        p = self.p
+        p.write(packet(0), 0, ts=0xffffff60, marker=1)
+        self.clock.advance(0.02)
+        p.write(packet(1), 1, ts=0)
+        self.assertTrue(p.jitter < 0.001)
+
+    def test_getPlayout(self):
+        from shtoom.audio import playout
+        self.assertTrue(isinstance(playout.getPlayout(self.ml),
+                                   playout.Playout))
+        self.assertTrue(isinstance(playout.getPlayout(self.ml, 'adaptive'),
+                                   playout.AdaptivePlayout))
+
+class SkewTest(unittest.TestCase):
+
+    def test_estimator(self):
+        from shtoom.audio.playout import SkewEstimator, SKEW_WARMUP
+        ae = self.assertEqual
+        e = SkewEstimator()
+        # Sender 1% fast: 20ms of timestamps every 19.8ms
+        for i in range(SKEW_WARMUP):
+            e.update(i * 160, i * 0.0198)
+        ae(e.pending(), 0)
+        for i in range(SKEW_WARMUP, 1000):
+            e.update(i * 160, i * 0.0198)
+        self.assertTrue(e.drift() < -0.02, e.drift())
+        ae(e.pending(), -1)
+        e.corrected(e.drift())
+        ae(e.pending(), 0)
+        ae(e.dropped, 1)
+
+    def test_estimatorWrap(self):
+        from shtoom.audio.playout import SkewEstimator
+        e = SkewEstimator()
+        for i in range(1000):
+            e.update((0xffff0000 + i * 160) & 0xffffffff, i * 0.02)
+        self.assertAlmostEqual(e.drift(), 0.0)
+
+    def runSender(self, audio, interval, count=600):
+        from shtoom.audio import playout
+        clock = task.Clock()
+        self.patch(playout, 'reactor', clock)
+        self.patch(playout, 'PLAYOUT_BUFFER_SECONDS', 0.03)
+        ml = DummyMediaLayer()
+        p = playout.Playout(ml, clock=clock.seconds)
+        for i in range(count):
+            p.write(audio, i, ts=i * 160)
+            clock.advance(interval)
+        return p
+
+    def test_dropSilenceWhenSenderFast(self):
+        p = self.runSender(b'\0' * PACKET, 0.0198)
+        self.assertTrue(p.skew.dropped > 0)
+        self.assertEqual(p.skew.inserted, 0)
+        self.assertTrue(abs(p.skew.drift()) <= 0.02 + 0.001)
+
+    def test_repeatSilenceWhenSenderSlow(self):
+        p = self.runSender(b'\0' * PACKET, 0.0202)
+        self.assertTrue(p.skew.inserted > 0)
+        self.assertEqual(p.skew.dropped, 0)
+
+    def test_speechUntouched(self):
+        import struct
+        loud = struct.pack('<160h', *([8000, -8000] * 80))
+        p = self.runSender(loud, 0.0198)
+        self.assertEqual(p.skew.dropped, 0)
+        self.assertEqual(p.skew.pending(), -1)
@@ -0,0 +1,168 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.doug.promptcache
+"""
+
+import os
+
+from twisted.trial import unittest
+
+class FakeLeg:
+    done = False
+    def _sourceDone(self, source):
+        self.done = True
+
+class PromptCacheTest(unittest.TestCase):
+
+    def makePrompt(self, frames, name='prompt.raw'):
+        import audioop
+        path = os.path.abspath(self.mktemp())
+        os.makedirs(path)
+        path = os.path.join(path, name)
+        # a tone, so the frames don't all encode the same
+        pcm = b''.join([audioop.mul(b'\x00\x10\x00\xf0' * 80, 2, n + 1)
+                        for n in range(frames)])
+        open(path, 'wb').write(pcm[:-100])
+        return path
+
+    def test_encodeAndHit(self):
+        from shtoom.doug.promptcache import PromptCache
+        from shtoom.rtp.formats import PT_PCMU, PT_PCMA
+        ae = self.assertEqual
+        path = self.makePrompt(5)
+        cache = PromptCache()
+        p = cache.get(path, PT_PCMU)
+        # The short last frame is padded out
+        ae(len(p), 5)
+        ae([len(f) for f in p.frames], [160] * 5)
+        self.assertTrue(cache.get(path, PT_PCMU) is p)
+        self.assertTrue(cache.get(path, PT_PCMA) is not p)
+        stats = cache.getStats()
+        ae((stats['hits'], stats['misses'], stats['prompts']), (1, 2, 2))
+
+    def test_lruBySize(self):
+        from shtoom.doug.promptcache import PromptCache
+        from shtoom.rtp.formats import PT_PCMU
+        ae = self.assertEqual
+        paths = [self.makePrompt(10, 'p%d.raw' % n) for n in range(3)]
+        cache = PromptCache(maxBytes=3500)
+        cache.get(paths[0], PT_PCMU)
+        cache.get(paths[1], PT_PCMU)
+        cache.get(paths[0], PT_PCMU)
+        # p1 was used least recently
+        cache.get(paths[2], PT_PCMU)
+        ae(len(cache), 2)
+        ae(cache.evictions, 1)
+        ae(cache.getStats()['hits'], 1)
+        cache.get(paths[0], PT_PCMU)
+        ae(cache.getStats()['hits'], 2)
+        self.assertTrue(cache.size <= 3500)
+
+    def test_sidecar(self):
+        from shtoom.doug.promptcache import PromptCache
+        from shtoom.rtp.formats import PT_PCMU
+        ae = self.assertEqual
+        path = self.makePrompt(4)
+        sidecars = self.mktemp()
+        os.makedirs(sidecars)
+        p1 = PromptCache(sidecarDir=sidecars).get(path, PT_PCMU)
+        ae(len(os.listdir(sidecars)), 1)
+        # A fresh cache maps the sidecar rather than encoding again
+        import shtoom.doug.promptcache as promptcache
+        self.patch(promptcache, 'encodePrompt', lambda pcm, fmt: self.fail())
+        p2 = PromptCache(sidecarDir=sidecars).get(path, PT_PCMU)
+        ae([bytes(f) for f in p2.frames], [bytes(f) for f in p1.frames])
+
+    def test_source(self):
+        from shtoom.doug.promptcache import PromptCache, CachedPromptSource
+        from shtoom.rtp.formats import PT_PCMU, PT_PCMA
+        ae = self.assertEqual
+        path = self.makePrompt(2)
+        prompt = PromptCache().get(path, PT_PCMU)
+        s = CachedPromptSource(path, prompt)
+        s.leg = FakeLeg()
+        samples = s.readEncoded(PT_PCMU)
+        ae(len(samples), 1)
+        ae(samples[0].ct, PT_PCMU)
+        ae(bytes(samples[0].data), bytes(prompt.frames[0]))
+        # Some other format - fall back to the file
+        ae(s.readEncoded(PT_PCMA), None)
+        ae(bytes(s.read()), open(path, 'rb').read()[320:640])
+        ae(s.readEncoded(PT_PCMU), [])
+        ae(s.leg.done, True)
+        s.close()
+
+    def test_cacheable(self):
+        from shtoom.doug.promptcache import PromptCache
+        ae = self.assertEqual
+        prompts = os.path.abspath(self.mktemp())
+        cache = PromptCache(promptDirs=[prompts])
+        ae(cache.isCacheable(os.path.join(prompts, 'menu.raw')), True)
+        ae(cache.isCacheable(os.path.join(prompts, 'sub', 'menu.raw')), True)
+        # Not a prefix match on the name
+        ae(cache.isCacheable(prompts + 'x/menu.raw'), False)
+        ae(cache.isCacheable('/var/spool/voicemail/1.raw'), False)
+        cache.markCacheable('/var/spool/voicemail/greeting.raw')
+        ae(cache.isCacheable('/var/spool/voicemail/greeting.raw'), True)
+
+    def test_statInterval(self):
+        from shtoom.doug.promptcache import PromptCache, STAT_INTERVAL
+        from shtoom.rtp.formats import PT_PCMU
+        ae = self.assertEqual
+        now = [1000.0]
+        path = self.makePrompt(4)
+        cache = PromptCache(clock=lambda: now[0])
+        p = cache.get(path, PT_PCMU)
+        open(path, 'ab').write(b'\0' * 640)
+        # Not looked at again yet
+        self.assertTrue(cache.get(path, PT_PCMU) is p)
+        now[0] += STAT_INTERVAL
+        p2 = cache.get(path, PT_PCMU)
+        self.assertTrue(p2 is not p)
+        ae(len(p2), 6)
+        ae(len(cache), 1)
+
+    def test_lookup(self):
+        from shtoom.doug.promptcache import PromptCache
+        from shtoom.rtp.formats import PT_PCMU
+        ae = self.assertEqual
+        path = self.makePrompt(3)
+        cache = PromptCache()
+        # A miss starts it encoding, in a thread
+        ae(cache.lookup(path, PT_PCMU), None)
+        ae(cache.lookup(path, PT_PCMU), None)
+        ae(cache.misses, 1)
+        d = cache._loading[(path, PT_PCMU)]
+        def loaded(result):
+            p = cache.lookup(path, PT_PCMU)
+            ae(len(p), 3)
+            ae(cache._loading, {})
+            ae(cache.hits, 1)
+        d.addCallback(loaded)
+        return d
+
+    def test_convertToSource(self):
+        from shtoom.doug.source import convertToSource, MappedFileSource
+        from shtoom.doug import promptcache
+        from shtoom.rtp.formats import PT_PCMU
+        path = self.makePrompt(1)
+        cache = promptcache.PromptCache()
+        self.patch(promptcache, '_cache', cache)
+        # Not a prompt
+        s = convertToSource(path, 'r', format=PT_PCMU)
+        self.assertTrue(isinstance(s, MappedFileSource))
+        s.close()
+        self.assertEqual(cache.misses, 0)
+        cache.addPromptDir(os.path.dirname(path))
+        # The first caller plays the file while it's encoded
+        s = convertToSource(path, 'r', format=PT_PCMU)
+        self.assertTrue(isinstance(s, MappedFileSource))
+        s.close()
+        def loaded(result):
+            s = convertToSource(path, 'r', format=PT_PCMU)
+            self.assertTrue(isinstance(s, promptcache.CachedPromptSource))
+            s = convertToSource(path, 'r')
+            self.assertTrue(isinstance(s, MappedFileSource))
+            s.close()
+        d = cache._loading[(path, PT_PCMU)]
+        d.addCallback(loaded)
+        return d
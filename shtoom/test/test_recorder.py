@@ -0,0 +1,89 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.doug.recorder
+"""
+
+import os, wave
+
+from twisted.trial import unittest
+
+class StuckWriter:
+    "A writer whose queue is always full"
+    def __init__(self):
+        self.tried = []
+    def submit(self, sink, op, data=None):
+        self.tried.append(data)
+        return False
+
+class RecorderTest(unittest.TestCase):
+
+    def path(self, name):
+        d = self.mktemp()
+        os.makedirs(d)
+        return os.path.join(d, name)
+
+    def test_wav(self):
+        from shtoom.doug import recorder
+        from shtoom.doug.recorder import RecordingSink, RecordingWriter
+        ae = self.assertEqual
+        self.patch(recorder, 'CHUNK_BYTES', 1000)
+        writer = RecordingWriter()
+        path = self.path('message.wav')
+        sink = RecordingSink(path, writer)
+        frames = [bytes([n]) * 320 for n in range(10)]
+        for f in frames:
+            sink.write(f)
+        ae(sink.isRecording(), True)
+        sink.close()
+        ae(sink.isRecording(), False)
+        self.assertTrue(sink.done.wait(5))
+        writer.stop()
+        ae(sink.error, None)
+        w = wave.open(path, 'rb')
+        ae(w.getparams()[:4], (1, 2, 8000, 1600))
+        ae(w.readframes(1600), b''.join(frames))
+        w.close()
+        ae(sink.getStats()['frames'], 10)
+        ae(sink.getStats()['bytes'], 3200)
+
+    def test_raw(self):
+        from shtoom.doug.recorder import RecordingSink, RecordingWriter
+        writer = RecordingWriter()
+        path = self.path('message.raw')
+        sink = RecordingSink(path, writer)
+        sink.write(b'\x01\x02' * 160)
+        sink.close()
+        self.assertTrue(sink.done.wait(5))
+        writer.stop()
+        self.assertEqual(open(path, 'rb').read(), b'\x01\x02' * 160)
+
+    def test_backpressure(self):
+        from shtoom.doug import recorder
+        from shtoom.doug.recorder import RecordingSink
+        ae = self.assertEqual
+        self.patch(recorder, 'CHUNK_BYTES', 640)
+        self.patch(recorder, 'MAX_PENDING', 1280)
+        writer = StuckWriter()
+        sink = RecordingSink(self.path('x.wav'), writer)
+        for n in range(6):
+            sink.write(b'\0' * 320)
+        stats = sink.getStats()
+        # Held on to four frames, tried to hand them over once per
+        # chunk, and had to drop the other two
+        ae(stats['pending'], 1280)
+        ae(stats['backpressure'], 2)
+        ae(stats['dropped'], 2)
+        ae(stats['bytes'], 0)
+        # Always the oldest chunk, as it was - not joined up again
+        ae(writer.tried, [b'\0' * 640] * 2)
+        ae(len(sink._chunks), 2)
+
+    def test_failedWriteClosesFile(self):
+        from shtoom.doug.recorder import RecordingSink, RecordingWriter
+        sink = RecordingSink(self.path('x.raw'), RecordingWriter())
+        sink._do_write(b'\0' * 320)
+        fp = sink._fp
+        sink.error = IOError("disk full")
+        sink._do_close(None)
+        self.assertTrue(fp.closed)
+        self.assertEqual(sink._fp, None)
+        self.assertTrue(sink.done.is_set())
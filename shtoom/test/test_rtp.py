@@ -5,34 +5,46 @@
 from twisted.trial import unittest
 
 
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def write(self, datagram, addr):
+        self.sent.append((bytes(datagram), addr))
+
+    def frames(self):
+        from shtoom.rtp.packets import parse_rtpframe
+        return [ parse_rtpframe(datagram) for datagram, addr in self.sent ]
+
+
 class TestRTP(unittest.TestCase):
     def testNTEencoding(self):
         from shtoom.rtp.packets import NTE
         ae = self.assertEqual
         nte = NTE('0', 1000)
         ae(nte.isDone(), False)
-        ae(nte.getPayload(1000), '\x00\n\x00\x00')
-        ae(nte.getPayload(1001), '\x00\n\x00\x01')
-        ae(nte.getPayload(1002), '\x00\n\x00\x02')
+        ae(nte.getPayload(1000), b'\x00\n\x00\x00')
+        ae(nte.getPayload(1001), b'\x00\n\x00\x01')
+        ae(nte.getPayload(1002), b'\x00\n\x00\x02')
         ae(nte.getPayload(1003), None)
         ae(nte.isDone(), False)
         nte.end()
         ae(nte.isDone(), False)
-        ae(nte.getPayload(1004), '\x00\x8a\x00\x04')
+        ae(nte.getPayload(1004), b'\x00\x8a\x00\x04')
         ae(nte.isDone(), True)
         ae(nte.getPayload(1004), None)
         ae(nte.isDone(), True)
-        for key, payload in ( ( '1', chr(1) ),
-                              ( '4', chr(4) ),
-                              ( '*', chr(10) ),
-                              ( '#', chr(11) ),
-                              ( 'A', chr(12) ),
-                              ( 'D', chr(15) ),
-                              ( 'flash', chr(16) ),
+        for key, payload in ( ( '1', b'\x01' ),
+                              ( '4', b'\x04' ),
+                              ( '*', b'\x0a' ),
+                              ( '#', b'\x0b' ),
+                              ( 'A', b'\x0c' ),
+                              ( 'D', b'\x0f' ),
+                              ( 'flash', b'\x10' ),
                              ):
             nte = NTE(key, 1000000)
             ae(nte.getKey(), key)
-            ae(nte.getPayload(1000258), payload+'\n\x01\x02')
+            ae(nte.getPayload(1000258), payload+b'\n\x01\x02')
 
     def testRTPDict(self):
         from shtoom.rtp.formats import PT_CN, PT_PCMU, PT_SPEEX, PT_SPEEX_16K, PT_NTE
@@ -69,6 +81,168 @@ class TestRTP(unittest.TestCase):
             ae(rpack.header.ts, ts)
             ae(rpack.header.ssrc, ssrc)
 
+    def testRTPFrameParse(self):
+        from shtoom.rtp.packets import RTPPacket, RTPFrame, parse_rtpframe
+        ae = self.assertEqual
+
+        payload = bytes(range(160))
+        pack = RTPPacket(100001, 12345, 12345678, payload, pt=0, marker=1)
+        datagram = pack.netbytes()
+        frame = parse_rtpframe(datagram)
+        a_ = self.assertTrue
+        a_(isinstance(frame, RTPFrame))
+        a_(isinstance(frame.payload, memoryview))
+        a_(frame.payload.obj is datagram)
+        a_(frame.header is frame)
+        ae((frame.ssrc, frame.seq, frame.ts, frame.pt, frame.marker),
+           (100001, 12345, 12345678, 0, 1))
+        ae(frame.data, payload)
+        self.assertRaises(AttributeError, setattr, frame, 'frobozz', 1)
+
+        # Extension header, padding and an auth tag
+        pack = RTPPacket(1, 2, 3, b'abcd', pt=8, xhdrtype=7,
+                         xhdrdata=b'12345678', authtag=b'TAG')
+        datagram = bytearray(pack.netbytes())
+        frame = parse_rtpframe(datagram, authtaglen=3)
+        ae((frame.pt, frame.marker, frame.xhdrtype), (8, 0, 7))
+        ae(bytes(frame.xhdrdata), b'12345678')
+        ae(frame.data, b'abcd')
+        ae(bytes(frame.authtag), b'TAG')
+        padded = bytearray(RTPPacket(1, 2, 3, b'abcd\0\0\0\x04',
+                                     pt=8).netbytes())
+        padded[0] |= 32
+        ae(parse_rtpframe(padded).data, b'abcd')
+
+    def testParseRTPPacketShim(self):
+        from shtoom.rtp.packets import RTPPacket, parse_rtppacket
+        ae = self.assertEqual
+        pack = RTPPacket(100001, 12345, 12345678, b'\0'*33, pt=3, marker=1)
+        rpack = parse_rtppacket(pack.netbytes())
+        self.assertTrue(isinstance(rpack, RTPPacket))
+        ae(rpack.header.pt, 3)
+        ae(rpack.header.marker, 1)
+        ae(rpack.header.seq, 12345)
+        ae(rpack.data, b'\0'*33)
+        ae(rpack.netbytes(), pack.netbytes())
+
+    def testRTPSendTemplate(self):
+        from shtoom.rtp.packets import RTPPacket, RTPSendTemplate
+        ae = self.assertEqual
+        t = RTPSendTemplate(100001, 0)
+        for seq, ts, marker in ((12345, 12345678, 0), (65537, 2**32+5, 1)):
+            data = bytes(range(160))
+            ref = RTPPacket(100001, seq, ts % 2**32, data, pt=0, marker=marker)
+            ae(bytes(t.packet(seq, ts, data, marker)), ref.netbytes())
+        # Payloads bigger than the buffer grow it
+        data = b'x' * 1000
+        ae(bytes(t.packet(1, 2, data)),
+           RTPPacket(100001, 1, 2, data, pt=0).netbytes())
+        ae(bytes(t.packet(3, 4, b'y')),
+           RTPPacket(100001, 3, 4, b'y', pt=0).netbytes())
+
+    def testSendPacketUsesTemplates(self):
+        from shtoom.rtp.protocol import RTPProtocol
+        from shtoom.rtp.packets import parse_rtpframe
+        from shtoom.rtp.formats import PT_PCMU
+        from shtoom.audio.converters import MediaSample
+        ae = self.assertEqual
+        rtp = RTPProtocol(None, 'cookie')
+        rtp.transport = FakeTransport()
+        rtp.dest = ('127.0.0.1', 5004)
+        rtp.ptdict = {PT_PCMU: 0, 0: PT_PCMU}
+        rtp.sending = True
+        seq, ts = rtp.seq, rtp.ts
+        rtp._silent = 0
+        rtp.handle_media_sample(MediaSample(PT_PCMU, b'\xff' * 160))
+        rtp.handle_media_sample(MediaSample(PT_PCMU, b'\x7f' * 160))
+        ae(list(rtp._sendTemplates.keys()), [0])
+        ae(len(rtp.transport.sent), 2)
+        for n, (datagram, addr) in enumerate(rtp.transport.sent):
+            frame = parse_rtpframe(datagram)
+            ae(addr, ('127.0.0.1', 5004))
+            ae(frame.ssrc, rtp.ssrc)
+            ae(frame.seq, (seq + n) % 2**16)
+            ae(frame.ts, ts + n * 160)
+            ae(frame.marker, n == 0 and 1 or 0)
+        ae(frame.data, b'\x7f' * 160)
+
+    def testComfortNoise(self):
+        from shtoom.rtp.protocol import RTPProtocol
+        from shtoom.rtp.formats import PT_PCMU, PT_CN
+        from shtoom.audio.converters import MediaSample
+        ae = self.assertEqual
+        rtp = RTPProtocol(None, 'cookie')
+        rtp.transport = FakeTransport()
+        rtp.dest = ('127.0.0.1', 5004)
+        rtp.ptdict = {PT_PCMU: 0, 0: PT_PCMU, PT_CN: 13, 13: PT_CN}
+        rtp.sending = True
+        seq, ts = rtp.seq, rtp.ts
+        rtp.handle_media_sample(MediaSample(PT_PCMU, b'\xff' * 160))
+        # Silence: a CN packet with the noise level, then nothing
+        rtp.handle_media_sample(MediaSample(PT_CN, b'\x3d'))
+        for n in range(10):
+            rtp.handle_media_sample(None)
+        rtp.handle_media_sample(MediaSample(PT_PCMU, b'\x7f' * 160))
+        sent = rtp.transport.frames()
+        ae([f.pt for f in sent], [0, 13, 0])
+        ae(sent[1].data, b'\x3d')
+        ae([f.seq for f in sent], [seq % 2**16, (seq + 1) % 2**16,
+                                   (seq + 2) % 2**16])
+        # The clock kept going through the silence
+        ae([f.ts for f in sent], [ts, ts + 160, ts + 12 * 160])
+        # And the new talkspurt is marked
+        ae(sent[2].marker, 1)
+        # Our periodic CN packets carry the same level
+        for n in range(25):
+            rtp.handle_media_sample(None)
+        sent = rtp.transport.frames()
+        ae(sent[-1].pt, 13)
+        ae(sent[-1].data, b'\x3d')
+
+    def testRelayPacket(self):
+        from shtoom.rtp.protocol import RTPProtocol
+        from shtoom.rtp.packets import RTPPacket, parse_rtpframe
+        from shtoom.rtp.formats import PT_PCMU, PT_NTE
+        ae = self.assertEqual
+        rtp = RTPProtocol(None, 'cookie')
+        rtp.transport = FakeTransport()
+        rtp.dest = ('127.0.0.1', 5004)
+        rtp.ptdict = {PT_PCMU: 0, 0: PT_PCMU, PT_NTE: 101, 101: PT_NTE}
+        rtp.sending = True
+        seq, ts = rtp.seq, rtp.ts
+        def inbound(seq, ts, ct, data=b'\xff' * 160):
+            frame = parse_rtpframe(RTPPacket(4242, seq, ts, data,
+                                             pt=0).netbytes())
+            frame.ct = ct
+            return frame
+        rtp.relay_packet(inbound(65535, 1000, PT_PCMU))
+        # seq wraps, and a lost packet leaves a gap
+        rtp.relay_packet(inbound(1, 1320, PT_PCMU))
+        rtp.relay_packet(inbound(2, 1320, PT_NTE, b'\x01\x0a\x00\xa0'))
+        sent = rtp.transport.frames()
+        ae([f.ssrc for f in sent], [rtp.ssrc] * 3)
+        ae([f.seq for f in sent], [seq % 2**16, (seq + 2) % 2**16,
+                                   (seq + 3) % 2**16])
+        ae([f.ts for f in sent], [ts, ts + 320, ts + 320])
+        ae([f.pt for f in sent], [0, 0, 101])
+        ae(sent[0].marker, 1)
+        ae(sent[2].data, b'\x01\x0a\x00\xa0')
+        # Our own packets follow on from the relayed ones
+        ae(rtp.seq, seq + 4)
+        ae(rtp.ts, ts + 480)
+        # A new stream, with 30ms packets
+        def inbound(seq, ts, marker=0):
+            frame = parse_rtpframe(RTPPacket(5353, seq, ts, b'\xff' * 240,
+                                             pt=0, marker=marker).netbytes())
+            frame.ct = PT_PCMU
+            return frame
+        rtp.relay_packet(inbound(10, 5000))
+        rtp.relay_packet(inbound(11, 5240))
+        ae(rtp.ts, ts + 480 + 480)
+        # A talkspurt after silence is marked; the jump isn't a packet size
+        rtp.relay_packet(inbound(12, 9000, marker=1))
+        ae(rtp.ts, ts + 480 + 4000 + 240)
+
     def testSDPGen(self):
         from shtoom.rtp.formats import SDPGenerator, PTMarker
         from shtoom.sdp import SDP
@@ -0,0 +1,139 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.rtp.mux
+"""
+
+from twisted.trial import unittest
+
+from shtoom.rtp.mux import RTPDemultiplexer, RTPSocketPool
+from shtoom.rtp.packets import RTPPacket
+
+class FakeRTCP:
+    def __init__(self):
+        self.got = []
+    def datagramReceived(self, datagram, addr):
+        self.got.append(datagram)
+
+class FakeSession:
+    def __init__(self):
+        self.got = []
+        self.RTCP = FakeRTCP()
+    def datagramReceived(self, datagram, addr):
+        self.got.append(datagram)
+
+class FakePort:
+    def __init__(self, port):
+        self.port = port
+        self.written = []
+    def write(self, datagram, addr):
+        self.written.append((datagram, addr))
+    def getHost(self):
+        return self
+    def stopListening(self):
+        pass
+
+def rtp(ssrc, seq=1):
+    return RTPPacket(ssrc, seq, 0, b'\0'*160, pt=0).netbytes()
+
+class DemuxTest(unittest.TestCase):
+
+    def test_routing(self):
+        ae = self.assertEqual
+        demux = RTPDemultiplexer()
+        demux.transport = FakePort(11000)
+        s1, s2, s3 = FakeSession(), FakeSession(), FakeSession()
+        t1 = demux.addSession(s1)
+        t2 = demux.addSession(s2)
+        t3 = demux.addSession(s3)
+        # s1 and s2 are both talking to the same media server port
+        t1.connect('10.0.0.1', 5004)
+        t2.connect('10.0.0.1', 5004)
+        t3.connect('10.0.0.2', 5004)
+        demux.datagramReceived(rtp(111), ('10.0.0.1', 5004))
+        demux.datagramReceived(rtp(222), ('10.0.0.1', 5004))
+        demux.datagramReceived(rtp(333), ('10.0.0.2', 5004))
+        demux.datagramReceived(rtp(222, 2), ('10.0.0.1', 5004))
+        demux.datagramReceived(rtp(111, 2), ('10.0.0.1', 5004))
+        ae(len(s1.got), 2)
+        ae(len(s2.got), 2)
+        ae(len(s3.got), 1)
+        ae(s2.got[1], rtp(222, 2))
+        # Strangers are dropped
+        demux.datagramReceived(rtp(444), ('10.0.0.3', 5004))
+        demux.datagramReceived(rtp(444), ('10.0.0.1', 5004))
+        ae(demux.unknown, 2)
+        # RTCP (a BYE from SSRC 222) goes to the session's RTCP protocol
+        bye = b'\x81\xcb\x00\x01' + b'\x00\x00\x00\xde'
+        demux.datagramReceived(bye, ('10.0.0.1', 5004))
+        ae(s2.RTCP.got, [bye])
+        # Writes go out the shared socket to the session's peer
+        t3.write(b'hello')
+        ae(demux.transport.written, [(b'hello', ('10.0.0.2', 5004))])
+        # The far end changes SSRC. s3's the only session talking to that
+        # address, so it's still theirs, and the old SSRC is forgotten
+        demux.datagramReceived(rtp(555), ('10.0.0.2', 5004))
+        ae(len(s3.got), 2)
+        ae(demux._bySource.get((('10.0.0.2', 5004), 333)), None)
+        demux.datagramReceived(rtp(333, 2), ('10.0.0.2', 5004))
+        ae(len(s3.got), 3)
+        t2.stopListening()
+        ae(demux.sessionCount(), 2)
+        ae(demux._bySource.get((('10.0.0.1', 5004), 222)), None)
+        # Now s1's the only one left talking to 10.0.0.1
+        demux.datagramReceived(rtp(222, 3), ('10.0.0.1', 5004))
+        ae(len(s2.got), 2)
+        ae(len(s1.got), 3)
+
+    def test_pool(self):
+        ae = self.assertEqual
+        ports = []
+        def listenUDP(port, proto, interface=''):
+            p = FakePort(port)
+            proto.transport = p
+            p.protocol = proto
+            ports.append(p)
+            return p
+        pool = RTPSocketPool(2, 12001, listenUDP=listenUDP)
+        transports = [pool.allocate(FakeSession()) for x in range(5)]
+        # Even RTP ports, each with RTCP on the port above
+        ae([p.port for p in ports], [12002, 12003, 12004, 12005])
+        ae(sorted([t.getHost().port for t in transports]),
+           [12002, 12002, 12002, 12004, 12004])
+        ae(pool.sessionCount(), 5)
+        transports[0].stopListening()
+        ae(pool.sessionCount(), 4)
+        # RTCP from a peer that doesn't mux arrives on the odd port
+        session = FakeSession()
+        session.rtcpMux = False
+        t = pool.allocate(session)
+        t.connect('10.0.0.1', 5004)
+        rtcpPort = ports[[p.port for p in ports].index(
+                                        t.getHost().port + 1)]
+        rr = b'\x80\xc9\x00\x01' + b'\x00\x00\x00\xde'
+        rtcpPort.protocol.datagramReceived(rr, ('10.0.0.1', 5005))
+        ae(session.RTCP.got, [rr])
+
+    def test_sdpNegotiation(self):
+        from shtoom.rtp.protocol import RTPProtocol
+        from shtoom.sdp import SDP
+        from shtoom.rtp.formats import SDPGenerator
+        class App:
+            def selectDefaultFormat(self, cookie, sdp):
+                pass
+        class Addr:
+            rtcpMux = True
+            def getVisibleAddress(self):
+                return ('127.0.0.1', 23456)
+        offer = SDP(SDPGenerator().getSDP(Addr()).show())
+        self.assertTrue('a=rtcp-mux' in offer.show())
+        self.assertTrue(offer.getMediaDescription('audio').hasAttribute('rtcp-mux'))
+        rtp = RTPProtocol(App(), 'cookie')
+        rtp._extIP, rtp._extRTPPort = '127.0.0.1', 12000
+        rtp.rtcpMux = True
+        answer = rtp.getSDP(offer)
+        self.assertTrue(rtp.rtcpMux)
+        self.assertTrue(answer.getMediaDescription('audio').hasAttribute('rtcp-mux'))
+        # An offer without rtcp-mux turns it off
+        offer.getMediaDescription('audio')._a.pop('rtcp-mux')
+        answer = rtp.getSDP(offer)
+        self.assertFalse(rtp.rtcpMux)
+        self.assertFalse(answer.getMediaDescription('audio').hasAttribute('rtcp-mux'))
@@ -0,0 +1,112 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.rtp.ports
+"""
+
+from twisted.trial import unittest
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+class PortAllocatorTest(unittest.TestCase):
+
+    def test_allocateEven(self):
+        from shtoom.rtp.ports import PortAllocator
+        ae = self.assertEqual
+        a = PortAllocator(10001, 10010, clock=FakeClock())
+        ae(a.free(), 4)
+        ports = [a.allocate() for x in range(4)]
+        ae(ports, [10002, 10004, 10006, 10008])
+        ae(a.inUse(), 4)
+        ae(a.free(), 0)
+
+    def test_exhausted(self):
+        from shtoom.rtp.ports import PortAllocator
+        from shtoom.exceptions import NoRTPPortsAvailable, CallFailed
+        a = PortAllocator(10000, 10003, clock=FakeClock())
+        a.allocate()
+        a.allocate()
+        self.assertRaises(NoRTPPortsAvailable, a.allocate)
+        self.assertEqual(a.exhausted, 1)
+        self.assertTrue(issubclass(NoRTPPortsAvailable, CallFailed))
+
+    def test_quarantine(self):
+        from shtoom.rtp.ports import PortAllocator
+        from shtoom.exceptions import NoRTPPortsAvailable
+        ae = self.assertEqual
+        clock = FakeClock()
+        a = PortAllocator(10000, 10001, quarantine=5, clock=clock)
+        p = a.allocate()
+        ae(p, 10000)
+        a.release(p)
+        ae(a.inUse(), 0)
+        ae(a.quarantined(), 1)
+        self.assertRaises(NoRTPPortsAvailable, a.allocate)
+        clock.now = 4.9
+        self.assertRaises(NoRTPPortsAvailable, a.allocate)
+        clock.now = 5.0
+        ae(a.allocate(), 10000)
+        self.assertRaises(ValueError, a.release, 10002)
+
+    def test_releasedGoToBack(self):
+        from shtoom.rtp.ports import PortAllocator
+        clock = FakeClock()
+        a = PortAllocator(10000, 10005, quarantine=0, clock=clock)
+        p = a.allocate()
+        a.release(p)
+        # Released ports are reused last
+        self.assertEqual([a.allocate() for x in range(3)],
+                         [10002, 10004, 10000])
+
+    def test_markBusy(self):
+        from shtoom.rtp.ports import PortAllocator
+        ae = self.assertEqual
+        a = PortAllocator(10000, 10010, clock=FakeClock())
+        p = a.allocate()
+        a.markBusy(p)
+        stats = a.getStats()
+        ae(stats['bindfailures'], 1)
+        ae(stats['quarantined'], 1)
+        ae(stats['inuse'], 0)
+        ae(stats['allocations'], 1)
+
+    def test_parsePortRange(self):
+        from shtoom.rtp.ports import parsePortRange
+        self.assertEqual(parsePortRange('12000-12100'), (12000, 12100))
+
+class ProtocolPortsTest(unittest.TestCase):
+
+    def test_bindFailureSkipsPort(self):
+        from twisted.internet.error import CannotListenError
+        from shtoom.rtp import ports
+        from shtoom.rtp.protocol import RTPProtocol
+        from shtoom.rtp.rtcp import RTCPProtocol
+        ae = self.assertEqual
+        allocator = ports.PortAllocator(10000, 10005, clock=FakeClock())
+        self.patch(ports, '_allocator', allocator)
+        bound = []
+        def listenUDP(port, proto):
+            if port == 10000:
+                raise CannotListenError('', port, None)
+            class Listener:
+                def stopListening(self):
+                    bound.remove(port)
+            bound.append(port)
+            return Listener()
+        class App:
+            def getPref(self, name):
+                return None
+        rtp = RTPProtocol(App(), 'cookie')
+        rtp.RTCP = RTCPProtocol()
+        from twisted.internet import reactor
+        self.patch(reactor, 'listenUDP', lambda port, proto: listenUDP(port, proto))
+        ae(rtp._allocatePorts(listenUDP), 10002)
+        ae(bound, [10002, 10003])
+        ae(rtp._allocatedPort, 10002)
+        ae(allocator.bindFailures, 1)
+        ae(allocator.inUse(), 1)
+        rtp._releasePorts()
+        ae(allocator.inUse(), 0)
+        ae(rtp._allocatedPort, None)
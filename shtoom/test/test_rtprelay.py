@@ -0,0 +1,122 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.rtp.relay
+"""
+
+import select, socket
+
+from twisted.trial import unittest
+from twisted.internet import reactor
+
+class RTPRelayTest(unittest.TestCase):
+
+    def setUp(self):
+        from shtoom.rtp.protocol import RTPProtocol
+        from shtoom.rtp.formats import PT_PCMU, PT_NTE
+        self.phones = []
+        self.rtps = []
+        for n in range(2):
+            phone = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            phone.bind(('127.0.0.1', 0))
+            phone.setblocking(False)
+            self.phones.append(phone)
+            rtp = RTPProtocol(None, 'cookie%d' % n)
+            rtp.rtpListener = reactor.listenUDP(0, rtp, interface='127.0.0.1')
+            rtp.dest = phone.getsockname()
+            rtp.sending = True
+            self.rtps.append(rtp)
+        # The two calls use different PTs for NTE
+        self.rtps[0].ptdict = {PT_PCMU: 0, 0: PT_PCMU, PT_NTE: 101, 101: PT_NTE}
+        self.rtps[1].ptdict = {PT_PCMU: 0, 0: PT_PCMU, PT_NTE: 96, 96: PT_NTE}
+        self.relay = None
+
+    def tearDown(self):
+        if self.relay is not None:
+            self.relay.stop()
+        for rtp in self.rtps:
+            rtp.rtpListener.stopListening()
+        for phone in self.phones:
+            phone.close()
+
+    def send(self, n, packets, marked=()):
+        "Send packets from phone n to its RTPProtocol"
+        from shtoom.rtp.packets import RTPPacket
+        addr = ('127.0.0.1', self.rtps[n].rtpListener.getHost().port)
+        for seq, ts, pt, data in packets:
+            self.phones[n].sendto(RTPPacket(1234, seq, ts, data, pt=pt,
+                                            marker=seq in marked).netbytes(),
+                                  addr)
+        select.select([self.rtps[n].rtpListener.socket], [], [], 1.0)
+
+    def receive(self, n):
+        from shtoom.rtp.packets import parse_rtpframe
+        phone = self.phones[n]
+        select.select([phone], [], [], 1.0)
+        frames = []
+        while True:
+            try:
+                frames.append(parse_rtpframe(phone.recv(2048)))
+            except BlockingIOError:
+                return frames
+
+    def test_relay(self):
+        from shtoom.rtp.relay import relayRTP
+        ae = self.assertEqual
+        rtp0, rtp1 = self.rtps
+        seq, ts = rtp1.seq, rtp1.ts
+        self.relay = relayRTP(rtp0, rtp1, reactor)
+        ae(rtp0._relay, self.relay)
+        self.send(0, [(100, 8000, 0, b'\xff' * 160),
+                      # one lost
+                      (102, 8320, 0, b'\x7f' * 160),
+                      (103, 8320, 101, b'\x01\x0a\x00\xa0'),
+                      # not negotiated
+                      (104, 8480, 8, b'\xd5' * 160)])
+        self.relay.halves[0].doRead()
+        frames = self.receive(1)
+        ae([f.ssrc for f in frames], [rtp1.ssrc] * 3)
+        ae([f.seq for f in frames], [seq % 2**16, (seq + 2) % 2**16,
+                                     (seq + 3) % 2**16])
+        ae([f.ts for f in frames], [ts, ts + 320, ts + 320])
+        ae([f.pt for f in frames], [0, 0, 96])
+        ae([f.marker for f in frames], [1, 0, 0])
+        ae(frames[1].data, b'\x7f' * 160)
+        stats = self.relay.getStats()[0]
+        ae(stats['packets'], 3)
+        ae(stats['dropped'], 1)
+        ae(stats['lost'], 1)
+        ae(stats['bytes'], 12 * 3 + 160 * 2 + 4)
+        # Nothing the other way
+        ae(self.relay.getStats()[1]['packets'], 0)
+        self.relay.stop()
+        self.relay = None
+        ae(rtp0._relay, None)
+        # rtp1's own packets carry on after the relayed ones
+        ae(rtp1.seq % 2**16, (seq + 4) % 2**16)
+        ae(rtp1.ts, ts + 480)
+
+    def test_connectedAndPacketSize(self):
+        from shtoom.rtp.relay import relayRTP
+        ae = self.assertEqual
+        rtp0, rtp1 = self.rtps
+        # rtp1 only talks to its phone
+        rtp1.rtpListener.connect(*rtp1.dest)
+        ts = rtp1.ts
+        self.relay = relayRTP(rtp0, rtp1, reactor)
+        self.assertTrue(self.relay.halves[0].connected)
+        # 30ms packets
+        self.send(0, [(100, 8000, 0, b'\xff' * 240),
+                      (101, 8240, 0, b'\xff' * 240),
+                      # after a silence, the ts jump isn't a packet size
+                      (102, 16000, 0, b'\xff' * 240)], marked=[102])
+        self.relay.halves[0].doRead()
+        frames = self.receive(1)
+        ae([f.ts for f in frames], [ts, ts + 240, ts + 8000])
+        ae(self.relay.getStats()[0]['senderrors'], 0)
+        self.relay.stop()
+        self.relay = None
+        ae(rtp1.ts, ts + 8240)
+
+    def test_cantRelayPooled(self):
+        from shtoom.rtp.relay import relayRTP
+        self.rtps[0].rtcpMux = True
+        self.assertEqual(relayRTP(self.rtps[0], self.rtps[1], reactor), None)
@@ -0,0 +1,106 @@
+# Copyright (C) 2005 Anthony Baxter
+"""Tests for shtoom.audio.vad
+"""
+
+import math, random, struct
+
+from twisted.trial import unittest
+
+def noise(amplitude, seed=1):
+    r = random.Random(seed)
+    return struct.pack('160h', *[int(r.gauss(0, amplitude))
+                                 for x in range(160)])
+
+def tone(amplitude, freq=440):
+    return struct.pack('160h', *[int(amplitude * math.sin(
+                                        2 * math.pi * freq * x / 8000.0))
+                                 for x in range(160)])
+
+class VADTest(unittest.TestCase):
+
+    def testFrameLevel(self):
+        from shtoom.audio import vad
+        ae = self.assertEqual
+        ae(vad.frameLevel(b'\0' * 320), (vad.SILENCE_DB, 0.0))
+        ae(vad.frameLevel(b''), (vad.SILENCE_DB, 0.0))
+        level, zcr = vad.frameLevel(struct.pack('160h', *[32767, -32768] * 80))
+        self.assertAlmostEqual(level, 0.0, 3)
+        self.assertAlmostEqual(zcr, 159 / 160.0)
+        level, zcr = vad.frameLevel(tone(3276.8))
+        # A sine wave is 3dB below a square wave
+        self.assertAlmostEqual(level, -23.0, 0)
+        # 440Hz crosses zero 880 times a second
+        self.assertAlmostEqual(zcr, 880 / 8000.0, 1)
+
+    def testPurePython(self):
+        from shtoom.audio import vad
+        frames = [noise(30), tone(3000), b'\0' * 320, tone(100, 3000)]
+        expected = [ vad.frameLevel(f) for f in frames ]
+        numpy = vad.numpy
+        vad.numpy = None
+        try:
+            got = [ vad.frameLevel(f) for f in frames ]
+        finally:
+            vad.numpy = numpy
+        for (l1, z1), (l2, z2) in zip(got, expected):
+            self.assertAlmostEqual(l1, l2)
+            self.assertAlmostEqual(z1, z2)
+
+    def testTalkspurt(self):
+        from shtoom.audio.vad import VAD, HANGOVER
+        ae = self.assertEqual
+        v = VAD()
+        frames = [noise(30, n) for n in range(20)] + [tone(3000)] * 20 + \
+                 [noise(30, n) for n in range(20)]
+        res = [ v.process(f) for f in frames ]
+        ae(res, [False] * 20 + [True] * (20 + HANGOVER) +
+                [False] * (20 - HANGOVER))
+        # The quietest of the noise frames
+        self.assertTrue(60 <= v.noiseLevel() <= 63, v.noiseLevel())
+        ae(v.speechFrames, 20 + HANGOVER)
+        # Digital silence is never speech
+        v.reset()
+        ae([ v.process(b'\0' * 320) for n in range(5) ], [False] * 5)
+        ae(v.noiseLevel(), 127)
+
+    def testSustainedSound(self):
+        from shtoom.audio.vad import VAD, HANGOVER
+        ae = self.assertEqual
+        v = VAD()
+        for n in range(20):
+            v.process(noise(30, n))
+        # Ten seconds of a -20dBov tone - hold music, say - is never
+        # taken for background noise
+        res = [ v.process(tone(4634)) for n in range(500) ]
+        ae(res, [True] * 500)
+        self.assertTrue(v.floor < -50, v.floor)
+        # Background noise getting a bit louder is followed, though
+        res = [ v.process(noise(80, n)) for n in range(100) ]
+        ae(res, [True] * HANGOVER + [False] * (100 - HANGOVER))
+        self.assertTrue(51 <= v.noiseLevel() <= 54, v.noiseLevel())
+
+    def testCodecker(self):
+        from shtoom.audio.converters import Codecker
+        from shtoom.audio.vad import VAD, HANGOVER, cnPayload
+        from shtoom.rtp.formats import PT_PCMU, PT_CN
+        ae = self.assertEqual
+        c = Codecker(PT_PCMU)
+        c.setVAD(VAD())
+        out = []
+        c.set_handler(out.append)
+        frames = [noise(30, n) for n in range(5)] + [tone(3000)] * 2 + \
+                 [noise(30, n) for n in range(HANGOVER + 3)]
+        # Hand it over in odd sized chunks
+        audio = b''.join(frames)
+        for n in range(0, len(audio), 500):
+            c.handle_audio(audio[n:n+500])
+        ae(len(out), len(frames))
+        ae([ s and s.ct for s in out ],
+           [PT_CN, None, None, None, None] +
+           [PT_PCMU] * (2 + HANGOVER) + [PT_CN, None, None])
+        ae(out[0].data, cnPayload(61))
+        ae(out[5].data, Codecker(PT_PCMU).handle_audio(tone(3000)).data)
+        # Turned off, everything's sent
+        c.setVAD(None)
+        c.handle_audio(noise(30))
+        ae(out[-1].ct, PT_PCMU)